@@ -0,0 +1,64 @@
+"""
+A shared, pooled HTTP client for calls to the agent admin API(s)
+"""
+
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class AdminClient:
+    """
+    Thin wrapper around a `requests.Session` with keep-alive connection pooling.
+
+    One client is shared by all threads: connections are pooled per host by
+    urllib3 (which is thread-safe) and the session never stores cookies, so no
+    per-request state is shared between callers.  Every call gets a
+    (connect, read) timeout unless the caller supplies its own.
+
+    If `error_counter` (a `CounterMetric` labelled by method and status) is
+    given, it counts the requests that fail or get an error (4xx/5xx) status.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 10,
+        pool_hosts: int = 4,
+        connect_timeout: float = 5,
+        read_timeout: float = 60,
+        error_counter=None,
+    ):
+        self.pool_size = pool_size
+        self.pool_hosts = pool_hosts
+        self.timeout = (connect_timeout, read_timeout)
+        self.error_counter = error_counter
+        self._session = requests.Session()
+        self._session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        if self.error_counter is None:
+            return self._session.request(method, url, **kwargs)
+        try:
+            response = self._session.request(method, url, **kwargs)
+        except Exception:
+            self.error_counter.inc(method, "error")
+            raise
+        if response.status_code >= 400:
+            self.error_counter.inc(method, str(response.status_code))
+        return response
+
+    def get(self, url: str, headers: dict = None, **kwargs) -> requests.Response:
+        return self.request("GET", url, headers=headers, **kwargs)
+
+    def post(
+        self, url: str, data=None, headers: dict = None, **kwargs
+    ) -> requests.Response:
+        return self.request("POST", url, data=data, headers=headers, **kwargs)
+
+    def close(self):
+        self._session.close()
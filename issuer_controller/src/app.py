@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 import json
 import os
+import re
 import signal
 import time
 
@@ -10,6 +11,8 @@ from flask import Flask, abort, jsonify, make_response, request
 from flask_cors import CORS
 
 from src import authentication, config, issuer
+from src.executor import QueueFullError
+from src.webhooks import WEBHOOK_MODE_QUEUED, empty_response
 
 # Load application settings (environment)
 config_root = os.environ.get("CONFIG_ROOT", "../config")
@@ -45,10 +48,17 @@ def readiness_check():
     A readiness probe checks if the container is ready to handle requests.
     A failed readiness probe means that a container should not receive any traffic from a proxy, even if it's running.
     """
-    if issuer.tob_connection_synced():
-        return make_response(jsonify({"success": True}), 200)
-    else:
-        abort(503, "Connection not ready to process requests")
+    ready = issuer.tob_connection_synced()
+    return make_response(
+        jsonify(
+            {
+                "success": ready,
+                "startup": issuer.startup_status(),
+                "agent_circuit": issuer.agent_breaker.to_dict(),
+            }
+        ),
+        200 if ready else 503,
+    )
 
 
 @app.route("/liveness", methods=["GET"])
@@ -74,11 +84,97 @@ def get_status():
     return make_response(jsonify(issuer.get_stats()), 200)
 
 
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    response = make_response(issuer.metrics.render(), 200)
+    response.headers["Content-Type"] = issuer.metrics.CONTENT_TYPE
+    return response
+
+
 @app.errorhandler(404)
 def not_found(error):
     return make_response(jsonify({"error": "Not found"}), 404)
 
 
+def async_requested():
+    """
+    Return True if the client asked for a batch to be processed as a background job,
+    either with "?async=true" or a "Prefer: respond-async" header.
+    """
+    if request.args.get("async", "").lower() == "true":
+        return True
+    return "respond-async" in request.headers.get("Prefer", "")
+
+
+def stream_requested():
+    """
+    Return True if the client asked for per-credential responses to be streamed back
+    as NDJSON as each exchange completes.
+    """
+    best = request.accept_mimetypes.best_match(
+        ["application/json", issuer.NDJSON_MIMETYPE], default="application/json"
+    )
+    return best == issuer.NDJSON_MIMETYPE
+
+
+TRACE_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+
+def requested_trace_ids(cred_input):
+    """
+    Return the trace ids the client gave the credentials in a batch, or None.
+
+    Aborts with a 400 unless there is one valid id per credential.
+    """
+    header = request.headers.get(issuer.TRACE_IDS_HEADER)
+    if not header:
+        return None
+    trace_ids = [trace_id.strip() for trace_id in header.split(",")]
+    if not isinstance(cred_input, list) or len(trace_ids) != len(cred_input):
+        abort(400, issuer.TRACE_IDS_HEADER + " must have one id per credential")
+    for trace_id in trace_ids:
+        if not TRACE_ID_PATTERN.match(trace_id):
+            abort(400, "Invalid trace id: " + trace_id)
+    return trace_ids
+
+
+def agent_unavailable_response():
+    """A 503 for credentials submitted while the agent's circuit breaker is open."""
+    response = make_response(
+        jsonify({"success": False, "error": "Agent is unavailable"}), 503
+    )
+    response.headers["Retry-After"] = str(int(issuer.agent_breaker.retry_after() + 0.5))
+    return response
+
+
+def too_many_exchanges_response():
+    """A 429 for credentials submitted while the agent is at its concurrency limit."""
+    response = make_response(
+        jsonify({"success": False, "error": "Too many credential exchanges in flight"}),
+        429,
+    )
+    response.headers["Retry-After"] = str(issuer.concurrency_limiter.retry_after())
+    return response
+
+
+def credential_job_response(job):
+    response = make_response(jsonify(job.to_dict(include_results=False)), 202)
+    response.headers["Location"] = "/jobs/" + job.job_id
+    return response
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+@authentication.auth_required
+def get_credential_job(job_id):
+    """
+    Return the status and per-credential results of a background credential batch.
+    """
+    job = issuer.get_credential_job(job_id)
+    if not job:
+        abort(404)
+    return make_response(jsonify(job.to_dict()), 200)
+
+
 @app.route("/issue-credential", methods=["POST"])
 @authentication.auth_required
 def submit_credential():
@@ -87,6 +183,8 @@ def submit_credential():
     """
     if not issuer.tob_connection_synced():
         abort(503, "Connection not yet synced")
+    if issuer.agent_breaker.is_open():
+        return agent_unavailable_response()
 
     start_time = time.perf_counter()
     method = "submit_credential.batch"
@@ -97,8 +195,32 @@ def submit_credential():
         abort(400)
 
     cred_input = request.json
+    trace_ids = requested_trace_ids(cred_input)
 
-    response = issuer.handle_send_credential(cred_input)
+    # reserve a slot for every credential in the batch, or refuse all of them
+    permit = issuer.reserve_exchanges(
+        len(cred_input) if isinstance(cred_input, list) else 1
+    )
+    if permit is None:
+        end_time = time.perf_counter()
+        issuer.log_timing_method(method, start_time, end_time, False)
+        return too_many_exchanges_response()
+
+    try:
+        if async_requested():
+            response = credential_job_response(
+                issuer.start_credential_job(cred_input, trace_ids, permit)
+            )
+        else:
+            response = issuer.handle_send_credential(
+                cred_input,
+                stream=stream_requested(),
+                trace_ids=trace_ids,
+                permit=permit,
+            )
+    except Exception:
+        permit.release_all()
+        raise
 
     end_time = time.perf_counter()
     issuer.log_timing_method(method, start_time, end_time, True)
@@ -113,6 +235,8 @@ def submit_credential_v20():
     """
     if not issuer.tob_connection_synced():
         abort(503, "Connection not yet synced")
+    if issuer.agent_breaker.is_open():
+        return agent_unavailable_response()
 
     start_time = time.perf_counter()
     method = 'submit_credential_v20.batch'
@@ -123,8 +247,32 @@ def submit_credential_v20():
         abort(400)
 
     cred_input = request.json
+    trace_ids = requested_trace_ids(cred_input)
 
-    response = issuer.handle_send_credential_v20(cred_input)
+    # reserve a slot for every credential in the batch, or refuse all of them
+    permit = issuer.reserve_exchanges(
+        len(cred_input) if isinstance(cred_input, list) else 1
+    )
+    if permit is None:
+        end_time = time.perf_counter()
+        issuer.log_timing_method(method, start_time, end_time, False)
+        return too_many_exchanges_response()
+
+    try:
+        if async_requested():
+            response = credential_job_response(
+                issuer.start_credential_job_v20(cred_input, trace_ids, permit)
+            )
+        else:
+            response = issuer.handle_send_credential_v20(
+                cred_input,
+                stream=stream_requested(),
+                trace_ids=trace_ids,
+                permit=permit,
+            )
+    except Exception:
+        permit.release_all()
+        raise
 
     end_time = time.perf_counter()
     issuer.log_timing_method(method, start_time, end_time, True)
@@ -147,65 +295,51 @@ def agent_callback(topic):
         abort(400)
 
     message = request.json
-    issuer.log_timing_event(method, message, start_time, None, False)
-
-    # dispatch based on the topic type
-    if topic == issuer.TOPIC_CONNECTIONS:
-        if "state" in message:
-            method = method + "." + message["state"]
-            response = issuer.handle_connections(message["state"], message)
-        else:
-            response = jsonify({})
-
-    elif topic == issuer.TOPIC_CREDENTIALS:
-        if "state" in message:
-            method = method + "." + message["state"]
-            response = issuer.handle_credentials(message["state"], message)
-        else:
-            response = jsonify({})
-
-    elif topic == issuer.TOPIC_CREDENTIALS_V20 or topic == issuer.TOPIC_CREDENTIALS_V20_INDY:
-        if "state" in message:
-            method = method + '.' + message["state"]
-            response =  issuer.handle_credentials_v20(message["state"], message)
-        else:
-            response =  jsonify({})
-
-    elif topic == issuer.TOPIC_PRESENTATIONS:
-        if "state" in message:
-            method = method + "." + message["state"]
-            response = issuer.handle_presentations(message["state"], message)
-        else:
-            response = jsonify({})
-
-    elif topic == issuer.TOPIC_PRESENTATIONS_V20:
-        if "state" in message:
-            method = method + '.' + message["state"]
-            response =  issuer.handle_presentations_v20(message["state"], message)
-        else:
-            response =  jsonify({})
-
-    elif topic == issuer.TOPIC_GET_ACTIVE_MENU:
-        response = issuer.handle_get_active_menu(message)
-
-    elif topic == issuer.TOPIC_PERFORM_MENU_ACTION:
-        response = issuer.handle_perform_menu_action(message)
-
-    elif topic == issuer.TOPIC_ISSUER_REGISTRATION:
-        response = issuer.handle_register_issuer(message)
-
-    elif topic == issuer.TOPIC_PROBLEM_REPORT:
-        response = issuer.handle_problem_report(message)
-
-    else:
+    handler = issuer.webhook_dispatcher.get(topic)
+    if handler is None:
         print("Callback: topic=", topic, ", message=", message)
         end_time = time.perf_counter()
         issuer.log_timing_method(method, start_time, end_time, False)
         issuer.log_timing_event(method, message, start_time, end_time, False)
         abort(400, {"message": "Invalid topic: " + topic})
 
+    # fast path for topics and states we don't act on
+    if handler.is_noop(message):
+        return empty_response()
+
+    if issuer.WEBHOOK_MODE == WEBHOOK_MODE_QUEUED:
+        missing = handler.missing_fields(message)
+        if missing:
+            abort(400, {"message": "Missing fields: " + ", ".join(missing)})
+        try:
+            if issuer.webhook_queue.submit(apply_webhook, topic, handler, message):
+                return empty_response()
+        except QueueFullError:
+            abort(503, "Webhook queue is full")
+
+    return apply_webhook(topic, handler, message, start_time)
+
+
+def apply_webhook(topic, handler, message, start_time=None):
+    """Run the handler for a webhook, with timing and tracing."""
+    if start_time is None:
+        start_time = time.perf_counter()
+    method = handler.method_name(topic, message)
+    trace_id = issuer.get_credential_trace_id(message)
+    issuer.log_timing_event(
+        method, message, start_time, None, False, trace_id=trace_id
+    )
+    # queued webhooks are applied on a consumer thread, outside of any request
+    with app.app_context():
+        response = handler(message)
+
     end_time = time.perf_counter()
+    issuer.webhook_duration.observe(
+        end_time - start_time, topic, message.get("state", "")
+    )
     issuer.log_timing_method(method, start_time, end_time, True)
-    issuer.log_timing_event(method, message, start_time, end_time, True)
+    issuer.log_timing_event(
+        method, message, start_time, end_time, True, trace_id=trace_id
+    )
 
     return response
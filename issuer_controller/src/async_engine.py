@@ -0,0 +1,143 @@
+"""
+An asyncio-based engine for posting credential offers to the agent
+
+The engine runs its own event loop on a background thread, so that callers on
+the (threaded or gevent) Flask side can submit coroutines and get back a
+`concurrent.futures.Future`.  Each in-flight exchange is just a coroutine
+waiting on an asyncio future, which is resolved from the webhook handlers.
+
+Note that the event loop runs in a real OS thread; use a threaded gunicorn
+worker class (e.g. gthread) rather than gevent with this engine.
+"""
+
+import asyncio
+import logging
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AsyncResult:
+    """
+    An awaitable equivalent of `threading.Event` for a single exchange.
+
+    `set()` may be called from any thread; `wait()` must be awaited on the
+    engine's event loop.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self._future = loop.create_future()
+
+    def _resolve(self):
+        if not self._future.done():
+            self._future.set_result(True)
+
+    def set(self):
+        self._loop.call_soon_threadsafe(self._resolve)
+
+    def is_set(self) -> bool:
+        return self._future.done()
+
+    async def wait(self, timeout: float = None) -> bool:
+        try:
+            await asyncio.wait_for(asyncio.shield(self._future), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+
+class AsyncIssuanceEngine:
+    """Own an event loop thread and a pooled aiohttp client session."""
+
+    def __init__(
+        self,
+        max_in_flight: int,
+        pool_size: int = 100,
+        connect_timeout: float = 5,
+        read_timeout: float = 60,
+    ):
+        self.max_in_flight = max(max_in_flight, 1)
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._session = None
+        self._semaphore = None
+        self._in_flight = 0
+
+    @property
+    def session(self):
+        return self._session
+
+    def start(self):
+        with self._lock:
+            if self._loop:
+                return
+            try:
+                import aiohttp
+            except ImportError:
+                raise RuntimeError(
+                    "The asyncio issuance engine requires the aiohttp package"
+                )
+
+            loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(
+                target=loop.run_forever, name="async-issuance", daemon=True
+            )
+            self._thread.start()
+
+            async def _setup():
+                self._semaphore = asyncio.Semaphore(self.max_in_flight)
+                self._session = aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(limit=self.pool_size),
+                    timeout=aiohttp.ClientTimeout(
+                        sock_connect=self.connect_timeout,
+                        sock_read=self.read_timeout,
+                    ),
+                )
+
+            asyncio.run_coroutine_threadsafe(_setup(), loop).result()
+            self._loop = loop
+            LOGGER.info(
+                "Started asyncio issuance engine (max in flight = %s)",
+                self.max_in_flight,
+            )
+
+    def create_waiter(self) -> AsyncResult:
+        """Create a waiter bound to the engine's event loop."""
+        return AsyncResult(self._loop)
+
+    async def _run(self, coro):
+        async with self._semaphore:
+            self._in_flight = self._in_flight + 1
+            try:
+                return await coro
+            finally:
+                self._in_flight = self._in_flight - 1
+
+    def submit(self, coro):
+        """Schedule a coroutine on the engine and return a concurrent future."""
+        if not self._loop:
+            self.start()
+        return asyncio.run_coroutine_threadsafe(self._run(coro), self._loop)
+
+    def stats(self) -> dict:
+        return {
+            "running": self._loop is not None,
+            "max_in_flight": self.max_in_flight,
+            "in_flight": self._in_flight,
+        }
+
+    def shutdown(self):
+        with self._lock:
+            loop = self._loop
+            if not loop:
+                return
+            self._loop = None
+        asyncio.run_coroutine_threadsafe(self._session.close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join()
+        loop.close()
@@ -1,11 +1,166 @@
 import json
 import os
+import threading
+import time
+from collections import OrderedDict
 from functools import wraps
 
 import requests
 from flask import jsonify, request, make_response
 from jose import jwt
 
+# how long (in seconds) fetched signing keys are used before they are
+# refreshed; stale keys are still used while the refresh runs in the background
+JWKS_CACHE_TTL = float(os.getenv("JWKS_CACHE_TTL", "300"))
+
+# min seconds between fetches triggered by tokens signed with an unknown key
+JWKS_MIN_REFRESH_INTERVAL = float(os.getenv("JWKS_MIN_REFRESH_INTERVAL", "10"))
+
+# timeout (in seconds) for fetching the signing keys
+JWKS_FETCH_TIMEOUT = float(os.getenv("JWKS_FETCH_TIMEOUT", "5"))
+
+# max number of verified tokens remembered (each until it expires)
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "1000"))
+
+
+class JwksCache:
+    """
+    The identity provider's signing keys, indexed by kid.
+
+    Keys are fetched on first use, and again (at most every
+    `min_refresh_interval` seconds) when a token names a kid we don't have.
+    Once they are older than `ttl` they are refreshed in the background and
+    the cached keys are used until that succeeds, so an identity provider
+    outage doesn't stop requests with known keys.
+    """
+
+    def __init__(self, ttl: float, min_refresh_interval: float, timeout: float):
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self._uri = None
+        self._keys = {}
+        self._fetched_at = None
+        self._attempted_at = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+
+    def _recently_attempted(self) -> bool:
+        return (
+            self._attempted_at is not None
+            and time.monotonic() - self._attempted_at < self.min_refresh_interval
+        )
+
+    def _fetch(self, uri: str, kid: str = None):
+        """Fetch the keys; for a `kid`, only if another caller hasn't just done so."""
+        with self._fetch_lock:
+            with self._lock:
+                if kid is not None and (
+                    kid in self._keys or self._recently_attempted()
+                ):
+                    return
+                self._attempted_at = time.monotonic()
+            try:
+                oidc_jwks = requests.get(uri, timeout=self.timeout).json()
+                keys = {jwk["kid"]: jwk for jwk in oidc_jwks["keys"] if "kid" in jwk}
+            except Exception as e:
+                print("Error fetching signing keys from " + uri + ": " + str(e))
+                return
+            with self._lock:
+                if self._uri == uri:
+                    self._keys = keys
+                    self._fetched_at = time.monotonic()
+
+    def _background_refresh(self, uri: str):
+        try:
+            self._fetch(uri)
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def get(self, uri: str, kid: str) -> dict:
+        """Return the key with the given kid, or None if there isn't one."""
+        with self._lock:
+            if self._uri != uri:
+                self._uri = uri
+                self._keys = {}
+                self._fetched_at = None
+                self._attempted_at = None
+            key = self._keys.get(kid)
+            stale = (
+                self._fetched_at is not None
+                and time.monotonic() - self._fetched_at >= self.ttl
+            )
+            if (
+                key is not None
+                and stale
+                and not self._refreshing
+                and not self._recently_attempted()
+            ):
+                self._refreshing = True
+                threading.Thread(
+                    target=self._background_refresh,
+                    args=(uri,),
+                    name="jwks-refresh",
+                    daemon=True,
+                ).start()
+        if key is not None:
+            return key
+
+        # unknown kid (or no keys yet): fetch now, unless we just did
+        self._fetch(uri, kid)
+        with self._lock:
+            return self._keys.get(kid)
+
+    def clear(self):
+        with self._lock:
+            self._uri = None
+            self._keys = {}
+            self._fetched_at = None
+            self._attempted_at = None
+
+
+class VerifiedTokenCache:
+    """
+    An LRU set of tokens whose signature and claims have been verified, each
+    remembered until its `exp` time; tokens without one aren't cached.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._tokens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def contains(self, token: str) -> bool:
+        with self._lock:
+            exp = self._tokens.get(token)
+            if exp is None:
+                return False
+            if exp <= time.time():
+                del self._tokens[token]
+                return False
+            self._tokens.move_to_end(token)
+            return True
+
+    def add(self, token: str, claims: dict):
+        exp = claims.get("exp")
+        if not isinstance(exp, (int, float)) or self.max_size <= 0:
+            return
+        with self._lock:
+            self._tokens[token] = exp
+            self._tokens.move_to_end(token)
+            while len(self._tokens) > self.max_size:
+                self._tokens.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
+
+
+jwks_cache = JwksCache(JWKS_CACHE_TTL, JWKS_MIN_REFRESH_INTERVAL, JWKS_FETCH_TIMEOUT)
+verified_tokens = VerifiedTokenCache(TOKEN_CACHE_SIZE)
+
 
 def auth_required(f):
     @wraps(f)
@@ -46,23 +201,20 @@ def validate_token(*args, **kwargs):
         if "Authorization" in request.headers:
             try:
                 token = request.headers["Authorization"].split()[1]
+                if verified_tokens.contains(token):
+                    return True
                 kid = jwt.get_unverified_header(token)["kid"]
-                oidc_jwks = requests.get(oidc_jwks_uri).json()
-                public_key = None
-                algorithms = []
-                for jwk in oidc_jwks["keys"]:
-                    if jwk["kid"] == kid:
-                        public_key = jwk
-                        if "alg" in jwk:
-                            algorithms = [jwk["alg"]]
-                        else:
-                            algorithms = ["RS256"]
-                jwt.decode(
+                public_key = jwks_cache.get(oidc_jwks_uri, kid)
+                if public_key is None:
+                    raise Exception("Unknown signing key: " + str(kid))
+                algorithms = [public_key.get("alg", "RS256")]
+                claims = jwt.decode(
                     token,
                     public_key,
                     algorithms=algorithms,
                     options={"verify_aud": False, "verify_at_hash": False},
                 )
+                verified_tokens.add(token, claims)
             except Exception as e:
                 print("Error verifying bearer token: " + str(e))
                 return False
@@ -0,0 +1,353 @@
+"""
+Correlation of outstanding credential exchanges with the agent's webhook callbacks
+"""
+
+import logging
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+from src.metrics import LOCK_WAIT_BOUNDS, Histogram
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ExchangeEntry:
+    """The correlation state for a single credential exchange."""
+
+    __slots__ = (
+        "cred_exch_id",
+        "thread_id",
+        "trace_id",
+        "waiter",
+        "response",
+        "deadline",
+    )
+
+    def __init__(self, cred_exch_id: str, deadline: float):
+        self.cred_exch_id = cred_exch_id
+        self.thread_id = None
+        self.trace_id = None
+        self.waiter = None
+        self.response = None
+        self.deadline = deadline
+
+
+class _Shard:
+    """One partition of the table, with its own lock and lock-wait histogram."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.entries = {}
+        self.threads = {}
+        # responses received by thread id before the thread id was registered
+        self.early_responses = {}
+        self.lock_wait = Histogram(LOCK_WAIT_BOUNDS)
+        self.orphaned_count = 0
+        self.expired_count = 0
+        self.evicted_count = 0
+
+    @contextmanager
+    def locked(self):
+        start_time = time.perf_counter()
+        self._lock.acquire()
+        try:
+            # recorded while we hold the lock, so no extra synchronization needed
+            self.lock_wait.record(time.perf_counter() - start_time)
+            yield self
+        finally:
+            self._lock.release()
+
+
+class CorrelationTable:
+    """
+    Track credential exchanges by credential exchange id and by thread id.
+
+    An entry is created either by the issuer waiting on an exchange
+    (`add_request`) or by a webhook for the exchange (`set_thread_id`,
+    `add_response`), whichever comes first.  Every entry has a deadline:
+    entries with a waiter live for `ttl` seconds, entries nobody is waiting on
+    ("orphans") live for `orphan_ttl` seconds, and expired entries are
+    removed by `expire()`, which is run periodically by a background thread.
+    At most `max_entries` entries are kept; when a shard is full its oldest
+    orphan is dropped to make room.
+
+    Responses that only carry a thread id (problem reports) and arrive before
+    that thread id has been registered are held for `early_ttl` seconds, and
+    are applied as soon as the thread id is registered.
+
+    Entries are partitioned over `shard_count` shards by credential exchange
+    id, and the thread id index by thread id, each shard with its own lock.
+    No operation holds more than one shard lock at a time.
+    """
+
+    def __init__(
+        self,
+        ttl: float,
+        orphan_ttl: float,
+        max_entries: int,
+        shard_count: int = 16,
+        early_ttl: float = 60,
+    ):
+        self.ttl = ttl
+        self.orphan_ttl = orphan_ttl
+        self.early_ttl = early_ttl
+        self.max_entries = max(max_entries, 1)
+        self._shards = [_Shard() for _ in range(max(shard_count, 1))]
+        self._shard_max_entries = max(self.max_entries // len(self._shards), 1)
+        self._expiry_lock = threading.Lock()
+        self._expiry_thread = None
+
+    def _shard(self, key: str) -> _Shard:
+        return self._shards[zlib.crc32(key.encode()) % len(self._shards)]
+
+    def _index_thread(self, thread_id: str, cred_exch_id: str):
+        with self._shard(thread_id).locked() as shard:
+            shard.threads[thread_id] = cred_exch_id
+            early = shard.early_responses.pop(thread_id, None)
+        if early:
+            self.add_response(cred_exch_id, early[0])
+
+    def _unindex_thread(self, thread_id: str, cred_exch_id: str):
+        if thread_id is None:
+            return
+        with self._shard(thread_id).locked() as shard:
+            if shard.threads.get(thread_id) == cred_exch_id:
+                del shard.threads[thread_id]
+
+    def _get_or_create(self, shard: _Shard, cred_exch_id: str):
+        """
+        Return the entry (and any entry evicted to make room); the shard must
+        be locked.
+        """
+        evicted = None
+        entry = shard.entries.get(cred_exch_id)
+        if entry is None:
+            if len(shard.entries) >= self._shard_max_entries:
+                for oldest in shard.entries.values():
+                    if oldest.waiter is None:
+                        evicted = shard.entries.pop(oldest.cred_exch_id)
+                        shard.evicted_count = shard.evicted_count + 1
+                        break
+            entry = ExchangeEntry(cred_exch_id, time.monotonic() + self.orphan_ttl)
+            shard.entries[cred_exch_id] = entry
+        return entry, evicted
+
+    def set_thread_id(self, cred_exch_id: str, thread_id: str):
+        with self._shard(cred_exch_id).locked() as shard:
+            entry, evicted = self._get_or_create(shard, cred_exch_id)
+            entry.thread_id = thread_id
+        if evicted:
+            self._unindex_thread(evicted.thread_id, evicted.cred_exch_id)
+        self._index_thread(thread_id, cred_exch_id)
+
+    def get_cred_exch_id(self, thread_id: str) -> str:
+        with self._shard(thread_id).locked() as shard:
+            return shard.threads.get(thread_id)
+
+    def add_thread_response(self, thread_id: str, response: dict) -> str:
+        """
+        Record a response for the exchange with the given thread id.
+
+        Returns the credential exchange id, or None if the thread id isn't
+        registered yet (in which case the response is held until it is).
+        """
+        with self._shard(thread_id).locked() as shard:
+            cred_exch_id = shard.threads.get(thread_id)
+            if cred_exch_id is None:
+                if (
+                    thread_id not in shard.early_responses
+                    and len(shard.early_responses) >= self._shard_max_entries
+                ):
+                    # drop the oldest held response to make room
+                    del shard.early_responses[next(iter(shard.early_responses))]
+                    shard.evicted_count = shard.evicted_count + 1
+                shard.early_responses[thread_id] = (
+                    response,
+                    time.monotonic() + self.early_ttl,
+                )
+        if cred_exch_id is not None:
+            self.add_response(cred_exch_id, response)
+        return cred_exch_id
+
+    def add_request(
+        self, cred_exch_id: str, waiter, thread_id: str = None, trace_id: str = None
+    ):
+        """
+        Register `waiter` (and optionally the thread id and the credential's
+        trace id) for an exchange, or return None if the response has already
+        been received.
+        """
+        with self._shard(cred_exch_id).locked() as shard:
+            entry, evicted = self._get_or_create(shard, cred_exch_id)
+            if thread_id is not None:
+                entry.thread_id = thread_id
+            if trace_id is not None:
+                entry.trace_id = trace_id
+            if entry.response is None:
+                entry.waiter = waiter
+                entry.deadline = time.monotonic() + self.ttl
+            else:
+                waiter = None
+        if evicted:
+            self._unindex_thread(evicted.thread_id, evicted.cred_exch_id)
+        if thread_id is not None:
+            # applies any problem report that arrived before we knew the thread id
+            self._index_thread(thread_id, cred_exch_id)
+        return waiter
+
+    def add_response(self, cred_exch_id: str, response: dict):
+        with self._shard(cred_exch_id).locked() as shard:
+            entry, evicted = self._get_or_create(shard, cred_exch_id)
+            entry.response = response
+            waiter = entry.waiter
+        if evicted:
+            self._unindex_thread(evicted.thread_id, evicted.cred_exch_id)
+        if waiter is not None:
+            waiter.set()
+
+    def get_trace_id(self, cred_exch_id: str) -> str:
+        with self._shard(cred_exch_id).locked() as shard:
+            entry = shard.entries.get(cred_exch_id)
+            return entry.trace_id if entry is not None else None
+
+    def pop_response(self, cred_exch_id: str):
+        """Remove an exchange, returning its (response, thread_id)."""
+        with self._shard(cred_exch_id).locked() as shard:
+            entry = shard.entries.pop(cred_exch_id, None)
+        if entry is None:
+            return None, None
+        self._unindex_thread(entry.thread_id, cred_exch_id)
+        return entry.response, entry.thread_id
+
+    def discard(self, cred_exch_id: str):
+        self.pop_response(cred_exch_id)
+
+    def is_waiting(self, cred_exch_id: str) -> bool:
+        with self._shard(cred_exch_id).locked() as shard:
+            entry = shard.entries.get(cred_exch_id)
+            return entry is not None and entry.waiter is not None
+
+    def outstanding_ids(self) -> list:
+        """Return the ids of exchanges that are waiting for a response."""
+        ret = []
+        for shard in self._shards:
+            with shard.locked():
+                ret.extend(
+                    entry.cred_exch_id
+                    for entry in shard.entries.values()
+                    if entry.waiter is not None and entry.response is None
+                )
+        return ret
+
+    def outstanding_count(self) -> int:
+        return len(self.outstanding_ids())
+
+    def expire(self):
+        """Remove all entries that are past their deadline."""
+        now = time.monotonic()
+        expired = []
+        for shard in self._shards:
+            with shard.locked():
+                shard_expired = [
+                    entry for entry in shard.entries.values() if entry.deadline < now
+                ]
+                for entry in shard_expired:
+                    del shard.entries[entry.cred_exch_id]
+                    if entry.waiter is None:
+                        shard.orphaned_count = shard.orphaned_count + 1
+                    else:
+                        shard.expired_count = shard.expired_count + 1
+                early_expired = [
+                    thread_id
+                    for thread_id, (_, deadline) in shard.early_responses.items()
+                    if deadline < now
+                ]
+                for thread_id in early_expired:
+                    del shard.early_responses[thread_id]
+                    shard.orphaned_count = shard.orphaned_count + 1
+            expired.extend(shard_expired)
+            for thread_id in early_expired:
+                LOGGER.warning("Expired unmatched response for thread %s", thread_id)
+        for entry in expired:
+            self._unindex_thread(entry.thread_id, entry.cred_exch_id)
+        self._expire_thread_index()
+        for entry in expired:
+            LOGGER.warning(
+                "Expired %s credential exchange %s (thread %s)",
+                "orphaned" if entry.waiter is None else "outstanding",
+                entry.cred_exch_id,
+                entry.thread_id,
+            )
+
+    def _has_entry(self, cred_exch_id: str) -> bool:
+        with self._shard(cred_exch_id).locked() as shard:
+            return cred_exch_id in shard.entries
+
+    def _expire_thread_index(self):
+        # a thread id can be indexed just after its exchange was removed, so
+        # drop any index entries that no longer point at an exchange
+        for shard in self._shards:
+            with shard.locked():
+                thread_ids = list(shard.threads.items())
+            stale = [
+                (thread_id, cred_exch_id)
+                for thread_id, cred_exch_id in thread_ids
+                if not self._has_entry(cred_exch_id)
+            ]
+            if stale:
+                with shard.locked():
+                    for thread_id, cred_exch_id in stale:
+                        if shard.threads.get(thread_id) == cred_exch_id:
+                            del shard.threads[thread_id]
+
+    def _run_expiry(self, interval: float):
+        while True:
+            time.sleep(interval)
+            try:
+                self.expire()
+            except Exception:
+                LOGGER.exception("Error expiring credential exchanges")
+
+    def start_expiry(self, interval: float):
+        """Start the background thread that expires stale entries."""
+        with self._expiry_lock:
+            if self._expiry_thread:
+                return
+            self._expiry_thread = threading.Thread(
+                target=self._run_expiry,
+                args=(interval,),
+                name="correlation-expiry",
+                daemon=True,
+            )
+            self._expiry_thread.start()
+
+    def stats(self) -> dict:
+        ret = {
+            "backend": "memory",
+            "shard_count": len(self._shards),
+            "entry_count": 0,
+            "early_response_count": 0,
+            "max_entries": self.max_entries,
+            "outstanding_count": 0,
+            "orphaned_count": 0,
+            "expired_count": 0,
+            "evicted_count": 0,
+        }
+        lock_wait = Histogram(LOCK_WAIT_BOUNDS)
+        for shard in self._shards:
+            with shard.locked():
+                ret["entry_count"] += len(shard.entries)
+                ret["early_response_count"] += len(shard.early_responses)
+                ret["outstanding_count"] += sum(
+                    1
+                    for entry in shard.entries.values()
+                    if entry.waiter is not None and entry.response is None
+                )
+                ret["orphaned_count"] += shard.orphaned_count
+                ret["expired_count"] += shard.expired_count
+                ret["evicted_count"] += shard.evicted_count
+                lock_wait.merge(shard.lock_wait)
+        ret["lock_wait"] = lock_wait.to_dict()
+        return ret
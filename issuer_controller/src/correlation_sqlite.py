@@ -0,0 +1,503 @@
+"""
+A correlation table shared by all worker processes, in a SQLite database
+
+Exchange state lives in a SQLite database in WAL mode, so a webhook handled
+by any gunicorn worker can resolve an exchange that another worker is
+waiting on.  Waiters themselves are process-local: each process polls a
+notification log for the exchanges it is waiting on.
+
+Each process uses one connection, serialized by a lock, rather than one per
+thread (under gevent that would be one per greenlet).  SQLite's own busy
+handler sleeps without yielding to the gevent hub, so it only waits briefly;
+when the database stays locked by another process we retry with time.sleep,
+which does yield.
+
+Only the correlation table is shared: each worker still runs its own
+startup thread, agent circuit breaker and adaptive concurrency limiter.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from src.metrics import LOCK_WAIT_BOUNDS, Histogram
+
+LOGGER = logging.getLogger(__name__)
+
+# the longest (in seconds) we sleep between retries while the database is locked
+MAX_BUSY_RETRY_DELAY = 0.1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS exchanges (
+    cred_exch_id TEXT PRIMARY KEY,
+    thread_id TEXT,
+    trace_id TEXT,
+    waiting INTEGER NOT NULL DEFAULT 0,
+    response TEXT,
+    deadline REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS exchanges_deadline ON exchanges (deadline);
+CREATE TABLE IF NOT EXISTS threads (
+    thread_id TEXT PRIMARY KEY,
+    cred_exch_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS early_responses (
+    thread_id TEXT PRIMARY KEY,
+    response TEXT NOT NULL,
+    deadline REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS notifications (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    cred_exch_id TEXT NOT NULL,
+    created REAL NOT NULL
+);
+"""
+
+
+class SqliteCorrelationTable:
+    """
+    A drop-in replacement for `CorrelationTable` backed by a SQLite database
+    at `path`, which must be on a local filesystem shared by the workers.
+
+    Deadlines are wall-clock times, since they are shared between processes.
+    Each process polls for responses to its own waiters every
+    `poll_interval` seconds; responses added by the waiting process itself
+    are delivered immediately.  Outstanding counts are per process, since
+    they are used to decide when this process can shut down.
+
+    SQLite waits up to `busy_timeout` seconds for another process's lock, and
+    we keep retrying (sleeping in between) for up to `lock_timeout` seconds.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl: float,
+        orphan_ttl: float,
+        max_entries: int,
+        early_ttl: float = 60,
+        poll_interval: float = 0.05,
+        busy_timeout: float = 0.01,
+        lock_timeout: float = 30,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.orphan_ttl = orphan_ttl
+        self.max_entries = max(max_entries, 1)
+        self.early_ttl = early_ttl
+        self.poll_interval = poll_interval
+        self.busy_timeout = busy_timeout
+        self.lock_timeout = lock_timeout
+        self._lock = threading.Lock()
+        self._waiters = {}
+        self._lock_wait = Histogram(LOCK_WAIT_BOUNDS)
+        self._orphaned_count = 0
+        self._expired_count = 0
+        self._evicted_count = 0
+        self._poll_thread = None
+        self._expiry_thread = None
+
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(
+            path,
+            timeout=busy_timeout,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        with self._connection() as db:
+            self._retry_busy(lambda: db.execute("PRAGMA journal_mode=WAL"))
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._retry_busy(lambda: db.executescript(SCHEMA))
+            columns = [row[1] for row in db.execute("PRAGMA table_info(exchanges)")]
+            if "trace_id" not in columns:
+                # a database created before exchanges had trace ids
+                db.execute("ALTER TABLE exchanges ADD COLUMN trace_id TEXT")
+        # only responses added from now on are of interest to this process
+        self._last_seq = self._query_one("SELECT MAX(seq) FROM notifications")[0] or 0
+
+    @contextmanager
+    def _connection(self):
+        """The process's connection, locked for the calling thread (or greenlet)."""
+        with self._db_lock:
+            yield self._db
+
+    def _retry_busy(self, fn):
+        """
+        Call `fn()`, retrying (with backoff) while the database is locked.
+
+        `fn` should take the connection lock itself where it can, so the lock is
+        not held while sleeping between attempts.
+        """
+        deadline = time.monotonic() + self.lock_timeout
+        delay = self.busy_timeout
+        while True:
+            try:
+                return fn()
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) and "busy" not in str(e):
+                    raise
+                if time.monotonic() + delay > deadline:
+                    raise
+            # unlike SQLite's busy handler, this sleeps without the connection lock
+            # (unless the caller holds it), so other threads and greenlets can use
+            # the connection in the meantime
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_BUSY_RETRY_DELAY)
+
+    def _query(self, sql: str, params=()) -> list:
+        def attempt():
+            with self._connection() as db:
+                return db.execute(sql, params).fetchall()
+
+        return self._retry_busy(attempt)
+
+    def _query_one(self, sql: str, params=()):
+        rows = self._query(sql, params)
+        return rows[0] if rows else None
+
+    def _transaction(self):
+        return _Transaction(self)
+
+    def _record_lock_wait(self, wait_time: float):
+        with self._lock:
+            self._lock_wait.record(wait_time)
+
+    def _notify(self, db, cred_exch_id: str):
+        db.execute(
+            "INSERT INTO notifications (cred_exch_id, created) VALUES (?, ?)",
+            (cred_exch_id, time.time()),
+        )
+
+    def _set_waiter(self, cred_exch_id: str):
+        with self._lock:
+            waiter = self._waiters.get(cred_exch_id)
+        if waiter is not None:
+            waiter.set()
+
+    def _ensure_exchange(self, db, cred_exch_id: str):
+        db.execute(
+            "INSERT OR IGNORE INTO exchanges (cred_exch_id, deadline) VALUES (?, ?)",
+            (cred_exch_id, time.time() + self.orphan_ttl),
+        )
+
+    def _index_thread(self, db, thread_id: str, cred_exch_id: str) -> bool:
+        """Index the thread id, applying any early response; returns True if one was."""
+        db.execute(
+            "INSERT OR REPLACE INTO threads (thread_id, cred_exch_id) VALUES (?, ?)",
+            (thread_id, cred_exch_id),
+        )
+        row = db.execute(
+            "SELECT response FROM early_responses WHERE thread_id = ?", (thread_id,)
+        ).fetchone()
+        if row is None:
+            return False
+        db.execute("DELETE FROM early_responses WHERE thread_id = ?", (thread_id,))
+        db.execute(
+            "UPDATE exchanges SET response = ? WHERE cred_exch_id = ?",
+            (row[0], cred_exch_id),
+        )
+        self._notify(db, cred_exch_id)
+        return True
+
+    def set_thread_id(self, cred_exch_id: str, thread_id: str):
+        with self._transaction() as db:
+            self._ensure_exchange(db, cred_exch_id)
+            db.execute(
+                "UPDATE exchanges SET thread_id = ? WHERE cred_exch_id = ?",
+                (thread_id, cred_exch_id),
+            )
+            applied = self._index_thread(db, thread_id, cred_exch_id)
+        if applied:
+            self._set_waiter(cred_exch_id)
+
+    def get_cred_exch_id(self, thread_id: str) -> str:
+        row = self._query_one(
+            "SELECT cred_exch_id FROM threads WHERE thread_id = ?", (thread_id,)
+        )
+        return row[0] if row else None
+
+    def add_thread_response(self, thread_id: str, response: dict) -> str:
+        response_json = json.dumps(response)
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT cred_exch_id FROM threads WHERE thread_id = ?", (thread_id,)
+            ).fetchone()
+            if row is None:
+                db.execute(
+                    "INSERT OR REPLACE INTO early_responses"
+                    " (thread_id, response, deadline) VALUES (?, ?, ?)",
+                    (thread_id, response_json, time.time() + self.early_ttl),
+                )
+                return None
+            cred_exch_id = row[0]
+            self._add_response(db, cred_exch_id, response_json)
+        self._set_waiter(cred_exch_id)
+        return cred_exch_id
+
+    def add_request(
+        self, cred_exch_id: str, waiter, thread_id: str = None, trace_id: str = None
+    ):
+        with self._lock:
+            self._waiters[cred_exch_id] = waiter
+        with self._transaction() as db:
+            self._ensure_exchange(db, cred_exch_id)
+            if trace_id is not None:
+                db.execute(
+                    "UPDATE exchanges SET trace_id = ? WHERE cred_exch_id = ?",
+                    (trace_id, cred_exch_id),
+                )
+            row = db.execute(
+                "SELECT response FROM exchanges WHERE cred_exch_id = ?",
+                (cred_exch_id,),
+            ).fetchone()
+            if row[0] is not None:
+                already_received = True
+            else:
+                already_received = False
+                db.execute(
+                    "UPDATE exchanges SET waiting = 1, deadline = ?"
+                    " WHERE cred_exch_id = ?",
+                    (time.time() + self.ttl, cred_exch_id),
+                )
+            applied = False
+            if thread_id is not None:
+                db.execute(
+                    "UPDATE exchanges SET thread_id = ? WHERE cred_exch_id = ?",
+                    (thread_id, cred_exch_id),
+                )
+                if not already_received:
+                    applied = self._index_thread(db, thread_id, cred_exch_id)
+                else:
+                    db.execute(
+                        "INSERT OR REPLACE INTO threads (thread_id, cred_exch_id)"
+                        " VALUES (?, ?)",
+                        (thread_id, cred_exch_id),
+                    )
+        if already_received:
+            with self._lock:
+                self._waiters.pop(cred_exch_id, None)
+            return None
+        self._start_polling()
+        if applied:
+            waiter.set()
+        return waiter
+
+    def _add_response(self, db, cred_exch_id: str, response_json: str):
+        self._ensure_exchange(db, cred_exch_id)
+        db.execute(
+            "UPDATE exchanges SET response = ? WHERE cred_exch_id = ?",
+            (response_json, cred_exch_id),
+        )
+        self._notify(db, cred_exch_id)
+
+    def add_response(self, cred_exch_id: str, response: dict):
+        with self._transaction() as db:
+            self._add_response(db, cred_exch_id, json.dumps(response))
+        self._set_waiter(cred_exch_id)
+
+    def get_trace_id(self, cred_exch_id: str) -> str:
+        row = self._query_one(
+            "SELECT trace_id FROM exchanges WHERE cred_exch_id = ?", (cred_exch_id,)
+        )
+        return row[0] if row else None
+
+    def pop_response(self, cred_exch_id: str):
+        """Remove an exchange, returning its (response, thread_id)."""
+        with self._lock:
+            self._waiters.pop(cred_exch_id, None)
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT response, thread_id FROM exchanges WHERE cred_exch_id = ?",
+                (cred_exch_id,),
+            ).fetchone()
+            if row is None:
+                return None, None
+            db.execute("DELETE FROM exchanges WHERE cred_exch_id = ?", (cred_exch_id,))
+            if row[1] is not None:
+                db.execute(
+                    "DELETE FROM threads WHERE thread_id = ? AND cred_exch_id = ?",
+                    (row[1], cred_exch_id),
+                )
+        response = json.loads(row[0]) if row[0] is not None else None
+        return response, row[1]
+
+    def discard(self, cred_exch_id: str):
+        self.pop_response(cred_exch_id)
+
+    def is_waiting(self, cred_exch_id: str) -> bool:
+        row = self._query_one(
+            "SELECT waiting FROM exchanges WHERE cred_exch_id = ?", (cred_exch_id,)
+        )
+        return bool(row and row[0])
+
+    def outstanding_ids(self) -> list:
+        """Return the ids of exchanges this process is waiting on."""
+        with self._lock:
+            return [
+                cred_exch_id
+                for cred_exch_id, waiter in self._waiters.items()
+                if not waiter.is_set()
+            ]
+
+    def outstanding_count(self) -> int:
+        return len(self.outstanding_ids())
+
+    def _poll(self):
+        """Wake up the waiters in this process whose responses have arrived."""
+        rows = self._query(
+            "SELECT seq, cred_exch_id FROM notifications WHERE seq > ? ORDER BY seq",
+            (self._last_seq,),
+        )
+        for seq, cred_exch_id in rows:
+            self._last_seq = seq
+            self._set_waiter(cred_exch_id)
+
+    def _run_polling(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self._poll()
+            except Exception:
+                LOGGER.exception("Error polling for credential exchange responses")
+
+    def _start_polling(self):
+        if self._poll_thread:
+            return
+        with self._lock:
+            if self._poll_thread:
+                return
+            self._poll_thread = threading.Thread(
+                target=self._run_polling, name="correlation-poll", daemon=True
+            )
+            self._poll_thread.start()
+
+    def expire(self):
+        """Remove all entries that are past their deadline."""
+        now = time.time()
+        with self._transaction() as db:
+            expired = db.execute(
+                "SELECT cred_exch_id, thread_id, waiting FROM exchanges"
+                " WHERE deadline < ?",
+                (now,),
+            ).fetchall()
+            db.execute("DELETE FROM exchanges WHERE deadline < ?", (now,))
+            early_expired = db.execute(
+                "DELETE FROM early_responses WHERE deadline < ?", (now,)
+            ).rowcount
+            db.execute(
+                "DELETE FROM threads WHERE cred_exch_id NOT IN"
+                " (SELECT cred_exch_id FROM exchanges)"
+            )
+            # notifications only need to outlive the poll interval
+            db.execute(
+                "DELETE FROM notifications WHERE created < ?", (now - self.orphan_ttl,)
+            )
+            evicted = 0
+            excess = (
+                db.execute("SELECT COUNT(*) FROM exchanges").fetchone()[0]
+                - self.max_entries
+            )
+            if excess > 0:
+                evicted = db.execute(
+                    "DELETE FROM exchanges WHERE cred_exch_id IN (SELECT cred_exch_id"
+                    " FROM exchanges WHERE waiting = 0 ORDER BY deadline LIMIT ?)",
+                    (excess,),
+                ).rowcount
+        with self._lock:
+            for cred_exch_id, thread_id, waiting in expired:
+                self._waiters.pop(cred_exch_id, None)
+                if waiting:
+                    self._expired_count = self._expired_count + 1
+                else:
+                    self._orphaned_count = self._orphaned_count + 1
+            self._orphaned_count = self._orphaned_count + early_expired
+            self._evicted_count = self._evicted_count + evicted
+        for cred_exch_id, thread_id, waiting in expired:
+            LOGGER.warning(
+                "Expired %s credential exchange %s (thread %s)",
+                "outstanding" if waiting else "orphaned",
+                cred_exch_id,
+                thread_id,
+            )
+
+    def _run_expiry(self, interval: float):
+        while True:
+            time.sleep(interval)
+            try:
+                self.expire()
+            except Exception:
+                LOGGER.exception("Error expiring credential exchanges")
+
+    def start_expiry(self, interval: float):
+        """Start the background thread that expires stale entries."""
+        with self._lock:
+            if self._expiry_thread:
+                return
+            self._expiry_thread = threading.Thread(
+                target=self._run_expiry,
+                args=(interval,),
+                name="correlation-expiry",
+                daemon=True,
+            )
+            self._expiry_thread.start()
+
+    def stats(self) -> dict:
+        entry_count = self._query_one("SELECT COUNT(*) FROM exchanges")[0]
+        early_response_count = self._query_one(
+            "SELECT COUNT(*) FROM early_responses"
+        )[0]
+        outstanding_count = self.outstanding_count()
+        with self._lock:
+            return {
+                "backend": "sqlite",
+                "entry_count": entry_count,
+                "early_response_count": early_response_count,
+                "max_entries": self.max_entries,
+                "outstanding_count": outstanding_count,
+                "orphaned_count": self._orphaned_count,
+                "expired_count": self._expired_count,
+                "evicted_count": self._evicted_count,
+                "lock_wait": self._lock_wait.to_dict(),
+            }
+
+
+class _Transaction:
+    """An immediate (write-locked) transaction on the process's connection."""
+
+    def __init__(self, table: SqliteCorrelationTable):
+        self._table = table
+        self._db = table._db
+
+    def _begin(self):
+        # the connection lock is held for the whole transaction once it begins,
+        # but is given up between attempts while another process holds the
+        # database's write lock
+        self._table._db_lock.acquire()
+        try:
+            self._db.execute("BEGIN IMMEDIATE")
+        except BaseException:
+            self._table._db_lock.release()
+            raise
+
+    def __enter__(self) -> sqlite3.Connection:
+        start_time = time.perf_counter()
+        self._table._retry_busy(self._begin)
+        self._table._record_lock_wait(time.perf_counter() - start_time)
+        return self._db
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                try:
+                    self._table._retry_busy(lambda: self._db.execute("COMMIT"))
+                except Exception:
+                    self._db.execute("ROLLBACK")
+                    raise
+            else:
+                self._db.execute("ROLLBACK")
+        finally:
+            self._table._db_lock.release()
+        return False
@@ -0,0 +1,114 @@
+"""
+A long-lived, bounded worker pool for credential issuance
+"""
+
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+LOGGER = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when work can't be queued because the submission queue is full."""
+
+
+class IssuanceExecutor:
+    """
+    Run submitted callables on a fixed number of worker threads.
+
+    Work is queued on a bounded queue and each submission returns a
+    `concurrent.futures.Future` for its result.  Worker threads are started
+    on the first submission and are reused for the life of the process.
+    """
+
+    def __init__(self, worker_count: int, queue_size: int, name: str = "issuer"):
+        self.worker_count = max(worker_count, 1)
+        self.queue_size = max(queue_size, 1)
+        self.name = name
+        self._queue = queue.Queue(maxsize=self.queue_size)
+        self._lock = threading.Lock()
+        self._workers = []
+        self._active_workers = 0
+        self._completed_count = 0
+        self._rejected_count = 0
+
+    def _start_workers(self):
+        with self._lock:
+            if self._workers:
+                return
+            for i in range(self.worker_count):
+                worker = threading.Thread(
+                    target=self._run_worker,
+                    name="{}-worker-{}".format(self.name, i),
+                    daemon=True,
+                )
+                worker.start()
+                self._workers.append(worker)
+
+    def _run_worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            future, fn, args, kwargs = item
+            try:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                with self._lock:
+                    self._active_workers = self._active_workers + 1
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as exc:
+                    future.set_exception(exc)
+                finally:
+                    with self._lock:
+                        self._active_workers = self._active_workers - 1
+                        self._completed_count = self._completed_count + 1
+            finally:
+                self._queue.task_done()
+
+    def submit(self, fn, *args, timeout: float = None, **kwargs) -> Future:
+        """
+        Queue `fn(*args, **kwargs)` for execution and return a future for its result.
+
+        Blocks for up to `timeout` seconds (forever if None) while the queue is full,
+        then raises QueueFullError.
+        """
+        if not self._workers:
+            self._start_workers()
+        future = Future()
+        try:
+            self._queue.put((future, fn, args, kwargs), timeout=timeout)
+        except queue.Full:
+            with self._lock:
+                self._rejected_count = self._rejected_count + 1
+            raise QueueFullError(
+                "{} queue is full ({} pending)".format(self.name, self.queue_size)
+            )
+        return future
+
+    def stats(self) -> dict:
+        """Return the current queue and worker gauges."""
+        with self._lock:
+            return {
+                "worker_count": self.worker_count,
+                "active_workers": self._active_workers,
+                "queue_size": self.queue_size,
+                "queue_depth": self._queue.qsize(),
+                "completed_count": self._completed_count,
+                "rejected_count": self._rejected_count,
+            }
+
+    def shutdown(self, wait: bool = True):
+        """Stop the worker threads once the queued work has been processed."""
+        with self._lock:
+            workers = self._workers
+            self._workers = []
+        for _ in workers:
+            self._queue.put(None)
+        if wait:
+            for worker in workers:
+                worker.join()
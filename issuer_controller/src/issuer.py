@@ -1,16 +1,52 @@
+import functools
 import json
 import os
 import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor
+from concurrent.futures import wait as futures_wait
 from datetime import datetime
 import requests
 import logging
 import random
+import tempfile
 
 import requests
-from flask import jsonify
+from flask import Response, jsonify
 
 from src import config
+from src.admin_client import AdminClient
+from src.async_engine import AsyncIssuanceEngine
+from src.correlation import CorrelationTable
+from src.correlation_sqlite import SqliteCorrelationTable
+from src.executor import IssuanceExecutor, QueueFullError
+from src.jobs import JobStore
+from src.limiter import AdaptiveLimiter
+from src.metrics import MethodTimings, MetricsRegistry
+from src.resilience import (
+    CircuitBreaker,
+    RetryPolicy,
+    call_with_retry,
+    call_with_retry_async,
+)
+from src.offers import (
+    PROTOCOL_V10,
+    PROTOCOL_V20,
+    OfferTemplates,
+    UnknownSchemaError,
+)
+from src.startup import PHASE_COMPLETE, StartupPhases
+from src.startup_cache import StartupCache, config_hash
+from src.trace_exporter import TraceExporter
+from src.validation import invalid_credential_response
+from src.webhooks import (
+    WEBHOOK_MODE_INLINE,
+    WEBHOOK_MODE_QUEUED,
+    WEBHOOK_OVERFLOW_REJECT,
+    WebhookDispatcher,
+    WebhookHandler,
+    WebhookQueue,
+)
 
 AGENT_ADMIN_API_KEY = os.environ.get("AGENT_ADMIN_API_KEY")
 ADMIN_REQUEST_HEADERS = {"Content-Type": "application/json"}
@@ -32,6 +68,17 @@ TRACE_TARGET = os.getenv("TRACE_TARGET", TRACE_LOG_TARGET)
 TRACE_MSG_PCT = int(os.getenv("TRACE_MSG_PCT", "0"))
 TRACE_MSG_PCT = max(min(TRACE_MSG_PCT, 100), 0)
 
+# the trace ids of a batch of credentials, one per credential (comma-separated)
+TRACE_IDS_HEADER = "X-Credential-Trace-Ids"
+TRACE_ID_COMMENT_PREFIX = "trace_id:"
+
+# events for an http trace target are sent in the background, in batches of
+# up to TRACE_BATCH_SIZE (as a json list) at least every TRACE_FLUSH_INTERVAL
+# seconds; beyond TRACE_BUFFER_SIZE waiting events the oldest are dropped
+TRACE_BATCH_SIZE = int(os.getenv("TRACE_BATCH_SIZE", "100"))
+TRACE_FLUSH_INTERVAL = float(os.getenv("TRACE_FLUSH_INTERVAL", "1.0"))
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "10000"))
+
 ACK_ERROR_PCT = int(os.getenv("ACK_ERROR_PCT", "0"))
 ACK_ERROR_PCT = max(min(ACK_ERROR_PCT, 100), 0)
 
@@ -53,75 +100,254 @@ synced = {}
 
 MAX_RETRIES = 3
 
+# max 15 second wait for a credential response (prevents blocking forever)
+MAX_CRED_RESPONSE_TIMEOUT = int(os.getenv("MAX_CRED_RESPONSE_TIMEOUT", "120"))
+
+# agent admin api calls that fail with a retryable error (a connection error,
+# timeout or 5xx/429 status) are retried up to MAX_RETRIES times, after an
+# exponential backoff (with jitter) starting at AGENT_RETRY_BASE_DELAY seconds,
+# within a total of AGENT_RETRY_DEADLINE seconds
+AGENT_RETRY_BASE_DELAY = float(os.getenv("AGENT_RETRY_BASE_DELAY", "0.5"))
+AGENT_RETRY_MAX_DELAY = float(os.getenv("AGENT_RETRY_MAX_DELAY", "10"))
+AGENT_RETRY_DEADLINE = float(os.getenv("AGENT_RETRY_DEADLINE", "30"))
+agent_retry_policy = RetryPolicy(
+    max_attempts=MAX_RETRIES + 1,
+    base_delay=AGENT_RETRY_BASE_DELAY,
+    max_delay=AGENT_RETRY_MAX_DELAY,
+    deadline=AGENT_RETRY_DEADLINE,
+)
+
+# after AGENT_BREAKER_THRESHOLD consecutive agent failures (or credential
+# exchange timeouts) credentials are refused with a 503 for
+# AGENT_BREAKER_RESET_TIMEOUT seconds, then a single trial call is let through
+AGENT_BREAKER_THRESHOLD = int(os.getenv("AGENT_BREAKER_THRESHOLD", "5"))
+AGENT_BREAKER_RESET_TIMEOUT = float(os.getenv("AGENT_BREAKER_RESET_TIMEOUT", "30"))
+agent_breaker = CircuitBreaker(
+    AGENT_BREAKER_THRESHOLD,
+    AGENT_BREAKER_RESET_TIMEOUT,
+    name="agent",
+    # a trial credential exchange can take this long to complete (or time out)
+    trial_timeout=AGENT_RETRY_DEADLINE + MAX_CRED_RESPONSE_TIMEOUT,
+)
+
+# if enabled, credential batches are refused with a 429 while the number of
+# exchanges in flight at the agent is at the adaptive limit; the limit grows
+# while exchanges complete within CONCURRENCY_LATENCY_TARGET seconds, and is
+# cut back (by CONCURRENCY_BACKOFF_RATIO) when they are slower or time out.
+# Each batch counts CRED_BATCH_CONCURRENCY exchanges at most, so the default
+# initial limit admits the pipeline's 16 concurrent batches.
+ADAPTIVE_CONCURRENCY = os.getenv("ADAPTIVE_CONCURRENCY", "True").lower() == "true"
+CONCURRENCY_INITIAL_LIMIT = int(os.getenv("CONCURRENCY_INITIAL_LIMIT", "32"))
+CONCURRENCY_MIN_LIMIT = int(os.getenv("CONCURRENCY_MIN_LIMIT", "4"))
+CONCURRENCY_MAX_LIMIT = int(os.getenv("CONCURRENCY_MAX_LIMIT", "512"))
+CONCURRENCY_LATENCY_TARGET = float(os.getenv("CONCURRENCY_LATENCY_TARGET", "10"))
+CONCURRENCY_BACKOFF_RATIO = float(os.getenv("CONCURRENCY_BACKOFF_RATIO", "0.75"))
+concurrency_limiter = AdaptiveLimiter(
+    initial_limit=CONCURRENCY_INITIAL_LIMIT,
+    min_limit=CONCURRENCY_MIN_LIMIT,
+    max_limit=CONCURRENCY_MAX_LIMIT,
+    latency_target=CONCURRENCY_LATENCY_TARGET,
+    backoff_ratio=CONCURRENCY_BACKOFF_RATIO,
+)
+
+# metrics published on /metrics (always collected, unlike the /status timings)
+metrics = MetricsRegistry()
+webhook_duration = metrics.histogram(
+    "issuer_webhook_duration_seconds",
+    "Time taken to handle an agent webhook",
+    ("topic", "state"),
+)
+offer_post_duration = metrics.histogram(
+    "issuer_offer_post_duration_seconds",
+    "Time taken to post a credential offer to the agent",
+)
+exchange_duration = metrics.histogram(
+    "issuer_exchange_duration_seconds",
+    "Time from posting a credential offer to the exchange completing",
+    ("outcome",),
+)
+exchange_timeouts = metrics.counter(
+    "issuer_exchange_timeouts",
+    "Credential exchanges that timed out waiting for the agent",
+)
+problem_reports = metrics.counter(
+    "issuer_problem_reports",
+    "Problem reports received from the agent",
+)
+trace_events_dropped = metrics.counter(
+    "issuer_trace_events_dropped",
+    "Trace events dropped because the trace export buffer was full",
+)
+admin_api_errors = metrics.counter(
+    "issuer_admin_api_errors",
+    "Agent admin API requests that failed or returned an error status",
+    ("method", "status"),
+)
+metrics.gauge(
+    "issuer_agent_circuit_open",
+    "1 while the agent's circuit breaker is refusing credentials, else 0",
+    lambda: 1 if agent_breaker.is_open() else 0,
+)
+metrics.gauge(
+    "issuer_concurrency_limit",
+    "The adaptive limit on credential exchanges in flight",
+    lambda: concurrency_limiter.limit,
+)
+metrics.gauge(
+    "issuer_exchanges_in_flight",
+    "Credential exchanges queued or in progress",
+    lambda: concurrency_limiter.in_flight,
+)
+metrics.gauge(
+    "issuer_outstanding_exchanges",
+    "Credential exchanges waiting for a response from the agent",
+    lambda: correlation_table.outstanding_count(),
+)
+
+# all calls to the agent admin api(s) share a pool of keep-alive connections
+AGENT_ADMIN_POOL_SIZE = int(os.getenv("AGENT_ADMIN_POOL_SIZE", "32"))
+AGENT_ADMIN_CONNECT_TIMEOUT = float(os.getenv("AGENT_ADMIN_CONNECT_TIMEOUT", "5"))
+AGENT_ADMIN_READ_TIMEOUT = float(os.getenv("AGENT_ADMIN_READ_TIMEOUT", "60"))
+admin_client = AdminClient(
+    pool_size=AGENT_ADMIN_POOL_SIZE,
+    connect_timeout=AGENT_ADMIN_CONNECT_TIMEOUT,
+    read_timeout=AGENT_ADMIN_READ_TIMEOUT,
+    error_counter=admin_api_errors,
+)
+
+# max concurrent admin api requests when loading schemas and cred defs at startup
+STARTUP_FETCH_CONCURRENCY = int(os.getenv("STARTUP_FETCH_CONCURRENCY", "8"))
+
+# if set, the schema/cred def ids and TOB connection resolved at startup are
+# saved to this file (relative to CONFIG_ROOT), and served from it on the next
+# start while they are re-validated against the agent
+STARTUP_CACHE_PATH = os.getenv("STARTUP_CACHE_PATH", "")
+
+# max schemas (each with its cred def) registered concurrently at startup
+STARTUP_REGISTRATION_CONCURRENCY = int(
+    os.getenv("STARTUP_REGISTRATION_CONCURRENCY", "4")
+)
+
+# max seconds to wait for a new TOB connection to become active at startup
+CONNECTION_ACTIVE_TIMEOUT = int(os.getenv("CONNECTION_ACTIVE_TIMEOUT", "30"))
+
+# connections that have reached the active state, by connection id (to alias)
+connection_state = threading.Condition()
+active_connections = {}
+
+registration_lock = threading.Lock()
+startup_thread = None
+
+# how long each startup step took, published on /status
+startup_lock = threading.Lock()
+startup_steps = {}
+
+
+def log_startup_step(step, start_time, end_time, success=True):
+    with startup_lock:
+        startup_steps[step] = {
+            "elapsed_time": end_time - start_time,
+            "success": success,
+        }
+
+
+def _agent_call(
+    send, url, description, idempotent=True, breaker=agent_breaker, **kwargs
+):
+    """
+    Make an agent admin api call (`send` is admin_client.get or post), with
+    retries, through the circuit breaker (if any).
+    """
+
+    def call():
+        response = send(url, **kwargs)
+        response.raise_for_status()
+        return response
+
+    try:
+        return call_with_retry(
+            call,
+            agent_retry_policy,
+            breaker,
+            idempotent=idempotent,
+            description=description,
+        )
+    except Exception as e:
+        LOGGER.error("Error calling %s %s %s", description, url, str(e))
+        raise
+
 
 def agent_post_with_retry(url, payload, headers=None):
-    retries = 0
-    while True:
-        try:
-            # test code to test exception handling
-            # if retries < MAX_RETRIES:
-            #    raise Exception("Fake exception!!!")
-            response = requests.post(
-                url,
-                payload,
-                headers=headers,
-            )
-            response.raise_for_status()
-            return response
-        except Exception as e:
-            LOGGER.error("Error posting %s %s", url, str(e))
-            retries = retries + 1
-            if retries > MAX_RETRIES:
-                raise e
-            time.sleep(5)
+    # the agent returns the existing schema or cred def if it's re-registered
+    return _agent_call(
+        admin_client.post, url, "agent POST", data=payload, headers=headers
+    )
+
+
+def agent_get_with_retry(url, headers=ADMIN_REQUEST_HEADERS):
+    return _agent_call(admin_client.get, url, "agent GET", headers=headers)
+
+
+def _agent_get_json(url):
+    return agent_get_with_retry(url).json()
 
 
 def agent_schemas_cred_defs(agent_admin_url):
     ret_schemas = {}
 
     # get loaded cred defs and schemas
-    response = requests.get(
-        agent_admin_url + "/schemas/created",
-        headers=ADMIN_REQUEST_HEADERS,
-    )
-    response.raise_for_status()
-    schemas = response.json()["schema_ids"]
-    for schema_id in schemas:
-        response = requests.get(
-            agent_admin_url + "/schemas/" + schema_id,
-            headers=ADMIN_REQUEST_HEADERS,
-        )
-        response.raise_for_status()
-        schema = response.json()["schema"]
-        if schema:
-            schema_key = schema["name"] + "::" + schema["version"]
-            ret_schemas[schema_key] = {
-                "schema": schema,
-                "schema_id": str(schema["seqNo"]),
-            }
+    schemas = _agent_get_json(agent_admin_url + "/schemas/created")["schema_ids"]
+    cred_defs = _agent_get_json(agent_admin_url + "/credential-definitions/created")[
+        "credential_definition_ids"
+    ]
 
-    response = requests.get(
-        agent_admin_url + "/credential-definitions/created",
-        headers=ADMIN_REQUEST_HEADERS,
-    )
-    response.raise_for_status()
-    cred_defs = response.json()["credential_definition_ids"]
-    for cred_def_id in cred_defs:
-        response = requests.get(
-            agent_admin_url + "/credential-definitions/" + cred_def_id,
-            headers=ADMIN_REQUEST_HEADERS,
-        )
-        response.raise_for_status()
-        cred_def = response.json()["credential_definition"]
-        for schema_key in ret_schemas:
-            if ret_schemas[schema_key]["schema_id"] == cred_def["schemaId"]:
+    # fetch the individual schemas and cred defs concurrently
+    with ThreadPoolExecutor(
+        max_workers=max(STARTUP_FETCH_CONCURRENCY, 1),
+        thread_name_prefix="startup-fetch",
+    ) as executor:
+        schema_futures = [
+            executor.submit(_agent_get_json, agent_admin_url + "/schemas/" + schema_id)
+            for schema_id in schemas
+        ]
+        cred_def_futures = [
+            executor.submit(
+                _agent_get_json,
+                agent_admin_url + "/credential-definitions/" + cred_def_id,
+            )
+            for cred_def_id in cred_defs
+        ]
+
+        for future in schema_futures:
+            schema = future.result()["schema"]
+            if schema:
+                schema_key = schema["name"] + "::" + schema["version"]
+                ret_schemas[schema_key] = {
+                    "schema": schema,
+                    "schema_id": str(schema["seqNo"]),
+                }
+
+        # index by seqNo, which is what a cred def's schemaId refers to
+        schema_keys = {
+            ret_schema["schema_id"]: schema_key
+            for schema_key, ret_schema in ret_schemas.items()
+        }
+        for future in cred_def_futures:
+            cred_def = future.result()["credential_definition"]
+            schema_key = schema_keys.get(cred_def["schemaId"])
+            if schema_key:
                 ret_schemas[schema_key]["cred_def"] = cred_def
-                break
 
     return ret_schemas
 
 
 def register_issuer_with_orgbook(connection_id):
+    # the startup thread and the connections webhook can both get here
+    with registration_lock:
+        _register_issuer_with_orgbook(connection_id)
+
+
+def _register_issuer_with_orgbook(connection_id):
     if connection_id in synced and synced[connection_id]:
         return
 
@@ -182,12 +408,15 @@ def register_issuer_with_orgbook(connection_id):
             },
         }
 
-        response = requests.post(
+        # sends a message to OrgBook, so only retried if the agent refused it
+        response = _agent_call(
+            admin_client.post,
             agent_admin_url + "/issuer_registration/send",
-            json.dumps(issuer_request),
+            "issuer registration",
+            idempotent=False,
+            data=json.dumps(issuer_request),
             headers=ADMIN_REQUEST_HEADERS,
         )
-        response.raise_for_status()
         response.json()
 
     synced[connection_id] = True
@@ -195,116 +424,133 @@ def register_issuer_with_orgbook(connection_id):
 
 
 class StartupProcessingThread(threading.Thread):
+    """
+    Run the startup phases: config parsing, the DID fetch and schema
+    discovery run concurrently, and each later phase starts as soon as the
+    phases it needs have completed.  The phase states are on /readiness and
+    /status.
+    """
+
     global app_config
 
     def __init__(self, ENV):
         threading.Thread.__init__(self)
         self.ENV = ENV
+        self.agent_admin_url = None
+        self.config_schemas = None
+        self.config_services = None
+        self.existing_schemas = None
+        self.startup_cache = None
+        self.cache_key = None
+        self.cached = None
+        self.tob_connection = None
+
+        self.phases = StartupPhases()
+        self.phases.add("config", self.load_config)
+        self.phases.add("did", self.fetch_did)
+        self.phases.add("existing_schemas", self.load_existing_schemas)
+        self.phases.add("startup_cache", self.load_startup_cache, ("config", "did"))
+        self.phases.add(
+            "registration",
+            self.register_schemas,
+            ("existing_schemas", "startup_cache"),
+        )
+        self.phases.add("tob_connection", self.find_tob_connection, ("config",))
+        self.phases.add(
+            "register_issuer",
+            self.register_issuer,
+            ("registration", "tob_connection"),
+        )
 
     def run(self):
+        self.agent_admin_url = self.ENV.get("AGENT_ADMIN_URL")
+        if not self.agent_admin_url:
+            raise RuntimeError(
+                "Error AGENT_ADMIN_URL is not specified, can't connect to Agent."
+            )
+        app_config["AGENT_ADMIN_URL"] = self.agent_admin_url
+
+        if not self.phases.run():
+            LOGGER.error("Startup failed: %s", json.dumps(self.phases.to_dict()))
+
+    def load_config(self):
         # read configuration files
         config_root = self.ENV.get("CONFIG_ROOT", "../config")
-        config_schemas = config.load_config(config_root + "/schemas.yml", env=self.ENV)
-        config_services = config.load_config(
+        self.config_schemas = config.load_config(
+            config_root + "/schemas.yml", env=self.ENV
+        )
+        self.config_services = config.load_config(
             config_root + "/services.yml", env=self.ENV
         )
         app_config["config_root"] = config_root
-        app_config["config_services"] = config_services
-
-        agent_admin_url = self.ENV.get("AGENT_ADMIN_URL")
-        if not agent_admin_url:
-            raise RuntimeError(
-                "Error AGENT_ADMIN_URL is not specified, can't connect to Agent."
-            )
-        app_config["AGENT_ADMIN_URL"] = agent_admin_url
+        app_config["config_services"] = self.config_services
 
+    def fetch_did(self):
         # get public DID from our agent
-        response = requests.get(
-            agent_admin_url + "/wallet/did/public",
-            headers=ADMIN_REQUEST_HEADERS,
-        )
-        result = response.json()
+        result = _agent_get_json(self.agent_admin_url + "/wallet/did/public")
         did = result["result"]
         LOGGER.info("Fetched DID from agent: %s", did)
         app_config["DID"] = did["did"]
 
+    def load_existing_schemas(self):
         # determine pre-registered schemas and cred defs
-        existing_schemas = agent_schemas_cred_defs(agent_admin_url)
-
-        # register schemas and credential definitions
-        for schema in config_schemas:
-            schema_name = schema["name"]
-            schema_version = schema["version"]
-            schema_key = schema_name + "::" + schema_version
-            if schema_key not in existing_schemas:
-                schema_attrs = []
-                schema_descs = {}
-                if isinstance(schema["attributes"], dict):
-                    # each element is a dict
-                    for attr, desc in schema["attributes"].items():
-                        schema_attrs.append(attr)
-                        schema_descs[attr] = desc
-                else:
-                    # assume it's an array
-                    for attr in schema["attributes"]:
-                        schema_attrs.append(attr)
-
-                # register our schema(s) and credential definition(s)
-                schema_request = {
-                    "schema_name": schema_name,
-                    "schema_version": schema_version,
-                    "attributes": schema_attrs,
-                }
-                response = agent_post_with_retry(
-                    agent_admin_url + "/schemas",
-                    json.dumps(schema_request),
-                    headers=ADMIN_REQUEST_HEADERS,
+        self.existing_schemas = agent_schemas_cred_defs(self.agent_admin_url)
+
+    def load_startup_cache(self):
+        # serve from the startup cache (if any) while we re-validate
+        if not STARTUP_CACHE_PATH:
+            return
+        self.cache_key = config_hash(self.config_schemas, self.config_services)
+        self.startup_cache = StartupCache(
+            os.path.join(app_config["config_root"], STARTUP_CACHE_PATH)
+        )
+        self.cached = self.startup_cache.load(app_config["DID"], self.cache_key)
+        if self.cached:
+            apply_startup_snapshot(self.cached)
+
+    def register_schemas(self):
+        # register schemas and credential definitions; each schema and its
+        # cred def are registered in turn, independently of the other schemas
+        config_schemas = self.config_schemas
+        with ThreadPoolExecutor(
+            max_workers=max(STARTUP_REGISTRATION_CONCURRENCY, 1),
+            thread_name_prefix="startup-register",
+        ) as executor:
+            registrations = [
+                executor.submit(
+                    register_schema_cred_def,
+                    self.agent_admin_url,
+                    schema,
+                    self.existing_schemas,
                 )
-                response.raise_for_status()
-                schema_id = response.json()
-            else:
-                schema_id = {"schema_id": existing_schemas[schema_key]["schema"]["id"]}
-            app_config["schemas"]["SCHEMA_" + schema_name] = schema
-            app_config["schemas"][
-                "SCHEMA_" + schema_name + "_" + schema_version
-            ] = schema_id["schema_id"]
-            LOGGER.info("Registered schema: %s", schema_id)
+                for schema in config_schemas
+            ]
+            for schema, future in zip(config_schemas, registrations):
+                schema_id, credential_definition_id = future.result()
+                schema_name = schema["name"]
+                schema_version = schema["version"]
+                app_config["schemas"]["SCHEMA_" + schema_name] = schema
+                app_config["schemas"][
+                    "SCHEMA_" + schema_name + "_" + schema_version
+                ] = schema_id
+                app_config["schemas"][
+                    "CRED_DEF_" + schema_name + "_" + schema_version
+                ] = credential_definition_id
+        offer_templates.clear()
+        for schema in config_schemas:
+            for protocol in (PROTOCOL_V10, PROTOCOL_V20):
+                offer_templates.get(schema["name"], schema["version"], protocol)
 
-            if (
-                schema_key not in existing_schemas
-                or "cred_def" not in existing_schemas[schema_key]
-            ):
-                cred_def_request = {"schema_id": schema_id["schema_id"]}
-                response = agent_post_with_retry(
-                    agent_admin_url + "/credential-definitions",
-                    json.dumps(cred_def_request),
-                    headers=ADMIN_REQUEST_HEADERS,
-                )
-                response.raise_for_status()
-                credential_definition_id = response.json()
-            else:
-                credential_definition_id = {
-                    "credential_definition_id": existing_schemas[schema_key][
-                        "cred_def"
-                    ]["id"]
-                }
-            app_config["schemas"][
-                "CRED_DEF_" + schema_name + "_" + schema_version
-            ] = credential_definition_id["credential_definition_id"]
-            LOGGER.info(
-                "Registered credential definition: %s", credential_definition_id
-            )
+    def find_tob_connection(self):
+        agent_admin_url = self.agent_admin_url
 
         # what is the TOB connection name?
-        tob_connection_params = config_services["verifiers"]["bctob"]
+        tob_connection_params = self.config_services["verifiers"]["bctob"]
 
         # check if we have a TOB connection
-        response = requests.get(
-            agent_admin_url + "/connections?alias=" + tob_connection_params["alias"],
-            headers=ADMIN_REQUEST_HEADERS,
-        )
-        response.raise_for_status()
-        connections = response.json()["results"]
+        connections = _agent_get_json(
+            agent_admin_url + "/connections?alias=" + tob_connection_params["alias"]
+        )["results"]
         tob_connection = None
         for connection in connections:
             # check for TOB connection
@@ -323,34 +569,76 @@ class StartupProcessingThread(threading.Thread):
                 tob_agent_admin_url = tob_connection_params["connection"][
                     "agent_admin_url"
                 ]
-                response = requests.post(
+                # the TOB agent isn't ours, so its failures don't trip our breaker
+                response = _agent_call(
+                    admin_client.post,
                     tob_agent_admin_url + "/out-of-band/create-invitation"
                     + "?auto_accept=true&use_existing_connection=true",
-                    json.dumps({
+                    "TOB create invitation",
+                    idempotent=False,
+                    breaker=None,
+                    data=json.dumps({
                         "handshake_protocols": [
                             "https://didcomm.org/didexchange/1.0"
                         ]
                     }),
                     headers=TOB_REQUEST_HEADERS,
                 )
-                response.raise_for_status()
                 invitation = response.json()
 
-                response = requests.post(
+                response = _agent_call(
+                    admin_client.post,
                     agent_admin_url
                     + "/out-of-band/receive-invitation?alias="
                     + tob_connection_params["alias"]
                     + "&auto_accept=true&use_existing_connection=true",
-                    json.dumps(invitation["invitation"]),
+                    "receive invitation",
+                    idempotent=False,
+                    data=json.dumps(invitation["invitation"]),
                     headers=ADMIN_REQUEST_HEADERS,
                 )
-                response.raise_for_status()
                 tob_connection = response.json()
 
                 LOGGER.info(
                     "Established tob connection: %s", json.dumps(tob_connection)
                 )
-                time.sleep(5)
+                # wait for the connections webhook rather than a fixed sleep
+                if tob_connection.get("state") != "active":
+                    if not wait_for_connection_active(
+                        tob_connection["connection_id"], CONNECTION_ACTIVE_TIMEOUT
+                    ):
+                        LOGGER.warning(
+                            "TOB connection %s not active after %s seconds",
+                            tob_connection["connection_id"],
+                            CONNECTION_ACTIVE_TIMEOUT,
+                        )
+
+        self.tob_connection = tob_connection
+
+    def register_issuer(self):
+        tob_connection = self.tob_connection
+        cached = self.cached
+
+        # the connection may have been accepted (via its webhook) in the meantime
+        if not tob_connection:
+            tob_alias = self.config_services["verifiers"]["bctob"]["alias"]
+            connection_id = active_connection_for_alias(tob_alias)
+            if connection_id:
+                tob_connection = {"connection_id": connection_id}
+
+        # the cached connection is only good if the agent still has it
+        if cached and cached.get("tob_connection"):
+            if (
+                not tob_connection
+                or tob_connection["connection_id"] != cached["tob_connection"]
+            ):
+                LOGGER.warning(
+                    "Cached TOB connection %s is no longer current",
+                    cached["tob_connection"],
+                )
+                synced.pop(cached["tob_connection"], None)
+                if app_config.get("TOB_CONNECTION") == cached["tob_connection"]:
+                    del app_config["TOB_CONNECTION"]
 
         # if we have a connection to the TOB agent, we can register our issuer
         if tob_connection:
@@ -360,6 +648,93 @@ class StartupProcessingThread(threading.Thread):
                 "No TOB connection found or established, awaiting invitation to connect to TOB ..."
             )
 
+        if self.startup_cache and tob_connection_synced():
+            self.startup_cache.save(
+                app_config["DID"],
+                self.cache_key,
+                app_config["schemas"],
+                app_config["TOB_CONNECTION"],
+            )
+
+
+def register_schema_cred_def(agent_admin_url, schema, existing_schemas):
+    """
+    Register a schema and its credential definition with the agent, unless
+    they are already registered.  Returns the (schema id, cred def id).
+    """
+    schema_name = schema["name"]
+    schema_version = schema["version"]
+    schema_key = schema_name + "::" + schema_version
+    if schema_key not in existing_schemas:
+        start_time = time.perf_counter()
+        schema_attrs = []
+        schema_descs = {}
+        if isinstance(schema["attributes"], dict):
+            # each element is a dict
+            for attr, desc in schema["attributes"].items():
+                schema_attrs.append(attr)
+                schema_descs[attr] = desc
+        else:
+            # assume it's an array
+            for attr in schema["attributes"]:
+                schema_attrs.append(attr)
+
+        # register our schema(s) and credential definition(s)
+        schema_request = {
+            "schema_name": schema_name,
+            "schema_version": schema_version,
+            "attributes": schema_attrs,
+        }
+        response = agent_post_with_retry(
+            agent_admin_url + "/schemas",
+            json.dumps(schema_request),
+            headers=ADMIN_REQUEST_HEADERS,
+        )
+        response.raise_for_status()
+        schema_id = response.json()
+        log_startup_step("schema." + schema_key, start_time, time.perf_counter())
+    else:
+        schema_id = {"schema_id": existing_schemas[schema_key]["schema"]["id"]}
+    LOGGER.info("Registered schema: %s", schema_id)
+
+    if (
+        schema_key not in existing_schemas
+        or "cred_def" not in existing_schemas[schema_key]
+    ):
+        start_time = time.perf_counter()
+        cred_def_request = {"schema_id": schema_id["schema_id"]}
+        response = agent_post_with_retry(
+            agent_admin_url + "/credential-definitions",
+            json.dumps(cred_def_request),
+            headers=ADMIN_REQUEST_HEADERS,
+        )
+        response.raise_for_status()
+        credential_definition_id = response.json()
+        log_startup_step("cred_def." + schema_key, start_time, time.perf_counter())
+    else:
+        credential_definition_id = {
+            "credential_definition_id": existing_schemas[schema_key]["cred_def"]["id"]
+        }
+    LOGGER.info("Registered credential definition: %s", credential_definition_id)
+
+    return (
+        schema_id["schema_id"],
+        credential_definition_id["credential_definition_id"],
+    )
+
+
+def apply_startup_snapshot(snapshot):
+    """Use the ids from a startup cache snapshot until they are re-validated."""
+    app_config["schemas"].update(snapshot["schemas"])
+    offer_templates.clear()
+    connection_id = snapshot.get("tob_connection")
+    if connection_id:
+        app_config["TOB_CONNECTION"] = connection_id
+        synced[connection_id] = True
+    LOGGER.info(
+        "Loaded schemas and TOB connection %s from startup cache", connection_id
+    )
+
 
 def tob_connection_synced():
     return (
@@ -376,7 +751,7 @@ def tob_connection_active():
     """
     if not tob_connection_synced():
         return False
-    return 0 < len(list(credential_requests.keys()))
+    return 0 < correlation_table.outstanding_count()
 
 
 def issuer_liveness_check():
@@ -412,88 +787,132 @@ def signal_issuer_shutdown(signum, frame):
     thread = ShutdownProcessingThread()
     thread.start()
     thread.join()
+    if not trace_exporter.flush(timeout=TRACE_FLUSH_INTERVAL + 5):
+        LOGGER.error("... Trace events not sent before shutdown ...")
     LOGGER.error(">>> Shutting down issuer controller process.")
 
 
 def startup_init(ENV):
     global app_config
+    global startup_thread
 
+    correlation_table.start_expiry(CORRELATION_EXPIRY_INTERVAL)
     thread = StartupProcessingThread(ENV)
+    startup_thread = thread
     thread.start()
     return thread
 
 
-credential_lock = threading.Lock()
-credential_requests = {}
-credential_responses = {}
-credential_threads = {}
+def startup_status():
+    """Return the state of each startup phase (and the overall state)."""
+    if not startup_thread:
+        return {"state": PHASE_COMPLETE, "phases": {}}
+    return startup_thread.phases.to_dict()
+
+
+def startup_phase_complete(phase):
+    if not startup_thread:
+        return True
+    return startup_thread.phases.phase_state(phase) == PHASE_COMPLETE
+
+
+def set_connection_active(connection_id, alias=None):
+    with connection_state:
+        active_connections[connection_id] = alias
+        connection_state.notify_all()
+
+
+def wait_for_connection_active(connection_id, timeout):
+    """Wait for the connections webhook to report the connection as active."""
+    with connection_state:
+        return connection_state.wait_for(
+            lambda: connection_id in active_connections, timeout
+        )
+
+
+def active_connection_for_alias(alias):
+    with connection_state:
+        for connection_id, connection_alias in active_connections.items():
+            if connection_alias == alias:
+                return connection_id
+    return None
 
 
-USE_LOCK = os.getenv("USE_LOCK", "True").lower() == "true"
 # need to specify an env variable RECORD_TIMINGS=True to get method timings
 RECORD_TIMINGS = os.getenv("RECORD_TIMINGS", "False").lower() == "true"
 
-timing_lock = threading.Lock()
-timings = {}
+# latency histograms per method, and the data of the most recent failures
+TIMING_SHARDS = int(os.getenv("TIMING_SHARDS", "16"))
+TIMING_FAILURE_SAMPLES = int(os.getenv("TIMING_FAILURE_SAMPLES", "100"))
+TIMING_MAX_METHODS = int(os.getenv("TIMING_MAX_METHODS", "1000"))
+method_timings = MethodTimings(
+    shard_count=TIMING_SHARDS,
+    failure_samples=TIMING_FAILURE_SAMPLES,
+    max_methods=TIMING_MAX_METHODS,
+)
 
 
 def clear_stats():
-    global timings
-    timing_lock.acquire()
-    try:
-        timings = {}
-    finally:
-        timing_lock.release()
+    method_timings.clear()
 
 
 def get_stats():
-    timing_lock.acquire()
-    try:
-        return timings
-    finally:
-        timing_lock.release()
+    stats = method_timings.to_dict()
+    stats["issuance_executor"] = issuance_executor.stats()
+    stats["async_engine"] = async_engine.stats()
+    stats["credential_jobs"] = credential_jobs.stats()
+    stats["job_executor"] = job_executor.stats()
+    stats["correlation"] = correlation_table.stats()
+    stats["webhook_queue"] = dict(webhook_queue.stats(), mode=WEBHOOK_MODE)
+    stats["trace_exporter"] = trace_exporter.stats()
+    stats["agent_circuit"] = agent_breaker.to_dict()
+    stats["concurrency_limiter"] = dict(
+        concurrency_limiter.stats(), enabled=ADAPTIVE_CONCURRENCY
+    )
+    stats["startup"] = startup_status()
+    with startup_lock:
+        stats["startup"]["steps"] = dict(startup_steps)
+    return stats
 
 
 def log_timing_method(method, start_time, end_time, success, data=None):
     if not RECORD_TIMINGS:
         return
 
-    timing_lock.acquire()
-    try:
-        elapsed_time = end_time - start_time
-        if not method in timings:
-            timings[method] = {
-                "total_count": 1,
-                "success_count": 1 if success else 0,
-                "fail_count": 0 if success else 1,
-                "min_time": elapsed_time,
-                "max_time": elapsed_time,
-                "total_time": elapsed_time,
-                "avg_time": elapsed_time,
-                "data": {},
-            }
-        else:
-            timings[method]["total_count"] = timings[method]["total_count"] + 1
-            if success:
-                timings[method]["success_count"] = timings[method]["success_count"] + 1
-            else:
-                timings[method]["fail_count"] = timings[method]["fail_count"] + 1
-            if elapsed_time > timings[method]["max_time"]:
-                timings[method]["max_time"] = elapsed_time
-            if elapsed_time < timings[method]["min_time"]:
-                timings[method]["min_time"] = elapsed_time
-            timings[method]["total_time"] = timings[method]["total_time"] + elapsed_time
-            timings[method]["avg_time"] = (
-                timings[method]["total_time"] / timings[method]["total_count"]
-            )
-        if data:
-            timings[method]["data"][str(timings[method]["total_count"])] = data
-    finally:
-        timing_lock.release()
+    method_timings.record(method, end_time - start_time, success, data)
+
+
+# trace events get their own connection, so they don't hold up admin api calls
+trace_session = requests.Session()
+
+
+def send_trace_events(events):
+    response = trace_session.post(
+        TRACE_TARGET + TRACE_TAG,
+        data=json.dumps(events),
+        headers={"Content-Type": "application/json"},
+        timeout=(AGENT_ADMIN_CONNECT_TIMEOUT, AGENT_ADMIN_READ_TIMEOUT),
+    )
+    response.raise_for_status()
 
 
-def log_timing_event(method, message, start_time, end_time, success, outcome=None):
-    """Record a timing event in the system log or http endpoint."""
+trace_exporter = TraceExporter(
+    send_trace_events,
+    batch_size=TRACE_BATCH_SIZE,
+    flush_interval=TRACE_FLUSH_INTERVAL,
+    buffer_size=TRACE_BUFFER_SIZE,
+    dropped_counter=trace_events_dropped,
+)
+
+
+def log_timing_event(
+    method, message, start_time, end_time, success, outcome=None, trace_id=None
+):
+    """
+    Record a timing event in the system log or http endpoint.
+
+    `trace_id` is the id the credential's submitter gave it, if any.
+    """
 
     if (not TRACE_EVENTS) and (not message.get("trace")):
         return
@@ -521,107 +940,78 @@ def log_timing_event(method, message, start_time, end_time, success, outcome=Non
         "ellapsed_milli": int(1000 * (end_time - start_time)) if end_time else 0,
         "outcome": str_outcome,
     }
-    event_str = json.dumps(event)
+    if trace_id:
+        event["trace_id"] = trace_id
 
-    try:
-        if TRACE_TARGET == TRACE_LOG_TARGET:
-            # write to standard log file
-            LOGGER.error(" %s %s", TRACE_TAG, event_str)
-        else:
-            # should be an http endpoint
-            _ = requests.post(
-                TRACE_TARGET + TRACE_TAG,
-                data=event_str,
-                headers={"Content-Type": "application/json"},
-            )
-    except Exception as e:
-        LOGGER.error(
-            "Error logging trace target: %s tag: %s event: %s",
-            TRACE_TARGET,
-            TRACE_TAG,
-            event_str,
-        )
-        LOGGER.exception(e)
+    if TRACE_TARGET == TRACE_LOG_TARGET:
+        # write to standard log file
+        LOGGER.error(" %s %s", TRACE_TAG, json.dumps(event))
+    else:
+        # should be an http endpoint, sent from the exporter's thread
+        trace_exporter.export(event)
 
 
 def set_credential_thread_id(cred_exch_id, thread_id):
-    start_time = time.perf_counter()
-    if USE_LOCK:
-        credential_lock.acquire()
-    try:
-        # add 2 records so we can x-ref
-        credential_threads[thread_id] = cred_exch_id
-        credential_threads[cred_exch_id] = thread_id
-    finally:
-        if USE_LOCK:
-            credential_lock.release()
-    processing_time = time.perf_counter() - start_time
-    if processing_time > 0.001:
-        LOGGER.warn(">>> lock time = %s", str(processing_time))
+    correlation_table.set_thread_id(cred_exch_id, thread_id)
 
 
-def add_credential_request(cred_exch_id):
-    start_time = time.perf_counter()
-    if USE_LOCK:
-        credential_lock.acquire()
-    try:
-        # short circuit if we already have the response
-        if cred_exch_id in credential_responses:
-            return None
+def add_credential_request(
+    cred_exch_id, result_available=None, thread_id=None, trace_id=None
+):
+    """
+    Register a waiter for a credential exchange; anything with a set() method
+    can be used (a threading.Event by default).  Registering the thread id from
+    the agent's response lets problem reports be routed to the exchange, and
+    the credential's trace id is added to the exchange's webhook trace events.
 
+    Returns None if the response has already been received.
+    """
+    if result_available is None:
         result_available = threading.Event()
-        credential_requests[cred_exch_id] = result_available
-        return result_available
-    finally:
-        if USE_LOCK:
-            credential_lock.release()
-    processing_time = time.perf_counter() - start_time
-    if processing_time > 0.001:
-        LOGGER.warn(">>> lock time = %s", str(processing_time))
+    return correlation_table.add_request(
+        cred_exch_id, result_available, thread_id, trace_id
+    )
+
+
+def get_credential_trace_id(message):
+    """
+    The trace id of the credential exchange a webhook message is about, if it
+    has one (looked up only when the message would be traced).
+    """
+    if not TRACE_TARGET or ((not TRACE_EVENTS) and (not message.get("trace"))):
+        return None
+    cred_exch_id = message.get("credential_exchange_id") or message.get("cred_ex_id")
+    if not cred_exch_id:
+        thread_id = message.get("thread_id") or message.get("~thread", {}).get("thid")
+        if not thread_id:
+            return None
+        cred_exch_id = correlation_table.get_cred_exch_id(thread_id)
+        if not cred_exch_id:
+            return None
+    return correlation_table.get_trace_id(cred_exch_id)
 
 
 def add_credential_response(cred_exch_id, response):
-    start_time = time.perf_counter()
-    if USE_LOCK:
-        credential_lock.acquire()
-    try:
-        credential_responses[cred_exch_id] = response
-        if cred_exch_id in credential_requests:
-            result_available = credential_requests[cred_exch_id]
-            result_available.set()
-            del credential_requests[cred_exch_id]
-    finally:
-        if USE_LOCK:
-            credential_lock.release()
-    processing_time = time.perf_counter() - start_time
-    if processing_time > 0.001:
-        LOGGER.warn(">>> lock time = %s", str(processing_time))
+    correlation_table.add_response(cred_exch_id, response)
 
 
 def add_credential_problem_report(thread_id, response):
-    LOGGER.error(
-        "get problem report for thread %s %s", thread_id, str(len(credential_requests))
-    )
-    if thread_id in credential_threads:
-        cred_exch_id = credential_threads[thread_id]
-        LOGGER.error(" ... cred_exch_id is %s: %s", cred_exch_id, str(response))
-        add_credential_response(cred_exch_id, response)
+    problem_reports.inc()
+    cred_exch_id = correlation_table.add_thread_response(thread_id, response)
+    if cred_exch_id:
+        LOGGER.error(
+            "got problem report for thread %s, cred_exch_id is %s: %s",
+            thread_id,
+            cred_exch_id,
+            str(response),
+        )
     else:
-        LOGGER.error("thread_id not found %s", thread_id)
-        # hack for now
-        if 1 == len(list(credential_requests.keys())):
-            cred_exch_id = list(credential_requests.keys())[0]
-            add_credential_response(cred_exch_id, response)
-        elif 0 == len(list(credential_requests.keys())):
-            LOGGER.error(
-                "NO outstanding requests, can't map problem report to request :-("
-            )
-            LOGGER.error(credential_requests)
-        else:
-            LOGGER.error(
-                "Too many outstanding requests, can't map problem report to request :-("
-            )
-            LOGGER.error(credential_requests)
+        # held until the thread id is registered (or expired if it never is)
+        LOGGER.error(
+            "got problem report for unknown thread %s, holding: %s",
+            thread_id,
+            str(response),
+        )
 
 
 def add_credential_timeout_report(cred_exch_id, thread_id):
@@ -630,37 +1020,20 @@ def add_credential_timeout_report(cred_exch_id, thread_id):
     add_credential_response(cred_exch_id, response)
 
 
-def add_credential_exception_report(cred_exch_id, exc):
-    LOGGER.error("add exception report for cred %s", cred_exch_id)
-    response = {"success": False, "result": cred_exch_id + "::" + str(exc)}
-    add_credential_response(cred_exch_id, response)
+def discard_credential_exchange(cred_exch_id):
+    LOGGER.error("discard credential exchange %s", cred_exch_id)
+    correlation_table.discard(cred_exch_id)
 
 
 def get_credential_response(cred_exch_id):
-    start_time = time.perf_counter()
-    if USE_LOCK:
-        credential_lock.acquire()
-    try:
-        if cred_exch_id in credential_responses:
-            thread_id = None
-            response = credential_responses[cred_exch_id]
-            del credential_responses[cred_exch_id]
-            if cred_exch_id in credential_threads:
-                thread_id = credential_threads[cred_exch_id]
-                del credential_threads[cred_exch_id]
-                del credential_threads[thread_id]
-                # override returned id with thread_id, if we have it (unless we have received a problem report)
-                if not "::" in response["result"]:
-                    response["result"] = thread_id
-            return response
-        else:
-            return None
-    finally:
-        if USE_LOCK:
-            credential_lock.release()
-    processing_time = time.perf_counter() - start_time
-    if processing_time > 0.001:
-        LOGGER.warn(">>> lock time = %s", str(processing_time))
+    response, thread_id = correlation_table.pop_response(cred_exch_id)
+    if response is None:
+        return None
+    # override returned id with thread_id, if we have it (unless we have received a
+    # problem report)
+    if thread_id and not "::" in response["result"]:
+        response["result"] = thread_id
+    return response
 
 
 TOPIC_CONNECTIONS = "connections"
@@ -675,8 +1048,94 @@ TOPIC_PERFORM_MENU_ACTION = "perform-menu-action"
 TOPIC_ISSUER_REGISTRATION = "issuer_registration"
 TOPIC_PROBLEM_REPORT = "problem_report"
 
-# max 15 second wait for a credential response (prevents blocking forever)
-MAX_CRED_RESPONSE_TIMEOUT = int(os.getenv("MAX_CRED_RESPONSE_TIMEOUT", "120"))
+# correlation of outstanding credential exchanges with the agent's webhooks
+# (exchanges nobody is waiting on are kept for CORRELATION_ORPHAN_TTL seconds)
+CORRELATION_MAX_ENTRIES = int(os.getenv("CORRELATION_MAX_ENTRIES", "10000"))
+CORRELATION_ORPHAN_TTL = int(os.getenv("CORRELATION_ORPHAN_TTL", "300"))
+CORRELATION_EXPIRY_INTERVAL = int(os.getenv("CORRELATION_EXPIRY_INTERVAL", "10"))
+# the table is partitioned into shards, each with its own lock
+CORRELATION_SHARDS = int(os.getenv("CORRELATION_SHARDS", "16"))
+# max seconds to hold a problem report that arrives before its thread id is known
+CORRELATION_EARLY_TTL = int(os.getenv("CORRELATION_EARLY_TTL", "60"))
+# "memory" keeps exchanges in this process; "sqlite" shares them between
+# worker processes through a database at CORRELATION_SQLITE_PATH, so a
+# webhook can be handled by any gunicorn worker (each worker still has its
+# own startup thread, agent circuit breaker and concurrency limiter)
+CORRELATION_BACKEND = os.getenv("CORRELATION_BACKEND", "memory").lower()
+CORRELATION_SQLITE_PATH = os.getenv(
+    "CORRELATION_SQLITE_PATH",
+    os.path.join(tempfile.gettempdir(), "issuer-correlation.db"),
+)
+# how often (in seconds) each worker checks for responses added by other workers
+CORRELATION_POLL_INTERVAL = float(os.getenv("CORRELATION_POLL_INTERVAL", "0.05"))
+if CORRELATION_BACKEND == "memory":
+    correlation_table = CorrelationTable(
+        ttl=MAX_CRED_RESPONSE_TIMEOUT + 60,
+        orphan_ttl=CORRELATION_ORPHAN_TTL,
+        max_entries=CORRELATION_MAX_ENTRIES,
+        shard_count=CORRELATION_SHARDS,
+        early_ttl=CORRELATION_EARLY_TTL,
+    )
+elif CORRELATION_BACKEND == "sqlite":
+    correlation_table = SqliteCorrelationTable(
+        CORRELATION_SQLITE_PATH,
+        ttl=MAX_CRED_RESPONSE_TIMEOUT + 60,
+        orphan_ttl=CORRELATION_ORPHAN_TTL,
+        max_entries=CORRELATION_MAX_ENTRIES,
+        early_ttl=CORRELATION_EARLY_TTL,
+        poll_interval=CORRELATION_POLL_INTERVAL,
+    )
+else:
+    raise Exception("Invalid CORRELATION_BACKEND: " + CORRELATION_BACKEND)
+
+# credential offer templates, compiled from the registered schemas on first use
+offer_templates = OfferTemplates(lambda: (app_config["schemas"], app_config["DID"]))
+
+CRED_OFFER_PATH = "/issue-credential/send"
+CRED_OFFER_PATH_V20 = "/issue-credential-2.0/send"
+
+# clients can ask for a batch's responses to be streamed back as they complete
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# max number of credential offers from a single batch that are in flight at once
+# (the default of 1 sends the offers in a batch one after another)
+CRED_BATCH_CONCURRENCY = max(int(os.getenv("CRED_BATCH_CONCURRENCY", "1")), 1)
+
+# shared pool of workers that post credential offers and wait for the agent's response
+ISSUANCE_WORKERS = int(os.getenv("ISSUANCE_WORKERS", "16"))
+ISSUANCE_QUEUE_SIZE = int(os.getenv("ISSUANCE_QUEUE_SIZE", "1000"))
+# max seconds to wait for space on the issuance queue before failing a credential
+ISSUANCE_SUBMIT_TIMEOUT = int(os.getenv("ISSUANCE_SUBMIT_TIMEOUT", "10"))
+issuance_executor = IssuanceExecutor(
+    ISSUANCE_WORKERS, ISSUANCE_QUEUE_SIZE, name="issuance"
+)
+
+# "threaded" runs each exchange on an issuance_executor worker, "asyncio" runs
+# each exchange as a coroutine on a single event loop
+ISSUANCE_ENGINE_THREADED = "threaded"
+ISSUANCE_ENGINE_ASYNCIO = "asyncio"
+ISSUANCE_ENGINE = os.getenv("ISSUANCE_ENGINE", ISSUANCE_ENGINE_THREADED).lower()
+if ISSUANCE_ENGINE not in [ISSUANCE_ENGINE_THREADED, ISSUANCE_ENGINE_ASYNCIO]:
+    raise Exception(f"Unsupported issuance engine: {ISSUANCE_ENGINE}")
+# max number of exchanges in flight on the asyncio engine
+ASYNC_MAX_IN_FLIGHT = int(os.getenv("ASYNC_MAX_IN_FLIGHT", "1000"))
+async_engine = AsyncIssuanceEngine(
+    ASYNC_MAX_IN_FLIGHT,
+    pool_size=AGENT_ADMIN_POOL_SIZE,
+    connect_timeout=AGENT_ADMIN_CONNECT_TIMEOUT,
+    read_timeout=AGENT_ADMIN_READ_TIMEOUT,
+)
+
+# results of batches submitted as background jobs, kept for JOB_TTL seconds
+# after they complete
+JOB_STORE_SIZE = int(os.getenv("JOB_STORE_SIZE", "1000"))
+JOB_TTL = int(os.getenv("JOB_TTL", "3600"))
+credential_jobs = JobStore(JOB_STORE_SIZE, JOB_TTL)
+# background jobs are run JOB_RUNNERS at a time, each sending its offers
+# CRED_BATCH_CONCURRENCY at a time; up to JOB_QUEUE_SIZE more jobs can wait
+JOB_RUNNERS = int(os.getenv("JOB_RUNNERS", "4"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+job_executor = IssuanceExecutor(JOB_RUNNERS, JOB_QUEUE_SIZE, name="jobs")
 
 
 def handle_connections(state, message):
@@ -685,9 +1144,13 @@ def handle_connections(state, message):
     config_services = app_config["config_services"]
     tob_connection_params = config_services["verifiers"]["bctob"]
 
+    if state == "active":
+        set_connection_active(message["connection_id"], message.get("alias"))
+
     # check this is the TOB connection
     if "alias" in message and message["alias"] == tob_connection_params["alias"]:
-        if state == "active":
+        # during startup, the issuer is registered once our schemas are
+        if state == "active" and startup_phase_complete("registration"):
             register_issuer_with_orgbook(message["connection_id"])
 
     return jsonify({"message": state})
@@ -696,7 +1159,8 @@ def handle_connections(state, message):
 def handle_credentials(state, message):
     start_time = time.perf_counter()
     method = "Handle callback:" + state
-    log_timing_event(method, message, start_time, None, False)
+    trace_id = get_credential_trace_id(message)
+    log_timing_event(method, message, start_time, None, False, trace_id=trace_id)
 
     if "thread_id" in message:
         set_credential_thread_id(
@@ -716,7 +1180,15 @@ def handle_credentials(state, message):
 
     end_time = time.perf_counter()
     processing_time = end_time - start_time
-    log_timing_event(method, message, start_time, end_time, True, outcome=str(state))
+    log_timing_event(
+        method,
+        message,
+        start_time,
+        end_time,
+        True,
+        outcome=str(state),
+        trace_id=trace_id,
+    )
 
     return jsonify({"message": state})
 
@@ -724,7 +1196,8 @@ def handle_credentials(state, message):
 def handle_credentials_v20(state, message):
     start_time = time.perf_counter()
     method = "Handle callback:" + state
-    log_timing_event(method, message, start_time, None, False)
+    trace_id = get_credential_trace_id(message)
+    log_timing_event(method, message, start_time, None, False, trace_id=trace_id)
 
     if "thread_id" in message:
         set_credential_thread_id(
@@ -742,7 +1215,15 @@ def handle_credentials_v20(state, message):
 
     end_time = time.perf_counter()
     processing_time = end_time - start_time
-    log_timing_event(method, message, start_time, end_time, True, outcome=str(state))
+    log_timing_event(
+        method,
+        message,
+        start_time,
+        end_time,
+        True,
+        outcome=str(state),
+        trace_id=trace_id,
+    )
 
     return jsonify({"message": "state"})
 
@@ -782,113 +1263,558 @@ def handle_problem_report(message):
     return jsonify({})
 
 
-class SendCredentialThread(threading.Thread):
-    def __init__(self, credential_definition_id, cred_offer, url, headers):
-        threading.Thread.__init__(self)
-        self.credential_definition_id = credential_definition_id
-        self.cred_offer = cred_offer
-        self.url = url
-        self.headers = headers
+# webhook handlers by topic; topics (and states) we don't act on are ignored
+# without any timing or tracing
+webhook_dispatcher = WebhookDispatcher()
+webhook_dispatcher.register(
+    TOPIC_CONNECTIONS,
+    WebhookHandler(handle_connections, by_state=True, states={"active"}),
+)
+webhook_dispatcher.register(
+    TOPIC_CREDENTIALS,
+    WebhookHandler(
+        handle_credentials, by_state=True, required=("credential_exchange_id",)
+    ),
+)
+webhook_dispatcher.register(
+    [TOPIC_CREDENTIALS_V20, TOPIC_CREDENTIALS_V20_INDY],
+    WebhookHandler(handle_credentials_v20, by_state=True, required=("cred_ex_id",)),
+)
+webhook_dispatcher.register(
+    TOPIC_PROBLEM_REPORT,
+    WebhookHandler(handle_problem_report, required=("~thread", "explain-ltxt")),
+)
+webhook_dispatcher.ignore(
+    [
+        TOPIC_PRESENTATIONS,
+        TOPIC_PRESENTATIONS_V20,
+        TOPIC_GET_ACTIVE_MENU,
+        TOPIC_PERFORM_MENU_ACTION,
+        TOPIC_ISSUER_REGISTRATION,
+    ]
+)
+
+# "inline" applies webhooks in the request handler; "queued" acknowledges
+# them as soon as they are on a bounded queue, and applies them on a pool of
+# consumer threads.  WEBHOOK_OVERFLOW ("reject", "drop" or "inline") decides
+# what happens to webhooks that arrive while the queue is full.
+WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", WEBHOOK_MODE_INLINE).lower()
+if WEBHOOK_MODE not in (WEBHOOK_MODE_INLINE, WEBHOOK_MODE_QUEUED):
+    raise Exception("Invalid WEBHOOK_MODE: " + WEBHOOK_MODE)
+WEBHOOK_CONSUMERS = int(os.getenv("WEBHOOK_CONSUMERS", "4"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "10000"))
+WEBHOOK_OVERFLOW = os.getenv("WEBHOOK_OVERFLOW", WEBHOOK_OVERFLOW_REJECT).lower()
+webhook_queue = WebhookQueue(WEBHOOK_CONSUMERS, WEBHOOK_QUEUE_SIZE, WEBHOOK_OVERFLOW)
+
+
+def _credential_exchange_id(cred_data):
+    if "credential_exchange_id" in cred_data:
+        return cred_data["credential_exchange_id"]
+    elif "cred_ex_id" in cred_data:
+        return cred_data["cred_ex_id"]
+    raise Exception(json.dumps(cred_data))
+
+
+def _log_credential_timeout(method, start_time, cred_data, credential_exchange_id):
+    exchange_timeouts.inc()
+    # the agent accepted the offer but never completed the exchange
+    agent_breaker.record_failure()
+    add_credential_timeout_report(credential_exchange_id, cred_data["thread_id"])
+    LOGGER.error(
+        "Got credential TIMEOUT: %s %s %s",
+        cred_data["thread_id"],
+        credential_exchange_id,
+        cred_data["connection_id"],
+    )
+    end_time = time.perf_counter()
+    log_timing_method(
+        method,
+        start_time,
+        end_time,
+        False,
+        data={
+            "thread_id": cred_data["thread_id"],
+            "credential_exchange_id": credential_exchange_id,
+            "Error": "Timeout",
+            "elapsed_time": (end_time - start_time),
+        },
+    )
+    return end_time
 
-    def run(self):
-        start_time = time.perf_counter()
-        method = "submit_credential.credential"
 
-        log_timing_event("issue_credential", {}, start_time, None, False)
-        LOGGER.info("Sending credential offer: %s", json.dumps(self.cred_offer))
+def _log_credential_exception(
+    method, start_time, exc, cred_data, credential_exchange_id
+):
+    LOGGER.error("got credential exception: %s", str(exc))
+    # if cred_data is not set we don't have a credential to set status for
+    end_time = time.perf_counter()
+    if cred_data and credential_exchange_id:
+        discard_credential_exchange(credential_exchange_id)
+        data = {
+            "thread_id": cred_data.get("thread_id"),
+            "credential_exchange_id": credential_exchange_id,
+            "Error": str(exc),
+            "elapsed_time": (end_time - start_time),
+        }
+    else:
+        data = {"Error": str(exc), "elapsed_time": (end_time - start_time)}
+    log_timing_method(method, start_time, end_time, False, data=data)
+    return end_time
+
+
+def _exchange_outcome(outcome, cred_response):
+    """The outcome label of an exchange: success, failure, timeout or error."""
+    if outcome == "timeout":
+        return "timeout"
+    if outcome != "success":
+        return "error"
+    # a problem report completes the exchange with an unsuccessful response
+    return "success" if cred_response and cred_response.get("success") else "failure"
 
-        cred_data = None
+
+def _timed_offer_post(url, data=None, headers=None):
+    post_start = time.perf_counter()
+    try:
+        return admin_client.post(url, data, headers=headers)
+    finally:
+        offer_post_duration.observe(time.perf_counter() - post_start)
+
+
+def _record_exchange(start_time, end_time, outcome, cred_response):
+    exchange_outcome = _exchange_outcome(outcome, cred_response)
+    exchange_duration.observe(end_time - start_time, exchange_outcome)
+    # errors (e.g. a rejected offer) say nothing about the agent's load
+    if exchange_outcome != "error":
+        concurrency_limiter.record(
+            start_time, end_time - start_time, timed_out=exchange_outcome == "timeout"
+        )
+
+
+def send_credential(credential_definition_id, cred_offer, url, headers, trace_id=None):
+    """
+    Post a credential offer to the agent and wait for the exchange to complete.
+
+    Returns the credential response, i.e. {"success": ..., "result": ...}, with
+    the credential's `trace_id` (if it has one).
+    """
+    start_time = time.perf_counter()
+    method = "submit_credential.credential"
+
+    log_timing_event("issue_credential", {}, start_time, None, False, trace_id=trace_id)
+    LOGGER.info("Sending credential offer: %s", json.dumps(cred_offer))
+
+    cred_data = None
+    credential_exchange_id = None
+    try:
+        # the breaker records the outcome of the exchange, not just the post
+        agent_breaker.allow()
         try:
-            response = requests.post(
-                self.url, json.dumps(self.cred_offer), headers=self.headers
+            response = _agent_call(
+                _timed_offer_post,
+                url,
+                "credential offer",
+                idempotent=False,
+                breaker=None,
+                data=json.dumps(cred_offer),
+                headers=headers,
             )
-            response.raise_for_status()
-            cred_data = response.json()
-            credential_exchange_id = None
-            if "credential_exchange_id" in cred_data:
-                credential_exchange_id = cred_data["credential_exchange_id"]
-                result_available = add_credential_request(
-                    cred_data["credential_exchange_id"]
-                )
-            elif "cred_ex_id" in cred_data:
-                credential_exchange_id = cred_data["cred_ex_id"]
-                result_available = add_credential_request(
-                    cred_data["cred_ex_id"]
-                )
-            else:
-                raise Exception(json.dumps(cred_data))
+        except Exception as exc:
+            agent_breaker.record(exc)
+            raise
+        cred_data = response.json()
+        credential_exchange_id = _credential_exchange_id(cred_data)
+        result_available = add_credential_request(
+            credential_exchange_id,
+            thread_id=cred_data.get("thread_id"),
+            trace_id=trace_id,
+        )
 
-            # wait for confirmation from the agent, which will include the credential exchange id
-            if result_available and not result_available.wait(
-                MAX_CRED_RESPONSE_TIMEOUT
-            ):
-                add_credential_timeout_report(
-                    credential_exchange_id, cred_data["thread_id"]
-                )
-                LOGGER.error(
-                    "Got credential TIMEOUT: %s %s %s",
-                    cred_data["thread_id"],
-                    credential_exchange_id,
-                    cred_data["connection_id"],
-                )
-                end_time = time.perf_counter()
-                log_timing_method(
-                    method,
-                    start_time,
-                    end_time,
-                    False,
-                    data={
-                        "thread_id": cred_data["thread_id"],
-                        "credential_exchange_id": credential_exchange_id,
-                        "Error": "Timeout",
-                        "elapsed_time": (end_time - start_time),
-                    },
-                )
-                success = False
-                outcome = "timeout"
-            else:
-                # response was received for this cred exchange via a web hook
-                end_time = time.perf_counter()
-                log_timing_method(method, start_time, end_time, True)
-                success = True
-                outcome = "success"
-
-            # there should be some form of response available
-            self.cred_response = get_credential_response(
-                credential_exchange_id
+        # wait for confirmation from the agent, which will include the credential
+        # exchange id
+        if result_available and not result_available.wait(MAX_CRED_RESPONSE_TIMEOUT):
+            end_time = _log_credential_timeout(
+                method, start_time, cred_data, credential_exchange_id
             )
+            success = False
+            outcome = "timeout"
+        else:
+            # response was received for this cred exchange via a web hook
+            agent_breaker.record_success()
+            end_time = time.perf_counter()
+            log_timing_method(method, start_time, end_time, True)
+            success = True
+            outcome = "success"
+
+        # there should be some form of response available
+        cred_response = get_credential_response(credential_exchange_id)
+
+    except Exception as exc:
+        end_time = _log_credential_exception(
+            method, start_time, exc, cred_data, credential_exchange_id
+        )
+        success = False
+        outcome = str(exc)
+        # don't re-raise; we want to log the exception as the credential error response
+        cred_response = {"success": False, "result": str(exc)}
+
+    _record_exchange(start_time, end_time, outcome, cred_response)
+    message = {"thread_id": cred_response["result"]}
+    log_timing_event(
+        "issue_credential",
+        message,
+        start_time,
+        end_time,
+        success,
+        outcome=outcome,
+        trace_id=trace_id,
+    )
+    if trace_id:
+        cred_response["trace_id"] = trace_id
+    return cred_response
+
+
+async def _post_offer_async(url, data, headers):
+    # not sent through admin_client, so count admin api errors here
+    post_start = time.perf_counter()
+    status = None
+    try:
+        async with async_engine.session.post(
+            url, data=data, headers=headers
+        ) as response:
+            status = response.status
+            response.raise_for_status()
+            return await response.json()
+    finally:
+        offer_post_duration.observe(time.perf_counter() - post_start)
+        if status is None:
+            admin_api_errors.inc("POST", "error")
+        elif status >= 400:
+            admin_api_errors.inc("POST", str(status))
+
 
+async def send_credential_async(
+    credential_definition_id, cred_offer, url, headers, trace_id=None
+):
+    """
+    Coroutine equivalent of send_credential(), run on the asyncio issuance engine.
+    """
+    start_time = time.perf_counter()
+    method = "submit_credential.credential"
+
+    log_timing_event("issue_credential", {}, start_time, None, False, trace_id=trace_id)
+    LOGGER.info("Sending credential offer: %s", json.dumps(cred_offer))
+
+    cred_data = None
+    credential_exchange_id = None
+    try:
+        # the breaker records the outcome of the exchange, not just the post
+        agent_breaker.allow()
+        try:
+            cred_data = await call_with_retry_async(
+                functools.partial(
+                    _post_offer_async, url, json.dumps(cred_offer), headers
+                ),
+                agent_retry_policy,
+                idempotent=False,
+                description="credential offer",
+            )
         except Exception as exc:
-            LOGGER.error("got credential exception: %s", str(exc))
-            # if cred_data is not set we don't have a credential to set status for
-            end_time = time.perf_counter()
+            agent_breaker.record(exc)
+            raise
+        credential_exchange_id = _credential_exchange_id(cred_data)
+        result_available = add_credential_request(
+            credential_exchange_id,
+            async_engine.create_waiter(),
+            thread_id=cred_data.get("thread_id"),
+            trace_id=trace_id,
+        )
+
+        # the webhook handler resolves the waiter from the Flask side
+        if result_available and not await result_available.wait(
+            MAX_CRED_RESPONSE_TIMEOUT
+        ):
+            end_time = _log_credential_timeout(
+                method, start_time, cred_data, credential_exchange_id
+            )
             success = False
-            outcome = str(exc)
-            if cred_data:
-                add_credential_exception_report(
-                    credential_exchange_id, exc
-                )
-                data = {
-                    "thread_id": cred_data["thread_id"],
-                    "credential_exchange_id": credential_exchange_id,
-                    "Error": str(exc),
-                    "elapsed_time": (end_time - start_time),
-                }
-            else:
-                data = {"Error": str(exc), "elapsed_time": (end_time - start_time)}
-            log_timing_method(method, start_time, end_time, False, data=data)
+            outcome = "timeout"
+        else:
+            agent_breaker.record_success()
+            end_time = time.perf_counter()
+            log_timing_method(method, start_time, end_time, True)
+            success = True
+            outcome = "success"
 
-            # don't re-raise; we want to log the exception as the credential error response
-            self.cred_response = {"success": False, "result": str(exc)}
+        cred_response = get_credential_response(credential_exchange_id)
 
-        processing_time = end_time - start_time
-        message = {"thread_id": self.cred_response["result"]}
-        log_timing_event(
-            "issue_credential", message, start_time, end_time, success, outcome=outcome
+    except Exception as exc:
+        end_time = _log_credential_exception(
+            method, start_time, exc, cred_data, credential_exchange_id
         )
+        success = False
+        outcome = str(exc)
+        cred_response = {"success": False, "result": str(exc)}
+
+    _record_exchange(start_time, end_time, outcome, cred_response)
+    message = {"thread_id": cred_response["result"]}
+    log_timing_event(
+        "issue_credential",
+        message,
+        start_time,
+        end_time,
+        success,
+        outcome=outcome,
+        trace_id=trace_id,
+    )
+    if trace_id:
+        cred_response["trace_id"] = trace_id
+    return cred_response
+
+
+def reserve_exchanges(count):
+    """
+    Reserve concurrency slots for a batch of `count` credential exchanges:
+    one for each exchange the batch will have in flight at the agent, i.e.
+    at most CRED_BATCH_CONCURRENCY (offers waiting their turn don't count).
+
+    Returns a LimiterPermit, or None if ADAPTIVE_CONCURRENCY is enabled and
+    the exchanges don't fit under the current limit.
+    """
+    count = min(count, CRED_BATCH_CONCURRENCY)
+    if ADAPTIVE_CONCURRENCY:
+        return concurrency_limiter.try_acquire(count)
+    return concurrency_limiter.acquire(count)
+
+
+def submit_credential(
+    credential_definition_id, cred_offer, url, trace_id=None, permit=None
+):
+    """
+    Queue a credential offer on the configured issuance engine.
 
+    If `permit` is given, the exchange runs in one of the slots its batch has
+    reserved; otherwise a slot is acquired for it and released when the
+    exchange completes.
 
-def handle_send_credential(cred_input):
+    Returns a future that resolves to the credential response.
+    """
+    if permit is not None:
+        return _submit_credential(credential_definition_id, cred_offer, url, trace_id)
+    permit = concurrency_limiter.acquire()
+    try:
+        future = _submit_credential(credential_definition_id, cred_offer, url, trace_id)
+    except Exception:
+        permit.release()
+        raise
+    future.add_done_callback(lambda _: permit.release())
+    return future
+
+
+def _submit_credential(credential_definition_id, cred_offer, url, trace_id):
+    if ISSUANCE_ENGINE == ISSUANCE_ENGINE_ASYNCIO:
+        return async_engine.submit(
+            send_credential_async(
+                credential_definition_id,
+                cred_offer,
+                url,
+                ADMIN_REQUEST_HEADERS,
+                trace_id,
+            )
+        )
+
+    try:
+        return issuance_executor.submit(
+            send_credential,
+            credential_definition_id,
+            cred_offer,
+            url,
+            ADMIN_REQUEST_HEADERS,
+            trace_id,
+            timeout=ISSUANCE_SUBMIT_TIMEOUT,
+        )
+    except QueueFullError as exc:
+        LOGGER.error("Can't queue credential offer: %s", str(exc))
+        cred_response = {"success": False, "result": str(exc)}
+        if trace_id:
+            cred_response["trace_id"] = trace_id
+        future = Future()
+        future.set_result(cred_response)
+        return future
+
+
+def _trace_id(trace_ids, index):
+    return trace_ids[index] if trace_ids else None
+
+
+def iter_credential_batch(cred_offers, url, trace_ids=None, permit=None):
+    """
+    Send a batch of credential offers to the agent, yielding (index, response)
+    for each offer as soon as its exchange completes.
+
+    Up to CRED_BATCH_CONCURRENCY offers are in flight at once.  None offers
+    (invalid credentials) are skipped.  `trace_ids`, if given, holds the trace
+    id of each offer.  `permit`, if given, holds the batch's concurrency
+    slots (see reserve_exchanges()); slots are released as soon as fewer
+    offers are left to complete, and all of them when the iteration ends.
+    """
+    pending = {}
+    unfinished = sum(1 for offer in cred_offers if offer is not None)
+
+    def release_unneeded():
+        if permit is not None:
+            needed = min(unfinished, CRED_BATCH_CONCURRENCY)
+            permit.release(permit.remaining - needed)
+
+    try:
+        release_unneeded()
+        for index, offer in enumerate(cred_offers):
+            if offer is None:
+                continue
+            credential_definition_id, cred_offer = offer
+            # wait for an offer to complete if we are at the concurrency limit
+            while len(pending) >= CRED_BATCH_CONCURRENCY:
+                done, _ = futures_wait(pending, return_when=FIRST_COMPLETED)
+                for done_future in done:
+                    unfinished = unfinished - 1
+                    release_unneeded()
+                    yield pending.pop(done_future), done_future.result()
+            future = submit_credential(
+                credential_definition_id,
+                cred_offer,
+                url,
+                _trace_id(trace_ids, index),
+                permit,
+            )
+            pending[future] = index
+
+        while pending:
+            done, _ = futures_wait(pending, return_when=FIRST_COMPLETED)
+            for done_future in done:
+                unfinished = unfinished - 1
+                release_unneeded()
+                yield pending.pop(done_future), done_future.result()
+    finally:
+        if permit is not None:
+            permit.release_all()
+
+
+def send_credential_batch(cred_offers, url, trace_ids=None, permit=None):
+    """
+    Send a batch of credential offers to the agent and wait for all of them to complete.
+
+    Responses are returned in the same order as the offers were supplied.
+    """
+    cred_responses = [None] * len(cred_offers)
+    for index, cred_response in iter_credential_batch(
+        cred_offers, url, trace_ids, permit
+    ):
+        cred_responses[index] = cred_response
+    return cred_responses
+
+
+def _build_cred_offers(cred_input, protocol, trace_ids=None):
+    cred_offers = []
+    failures = {}
+    connection_id = app_config["TOB_CONNECTION"]
+    for index, credential in enumerate(cred_input):
+        try:
+            template = offer_templates.get(
+                credential["schema"], credential["version"], protocol
+            )
+            attributes = credential["attributes"]
+        except (KeyError, TypeError):
+            failures[index] = invalid_credential_response(
+                ["schema, version and attributes are required"]
+            )
+            cred_offers.append(None)
+            continue
+        except UnknownSchemaError as e:
+            failures[index] = invalid_credential_response([str(e)])
+            cred_offers.append(None)
+            continue
+        if template.validator:
+            item_errors = template.validator.validate(attributes)
+            if item_errors:
+                failures[index] = invalid_credential_response(item_errors)
+                cred_offers.append(None)
+                continue
+        cred_offer = template.build(attributes, connection_id)
+        trace_id = _trace_id(trace_ids, index)
+        if trace_id:
+            # the offer's comment carries the trace id to the agent (and holder)
+            cred_offer["comment"] = TRACE_ID_COMMENT_PREFIX + trace_id
+        do_trace = random.randint(1, 100)
+        if do_trace <= TRACE_MSG_PCT:
+            cred_offer["trace"] = True
+        cred_offers.append((template.cred_def_id, cred_offer))
+    return cred_offers, failures
+
+
+def build_cred_offers(cred_input, trace_ids=None):
+    """
+    Build the (credential definition id, issue-credential 1.0 offer) pairs for a batch.
+
+    Returns the offers, one per credential (None for an invalid credential),
+    and a dict of the failure response for each invalid credential's index:
+    one whose schema/version isn't registered or whose attributes don't match
+    the schema.
+    """
+    return _build_cred_offers(cred_input, PROTOCOL_V10, trace_ids)
+
+
+def build_cred_offers_v20(cred_input, trace_ids=None):
+    """
+    Build the (credential definition id, issue-credential 2.0 offer) pairs for a batch.
+
+    Returns the offers and failures as build_cred_offers() does.
+    """
+    return _build_cred_offers(cred_input, PROTOCOL_V20, trace_ids)
+
+
+def _send_credentials(cred_offers, url, trace_ids=None, permit=None, failures=None):
+    start_time = time.perf_counter()
+
+    # let's send a credential!
+    cred_responses = send_credential_batch(cred_offers, url, trace_ids, permit)
+    for index, failure in (failures or {}).items():
+        cred_responses[index] = failure
+    processed_count = len(cred_responses)
+
+    processing_time = time.perf_counter() - start_time
+    print(">>> Processed", processed_count, "credentials in", processing_time)
+    print("   ", processing_time / processed_count, "seconds per credential")
+
+    return jsonify(cred_responses)
+
+
+def _stream_credentials(cred_offers, url, trace_ids=None, permit=None, failures=None):
+    """
+    Send a batch of credentials and stream the responses back as NDJSON, one line per
+    credential in completion order (invalid credentials first).  Each line includes
+    the credential's "index" in the submitted batch.
+    """
+
+    def generate():
+        for index, failure in sorted((failures or {}).items()):
+            line = {"index": index}
+            line.update(failure)
+            yield json.dumps(line) + "\n"
+        for index, cred_response in iter_credential_batch(
+            cred_offers, url, trace_ids, permit
+        ):
+            line = {"index": index}
+            line.update(cred_response)
+            yield json.dumps(line) + "\n"
+
+    response = Response(generate(), mimetype=NDJSON_MIMETYPE)
+    if permit is not None:
+        # the body may never be iterated (client gone before the first chunk),
+        # in which case the generator's cleanup never runs
+        response.call_on_close(permit.release_all)
+    return response
+
+
+def handle_send_credential(cred_input, stream=False, trace_ids=None, permit=None):
     """
     # other sample data
     sample_credentials = [
@@ -925,67 +1851,19 @@ def handle_send_credential(cred_input):
     """
     # construct and send the credential
     # print("Received credentials", cred_input)
-    global app_config
-
     agent_admin_url = app_config["AGENT_ADMIN_URL"]
-
-    start_time = time.perf_counter()
-    processing_time = 0
-    processed_count = 0
-
-    # let's send a credential!
-    cred_responses = []
-    for credential in cred_input:
-        cred_def_key = "CRED_DEF_" + credential["schema"] + "_" + credential["version"]
-        credential_definition_id = app_config["schemas"][cred_def_key]
-
-        credential_attributes = []
-        for attribute in credential["attributes"]:
-            credential_attributes.append(
-                {
-                    "name": attribute,
-                    "mime-type": "text/plain",
-                    "value": credential["attributes"][attribute],
-                }
-            )
-        cred_offer = {
-            "schema_id": app_config["schemas"][
-                "SCHEMA_" + credential["schema"] + "_" + credential["version"]
-            ],
-            "schema_name": credential["schema"],
-            "issuer_did": app_config["DID"],
-            "schema_version": credential["version"],
-            "credential_proposal": {
-                "@type": "did:sov:BzCbsNYhMrjHiqZDTUASHg;spec/issue-credential/1.0/credential-preview",
-                "attributes": credential_attributes,
-            },
-            "schema_issuer_did": app_config["DID"],
-            "cred_def_id": credential_definition_id,
-            "comment": "",
-            "connection_id": app_config["TOB_CONNECTION"],
-        }
-        do_trace = random.randint(1, 100)
-        if do_trace <= TRACE_MSG_PCT:
-            cred_offer["trace"] = True
-        thread = SendCredentialThread(
-            credential_definition_id,
-            cred_offer,
-            agent_admin_url + "/issue-credential/send",
-            ADMIN_REQUEST_HEADERS,
-        )
-        thread.start()
-        thread.join()
-        cred_responses.append(thread.cred_response)
-        processed_count = processed_count + 1
-
-    processing_time = time.perf_counter() - start_time
-    print(">>> Processed", processed_count, "credentials in", processing_time)
-    print("   ", processing_time / processed_count, "seconds per credential")
-
-    return jsonify(cred_responses)
+    send = _stream_credentials if stream else _send_credentials
+    cred_offers, failures = build_cred_offers(cred_input, trace_ids)
+    return send(
+        cred_offers,
+        agent_admin_url + CRED_OFFER_PATH,
+        trace_ids,
+        permit,
+        failures,
+    )
 
 
-def handle_send_credential_v20(cred_input):
+def handle_send_credential_v20(cred_input, stream=False, trace_ids=None, permit=None):
     """
     # other sample data
     sample_credentials = [
@@ -1021,62 +1899,87 @@ def handle_send_credential_v20(cred_input):
     ]
     """
     # construct and send the credential
-    global app_config
-
     agent_admin_url = app_config["AGENT_ADMIN_URL"]
+    send = _stream_credentials if stream else _send_credentials
+    cred_offers, failures = build_cred_offers_v20(cred_input, trace_ids)
+    return send(
+        cred_offers,
+        agent_admin_url + CRED_OFFER_PATH_V20,
+        trace_ids,
+        permit,
+        failures,
+    )
 
-    start_time = time.perf_counter()
-    processing_time = 0
-    processed_count = 0
 
-    # let's send a credential!
-    cred_responses = []
-    for credential in cred_input:
-        cred_def_key = "CRED_DEF_" + credential["schema"] + "_" + credential["version"]
-        credential_definition_id = app_config["schemas"][cred_def_key]
-
-        credential_attributes = []
-        for attribute in credential["attributes"]:
-            credential_attributes.append({
-                "name": attribute,
-                "value": credential["attributes"][attribute]
-                })
-        cred_offer = {
-          "credential_preview": {
-            "@type": "issue-credential/2.0/credential-preview",
-            "attributes": credential_attributes
-          },
-          "filter": {
-            "indy": {
-                  "schema_id": app_config["schemas"][
-                            "SCHEMA_" + credential["schema"] + "_" + credential["version"]
-                        ],
-                  "schema_name": credential["schema"],
-                  "issuer_did": app_config["DID"],
-                  "schema_version": credential["version"],
-                  "schema_issuer_did": app_config["DID"],
-                  "cred_def_id": credential_definition_id,
-            }
-          },
-          "comment": "",
-          "connection_id": app_config["TOB_CONNECTION"],
-        }
-        do_trace = random.randint(1, 100)
-        if do_trace <= TRACE_MSG_PCT:
-            cred_offer["trace"] = True
-        thread = SendCredentialThread(
-            credential_definition_id,
-            cred_offer,
-            agent_admin_url + "/issue-credential-2.0/send",
-            ADMIN_REQUEST_HEADERS,
+def _run_credential_job(job, cred_offers, url, trace_ids=None, permit=None):
+    try:
+        for index, cred_response in iter_credential_batch(
+            cred_offers, url, trace_ids, permit
+        ):
+            job.set_result(index, cred_response)
+    except Exception as exc:
+        LOGGER.exception("Error running credential job %s", job.job_id)
+        _fail_credential_job(job, str(exc))
+
+
+def _fail_credential_job(job, result):
+    for index, cred_response in enumerate(job.to_dict()["results"]):
+        if cred_response is None:
+            job.set_result(index, {"success": False, "result": result})
+
+
+def _start_credential_job(
+    cred_offers, url, trace_ids=None, permit=None, failures=None
+):
+    """
+    Create a job for a batch and queue it for a job runner, without waiting
+    for space on the issuance queue; if no runner can take it, every offer in
+    the job fails.
+    """
+    job = credential_jobs.create(len(cred_offers))
+    for index, failure in (failures or {}).items():
+        job.set_result(index, failure)
+    try:
+        job_executor.submit(
+            _run_credential_job, job, cred_offers, url, trace_ids, permit, timeout=0
         )
-        thread.start()
-        thread.join()
-        cred_responses.append(thread.cred_response)
-        processed_count = processed_count + 1
+    except QueueFullError as exc:
+        LOGGER.error("Can't queue credential job: %s", str(exc))
+        if permit is not None:
+            permit.release_all()
+        _fail_credential_job(job, str(exc))
+    return job
 
-    processing_time = time.perf_counter() - start_time
-    print(">>> Processed", processed_count, "credentials in", processing_time)
-    print("   ", processing_time/processed_count, "seconds per credential")
 
-    return jsonify(cred_responses)
+def start_credential_job(cred_input, trace_ids=None, permit=None):
+    """
+    Queue a batch of issue-credential 1.0 offers as a background job and return the job.
+    """
+    agent_admin_url = app_config["AGENT_ADMIN_URL"]
+    cred_offers, failures = build_cred_offers(cred_input, trace_ids)
+    return _start_credential_job(
+        cred_offers,
+        agent_admin_url + CRED_OFFER_PATH,
+        trace_ids,
+        permit,
+        failures,
+    )
+
+
+def start_credential_job_v20(cred_input, trace_ids=None, permit=None):
+    """
+    Queue a batch of issue-credential 2.0 offers as a background job and return the job.
+    """
+    agent_admin_url = app_config["AGENT_ADMIN_URL"]
+    cred_offers, failures = build_cred_offers_v20(cred_input, trace_ids)
+    return _start_credential_job(
+        cred_offers,
+        agent_admin_url + CRED_OFFER_PATH_V20,
+        trace_ids,
+        permit,
+        failures,
+    )
+
+
+def get_credential_job(job_id):
+    return credential_jobs.get(job_id)
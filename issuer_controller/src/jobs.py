@@ -0,0 +1,103 @@
+"""
+A bounded, TTL-evicting store for the results of background credential batches
+"""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+JOB_PENDING = "pending"
+JOB_COMPLETE = "complete"
+
+
+class CredentialJob:
+    """The per-credential results of one batch, filled in as exchanges complete."""
+
+    def __init__(self, total_count: int):
+        self.job_id = str(uuid.uuid4())
+        self.created = time.time()
+        self.completed = None
+        self.results = [None] * total_count
+        self.completed_count = 0
+        self._lock = threading.Lock()
+
+    @property
+    def status(self) -> str:
+        return JOB_COMPLETE if self.completed else JOB_PENDING
+
+    def set_result(self, index: int, response: dict):
+        with self._lock:
+            if self.results[index] is None:
+                self.completed_count = self.completed_count + 1
+            self.results[index] = response
+            if self.completed_count == len(self.results):
+                self.completed = time.time()
+
+    def to_dict(self, include_results: bool = True) -> dict:
+        with self._lock:
+            ret = {
+                "job_id": self.job_id,
+                "status": self.status,
+                "created": self.created,
+                "completed": self.completed,
+                "total_count": len(self.results),
+                "completed_count": self.completed_count,
+            }
+            if include_results:
+                ret["results"] = list(self.results)
+            return ret
+
+
+class JobStore:
+    """
+    Keep at most `max_jobs` jobs, each for `ttl` seconds after it completes.
+
+    When the store is full the oldest job is evicted, whether or not it has
+    completed, so that a flood of submissions can't grow memory without bound.
+    """
+
+    def __init__(self, max_jobs: int, ttl: float):
+        self.max_jobs = max(max_jobs, 1)
+        self.ttl = ttl
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self.evicted_count = 0
+
+    def _evict(self):
+        now = time.time()
+        expired = [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job.completed and job.completed + self.ttl < now
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+        while len(self._jobs) >= self.max_jobs:
+            self._jobs.popitem(last=False)
+            self.evicted_count = self.evicted_count + 1
+
+    def create(self, total_count: int) -> CredentialJob:
+        job = CredentialJob(total_count)
+        if total_count == 0:
+            job.completed = job.created
+        with self._lock:
+            self._evict()
+            self._jobs[job.job_id] = job
+        return job
+
+    def get(self, job_id: str) -> CredentialJob:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job and job.completed and job.completed + self.ttl < time.time():
+                del self._jobs[job_id]
+                return None
+            return job
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "job_count": len(self._jobs),
+                "max_jobs": self.max_jobs,
+                "evicted_count": self.evicted_count,
+            }
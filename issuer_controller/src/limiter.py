@@ -0,0 +1,141 @@
+"""
+An adaptive (AIMD) limit on the number of credential exchanges in flight
+"""
+
+import math
+import threading
+import time
+
+
+class AdaptiveLimiter:
+    """
+    Track the credential exchanges in flight and adapt how many are allowed.
+
+    The limit grows additively (by about one per `limit` fast exchanges)
+    while exchanges complete within `latency_target` seconds and the limit is
+    actually being used.  It is cut by `backoff_ratio` when an exchange is
+    slower than that or times out, at most once per round of exchanges (ones
+    that started before the last cut don't cut it again).  The limit stays
+    between `min_limit` and `max_limit`.
+    """
+
+    def __init__(
+        self,
+        initial_limit: int = 32,
+        min_limit: int = 4,
+        max_limit: int = 512,
+        latency_target: float = 10,
+        backoff_ratio: float = 0.75,
+    ):
+        self.min_limit = max(min_limit, 1)
+        self.max_limit = max(max_limit, self.min_limit)
+        self.latency_target = latency_target
+        self.backoff_ratio = backoff_ratio
+        self._limit = float(min(max(initial_limit, self.min_limit), self.max_limit))
+        self._in_flight = 0
+        self._latency = None
+        self._last_decrease = None
+        self._admitted_count = 0
+        self._rejected_count = 0
+        self._decrease_count = 0
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self) -> int:
+        with self._lock:
+            return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        with self._lock:
+            return self._in_flight
+
+    def try_acquire(self, count: int = 1):
+        """
+        Atomically reserve `count` exchange slots, if they fit under the limit.
+
+        Returns a LimiterPermit holding the slots, or None if `in_flight + count`
+        would exceed the limit.  A batch larger than the limit is admitted
+        when nothing else is in flight, so that it isn't rejected forever.
+        """
+        count = max(count, 1)
+        with self._lock:
+            if self._in_flight > 0 and self._in_flight + count > int(self._limit):
+                self._rejected_count = self._rejected_count + 1
+                return None
+            self._in_flight = self._in_flight + count
+            self._admitted_count = self._admitted_count + 1
+        return LimiterPermit(self, count)
+
+    def acquire(self, count: int = 1):
+        """Reserve `count` exchange slots regardless of the limit."""
+        count = max(count, 1)
+        with self._lock:
+            self._in_flight = self._in_flight + count
+        return LimiterPermit(self, count)
+
+    def retry_after(self) -> int:
+        """Seconds for a rejected client to wait: about one exchange's latency."""
+        with self._lock:
+            latency = self._latency if self._latency is not None else 1
+        return max(int(math.ceil(latency)), 1)
+
+    def _release(self, count: int):
+        with self._lock:
+            self._in_flight = max(self._in_flight - count, 0)
+
+    def record(self, start_time: float, latency: float, timed_out: bool = False):
+        """
+        Adapt the limit to an exchange that started at `start_time` (from
+        time.perf_counter()) and took `latency` seconds.
+        """
+        with self._lock:
+            if self._latency is None:
+                self._latency = latency
+            else:
+                self._latency = 0.9 * self._latency + 0.1 * latency
+            if timed_out or latency > self.latency_target:
+                if self._last_decrease is None or start_time >= self._last_decrease:
+                    self._limit = max(self._limit * self.backoff_ratio, self.min_limit)
+                    self._last_decrease = time.perf_counter()
+                    self._decrease_count = self._decrease_count + 1
+            elif self._in_flight * 2 >= self._limit:
+                self._limit = min(self._limit + 1 / self._limit, self.max_limit)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "limit": int(self._limit),
+                "in_flight": self._in_flight,
+                "latency": self._latency,
+                "admitted_count": self._admitted_count,
+                "rejected_count": self._rejected_count,
+                "decrease_count": self._decrease_count,
+            }
+
+
+class LimiterPermit:
+    """
+    Exchange slots reserved on an AdaptiveLimiter, given back one at a time
+    as each exchange completes.  Releasing more slots than are held is a no-op.
+    """
+
+    def __init__(self, limiter: AdaptiveLimiter, count: int):
+        self._limiter = limiter
+        self._remaining = count
+        self._lock = threading.Lock()
+
+    @property
+    def remaining(self) -> int:
+        with self._lock:
+            return self._remaining
+
+    def release(self, count: int = 1):
+        with self._lock:
+            count = max(min(count, self._remaining), 0)
+            self._remaining = self._remaining - count
+        if count > 0:
+            self._limiter._release(count)
+
+    def release_all(self):
+        self.release(self.remaining)
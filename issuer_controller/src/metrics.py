@@ -0,0 +1,403 @@
+"""
+Lightweight in-process metrics
+"""
+
+import bisect
+import itertools
+import threading
+import time
+from collections import deque
+
+# bucket upper bounds (in seconds) for lock wait times
+LOCK_WAIT_BOUNDS = [0.00001, 0.0001, 0.001, 0.01, 0.1, 1.0]
+
+
+class Histogram:
+    """
+    A fixed-bucket histogram of durations (in seconds).
+
+    Updates are not synchronized; callers either record while holding a lock
+    they already own, or keep one histogram per thread and merge them on read.
+    """
+
+    def __init__(self, bounds: list):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: "Histogram"):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.total += other.total
+        if other.max > self.max:
+            self.max = other.max
+
+    def to_dict(self) -> dict:
+        buckets = {}
+        for bound, count in zip(self.bounds + ["+Inf"], self.counts):
+            buckets["le_" + str(bound)] = count
+        return {
+            "count": self.count,
+            "total_time": self.total,
+            "avg_time": self.total / self.count if self.count else 0,
+            "max_time": self.max,
+            "buckets": buckets,
+        }
+
+
+class LatencyHistogram:
+    """
+    A log-linear (HDR-style) histogram of durations, with microsecond
+    resolution and a relative error of at most 1/16 at any magnitude.
+
+    Like `Histogram`, updates are not synchronized.
+    """
+
+    SUB_BUCKET_BITS = 4
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+
+    @classmethod
+    def _index(cls, micros: int) -> int:
+        linear = cls.SUB_BUCKETS * 2
+        if micros < linear:
+            return micros
+        shift = micros.bit_length() - (cls.SUB_BUCKET_BITS + 1)
+        return (
+            linear + (shift - 1) * cls.SUB_BUCKETS + (micros >> shift) - cls.SUB_BUCKETS
+        )
+
+    @classmethod
+    def _upper_bound(cls, index: int) -> float:
+        """The largest value (in seconds) that falls in a bucket."""
+        linear = cls.SUB_BUCKETS * 2
+        if index < linear:
+            return index / 1000000
+        shift = (index - linear) // cls.SUB_BUCKETS + 1
+        top = (index - linear) % cls.SUB_BUCKETS + cls.SUB_BUCKETS
+        return (((top + 1) << shift) - 1) / 1000000
+
+    def record(self, value: float):
+        index = self._index(max(int(value * 1000000), 0))
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: "LatencyHistogram"):
+        for index, count in list(other.counts.items()):
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max > self.max:
+            self.max = other.max
+
+    def percentile(self, fraction: float) -> float:
+        if not self.count:
+            return 0
+        rank = max(int(fraction * self.count + 0.999999), 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self._upper_bound(index), self.max)
+        return self.max
+
+
+class MethodTimings:
+    """
+    Per-method latency histograms and success/failure counts.
+
+    Samples are recorded into one of `shard_count` shards, assigned to each
+    recording thread (or greenlet) in turn on its first sample, each with its
+    own lock, so concurrent requests rarely contend; the shards are merged
+    when read.  At most `max_methods` distinct methods are tracked (any
+    others are counted under "_other"), and the data of the last
+    `failure_samples` failures is kept in a ring buffer.
+    """
+
+    OTHER_METHOD = "_other"
+
+    def __init__(
+        self, shard_count: int = 16, failure_samples: int = 100, max_methods: int = 1000
+    ):
+        self._shards = [(threading.Lock(), {}) for _ in range(max(shard_count, 1))]
+        self._methods = set()
+        self._methods_lock = threading.Lock()
+        self.max_methods = max_methods
+        self._failures = deque(maxlen=max(failure_samples, 1))
+        self._shard_counter = itertools.count()
+        self._local = threading.local()
+
+    def _shard(self):
+        index = getattr(self._local, "shard_index", None)
+        if index is None:
+            # next() on itertools.count is atomic, so no lock is needed
+            index = self._local.shard_index = next(self._shard_counter)
+        return self._shards[index % len(self._shards)]
+
+    def _method_name(self, method: str) -> str:
+        if method in self._methods:
+            return method
+        with self._methods_lock:
+            if method not in self._methods and len(self._methods) >= self.max_methods:
+                return self.OTHER_METHOD
+            self._methods.add(method)
+        return method
+
+    def record(self, method: str, elapsed_time: float, success: bool, data=None):
+        method = self._method_name(method)
+        lock, methods = self._shard()
+        with lock:
+            stats = methods.get(method)
+            if stats is None:
+                stats = methods[method] = [LatencyHistogram(), 0]
+            stats[0].record(elapsed_time)
+            if not success:
+                stats[1] += 1
+        if not success:
+            # deque appends are atomic, so no lock is needed
+            self._failures.append(
+                {
+                    "method": method,
+                    "timestamp": time.time(),
+                    "elapsed_time": elapsed_time,
+                    "data": data,
+                }
+            )
+
+    def clear(self):
+        for lock, methods in self._shards:
+            with lock:
+                methods.clear()
+        with self._methods_lock:
+            self._methods = set()
+        self._failures.clear()
+
+    def to_dict(self) -> dict:
+        merged = {}
+        for lock, methods in self._shards:
+            with lock:
+                for method, (histogram, fail_count) in methods.items():
+                    if method not in merged:
+                        merged[method] = [LatencyHistogram(), 0]
+                    merged[method][0].merge(histogram)
+                    merged[method][1] += fail_count
+
+        failures = list(self._failures)
+        ret = {}
+        for method, (histogram, fail_count) in merged.items():
+            ret[method] = {
+                "total_count": histogram.count,
+                "success_count": histogram.count - fail_count,
+                "fail_count": fail_count,
+                "error_rate": fail_count / histogram.count if histogram.count else 0,
+                "min_time": histogram.min,
+                "max_time": histogram.max,
+                "total_time": histogram.total,
+                "avg_time": histogram.total / histogram.count if histogram.count else 0,
+                "p50": histogram.percentile(0.5),
+                "p90": histogram.percentile(0.9),
+                "p99": histogram.percentile(0.99),
+                "p999": histogram.percentile(0.999),
+                "failures": [
+                    failure for failure in failures if failure["method"] == method
+                ],
+            }
+        return ret
+
+
+# bucket upper bounds (in seconds) for the latencies published on /metrics
+LATENCY_BOUNDS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=None) -> str:
+    pairs = [
+        '{}="{}"'.format(name, _escape_label(value))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append('{}="{}"'.format(*extra))
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class CounterMetric:
+    """A monotonically increasing count, per combination of label values."""
+
+    metric_type = "counter"
+
+    def __init__(self, name: str, help_text: str, label_names: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values) -> float:
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def samples(self) -> list:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [
+            (self.name + "_total", self.label_names, labels, value)
+            for labels, value in values
+        ]
+
+
+class GaugeMetric:
+    """A value read from `source()` whenever the metrics are collected."""
+
+    metric_type = "gauge"
+
+    def __init__(self, name: str, help_text: str, source):
+        self.name = name
+        self.help_text = help_text
+        self._source = source
+
+    def samples(self) -> list:
+        return [(self.name, (), (), self._source())]
+
+
+class HistogramMetric:
+    """A fixed-bucket latency `Histogram` per combination of label values."""
+
+    metric_type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        label_names: tuple = (),
+        bounds: list = LATENCY_BOUNDS,
+    ):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.bounds = list(bounds)
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        with self._lock:
+            histogram = self._histograms.get(label_values)
+            if histogram is None:
+                histogram = self._histograms[label_values] = Histogram(self.bounds)
+            histogram.record(value)
+
+    def count(self, *label_values) -> int:
+        with self._lock:
+            histogram = self._histograms.get(label_values)
+            return histogram.count if histogram else 0
+
+    def samples(self) -> list:
+        with self._lock:
+            histograms = [
+                (labels, list(histogram.counts), histogram.total, histogram.count)
+                for labels, histogram in sorted(self._histograms.items())
+            ]
+        ret = []
+        for labels, counts, total, count in histograms:
+            cumulative = 0
+            for bound, bucket_count in zip(self.bounds + [float("inf")], counts):
+                cumulative += bucket_count
+                ret.append(
+                    (
+                        self.name + "_bucket",
+                        self.label_names,
+                        labels,
+                        cumulative,
+                        ("le", _format_value(float(bound))),
+                    )
+                )
+            ret.append((self.name + "_sum", self.label_names, labels, total))
+            ret.append((self.name + "_count", self.label_names, labels, count))
+        return ret
+
+
+class MetricsRegistry:
+    """
+    The metrics published on /metrics, rendered in the Prometheus text
+    exposition format (version 0.0.4).
+
+    Recording a sample costs a dict lookup under a per-metric lock, so the
+    metrics are always collected, whether or not RECORD_TIMINGS is set.
+    """
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, label_names: tuple = ()):
+        return self._add(CounterMetric(name, help_text, label_names))
+
+    def gauge(self, name: str, help_text: str, source):
+        return self._add(GaugeMetric(name, help_text, source))
+
+    def histogram(
+        self,
+        name: str,
+        help_text: str,
+        label_names: tuple = (),
+        bounds: list = LATENCY_BOUNDS,
+    ):
+        return self._add(HistogramMetric(name, help_text, label_names, bounds))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help_text))
+            lines.append("# TYPE {} {}".format(metric.name, metric.metric_type))
+            for sample in metric.samples():
+                name, label_names, label_values, value = sample[:4]
+                extra = sample[4] if len(sample) > 4 else None
+                lines.append(
+                    name
+                    + _format_labels(label_names, label_values, extra)
+                    + " "
+                    + _format_value(value)
+                )
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,139 @@
+"""
+Credential offer templates, compiled once per (schema, version, protocol)
+"""
+
+import threading
+
+from src.validation import SchemaValidator
+
+PROTOCOL_V10 = "1.0"
+PROTOCOL_V20 = "2.0"
+
+CREDENTIAL_PREVIEW_V10 = (
+    "did:sov:BzCbsNYhMrjHiqZDTUASHg;spec/issue-credential/1.0/credential-preview"
+)
+CREDENTIAL_PREVIEW_V20 = "issue-credential/2.0/credential-preview"
+
+
+class UnknownSchemaError(Exception):
+    """Raised for a credential whose schema and version haven't been registered."""
+
+
+class OfferTemplate:
+    """
+    The fixed part of the credential offers for one schema version and
+    protocol; `build()` adds the attribute values and the connection id.
+
+    Offers built from a template share its nested (constant) dicts, which
+    must not be modified.  `validator` checks the attribute values, if the
+    schema's attributes are known.
+    """
+
+    __slots__ = ("cred_def_id", "protocol", "validator", "_base", "_filter")
+
+    def __init__(
+        self,
+        schema_name: str,
+        schema_version: str,
+        protocol: str,
+        schema_id: str,
+        cred_def_id: str,
+        did: str,
+        validator: SchemaValidator = None,
+    ):
+        self.cred_def_id = cred_def_id
+        self.protocol = protocol
+        self.validator = validator
+        ids = {
+            "schema_id": schema_id,
+            "schema_name": schema_name,
+            "issuer_did": did,
+            "schema_version": schema_version,
+            "schema_issuer_did": did,
+            "cred_def_id": cred_def_id,
+        }
+        if protocol == PROTOCOL_V10:
+            self._base = dict(ids, comment="")
+            self._filter = None
+        else:
+            self._base = {"comment": ""}
+            self._filter = {"indy": ids}
+
+    def build(self, attributes: dict, connection_id: str) -> dict:
+        offer = dict(self._base)
+        offer["connection_id"] = connection_id
+        if self.protocol == PROTOCOL_V10:
+            offer["credential_proposal"] = {
+                "@type": CREDENTIAL_PREVIEW_V10,
+                "attributes": [
+                    {"name": name, "mime-type": "text/plain", "value": value}
+                    for name, value in attributes.items()
+                ],
+            }
+        else:
+            offer["credential_preview"] = {
+                "@type": CREDENTIAL_PREVIEW_V20,
+                "attributes": [
+                    {"name": name, "value": value}
+                    for name, value in attributes.items()
+                ],
+            }
+            offer["filter"] = self._filter
+        return offer
+
+
+class OfferTemplates:
+    """
+    Compile offer templates on first use from the registered schema and cred
+    def ids, which `source()` returns as (app_config["schemas"], DID).
+
+    Call `clear()` whenever the registered ids change.
+    """
+
+    def __init__(self, source):
+        self._source = source
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def get(
+        self, schema_name: str, schema_version: str, protocol: str
+    ) -> OfferTemplate:
+        key = (schema_name, schema_version, protocol)
+        template = self._templates.get(key)
+        if template is None:
+            template = self._compile(schema_name, schema_version, protocol)
+            with self._lock:
+                self._templates[key] = template
+        return template
+
+    def _compile(self, schema_name: str, schema_version: str, protocol: str):
+        schemas, did = self._source()
+        suffix = str(schema_name) + "_" + str(schema_version)
+        schema_id = schemas.get("SCHEMA_" + suffix)
+        cred_def_id = schemas.get("CRED_DEF_" + suffix)
+        if not schema_id or not cred_def_id:
+            raise UnknownSchemaError(
+                "Unknown schema {} version {}".format(schema_name, schema_version)
+            )
+        # only the latest version of each schema has its config in app_config
+        validator = None
+        schema = schemas.get("SCHEMA_" + str(schema_name))
+        if (
+            isinstance(schema, dict)
+            and str(schema.get("version")) == str(schema_version)
+            and schema.get("attributes")
+        ):
+            validator = SchemaValidator(schema["attributes"])
+        return OfferTemplate(
+            schema_name,
+            schema_version,
+            protocol,
+            schema_id,
+            cred_def_id,
+            did,
+            validator,
+        )
+
+    def clear(self):
+        with self._lock:
+            self._templates = {}
@@ -0,0 +1,304 @@
+"""
+Retries with backoff, and a circuit breaker, for calls to the agent admin API
+"""
+
+import asyncio
+import logging
+import random
+import threading
+import time
+
+import requests
+from urllib3.exceptions import NewConnectionError
+
+LOGGER = logging.getLogger(__name__)
+
+BREAKER_CLOSED = "closed"
+BREAKER_OPEN = "open"
+BREAKER_HALF_OPEN = "half_open"
+
+# statuses worth retrying: the agent (or a proxy in front of it) is busy or down
+RETRYABLE_STATUSES = frozenset([408, 425, 429, 500, 502, 503, 504])
+# statuses that mean the agent didn't process the request at all
+REFUSED_STATUSES = frozenset([429, 503])
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the agent while its circuit breaker is open."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(
+            "{} is unavailable, retry after {:.0f}s".format(name, retry_after)
+        )
+        self.retry_after = retry_after
+
+
+def _status(exc):
+    """The HTTP status of a requests or aiohttp response error, if it is one."""
+    if isinstance(exc, requests.HTTPError):
+        return exc.response.status_code if exc.response is not None else None
+    status = getattr(exc, "status", None)
+    return status if isinstance(status, int) else None
+
+
+def _connect_failed(exc) -> bool:
+    """True if the request never reached the agent (so it's safe to resend)."""
+    if isinstance(exc, requests.ConnectTimeout):
+        return True
+    if isinstance(exc, requests.ConnectionError) and exc.args:
+        return isinstance(getattr(exc.args[0], "reason", None), NewConnectionError)
+    try:
+        import aiohttp
+    except ImportError:
+        return False
+    return isinstance(exc, aiohttp.ClientConnectorError)
+
+
+def _transport_error(exc) -> bool:
+    transport_errors = (
+        requests.ConnectionError,
+        requests.Timeout,
+        OSError,
+        asyncio.TimeoutError,
+    )
+    if isinstance(exc, transport_errors):
+        return True
+    try:
+        import aiohttp
+    except ImportError:
+        return False
+    return isinstance(exc, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError))
+
+
+def is_retryable(exc, idempotent: bool = True) -> bool:
+    """
+    Classify an error from an agent call as retryable or fatal.
+
+    Errors from a request that isn't `idempotent` (e.g. sending a credential
+    offer) are only retryable if the agent can't have acted on the request.
+    """
+    status = _status(exc)
+    if status is not None:
+        return status in (RETRYABLE_STATUSES if idempotent else REFUSED_STATUSES)
+    if _connect_failed(exc):
+        return True
+    return idempotent and _transport_error(exc)
+
+
+def is_agent_failure(exc) -> bool:
+    """True if an error means the agent is unhealthy (rather than the request bad)."""
+    return is_retryable(exc, idempotent=True)
+
+
+class RetryPolicy:
+    """
+    Up to `max_attempts` attempts, with exponential backoff and full jitter
+    between them, all within a `deadline` (seconds) from the first attempt.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 4,
+        base_delay: float = 0.5,
+        max_delay: float = 10,
+        deadline: float = 30,
+    ):
+        self.max_attempts = max(max_attempts, 1)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def delay(self, attempt: int) -> float:
+        """The (random) delay after the given (1-based) failed attempt."""
+        ceiling = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(0, ceiling)
+
+    def next_delay(self, attempt: int, start_time: float, exc, idempotent: bool):
+        """The delay before the next attempt, or None if we should give up."""
+        if attempt >= self.max_attempts or not is_retryable(exc, idempotent):
+            return None
+        delay = self.delay(attempt)
+        if time.monotonic() + delay - start_time > self.deadline:
+            return None
+        return delay
+
+
+class CircuitBreaker:
+    """
+    Stop calling the agent after `failure_threshold` consecutive failures.
+
+    While open, calls fail fast with CircuitOpenError.  After `reset_timeout`
+    seconds one trial call is let through (half open): if it succeeds the
+    breaker closes, otherwise it opens again.  A trial whose outcome hasn't
+    been recorded within `trial_timeout` seconds is replaced by another.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30,
+        name: str = "agent",
+        trial_timeout: float = None,
+    ):
+        self.failure_threshold = max(failure_threshold, 1)
+        self.reset_timeout = reset_timeout
+        self.trial_timeout = reset_timeout if trial_timeout is None else trial_timeout
+        self.name = name
+        self._state = BREAKER_CLOSED
+        self._failure_count = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._trial_started_at = None
+        self._open_count = 0
+        self._lock = threading.Lock()
+
+    def _retry_after(self) -> float:
+        return max(self._opened_at + self.reset_timeout - time.monotonic(), 0)
+
+    def allow(self):
+        """Raise CircuitOpenError unless a call may go ahead."""
+        with self._lock:
+            if self._state == BREAKER_CLOSED:
+                return
+            if self._state == BREAKER_OPEN and self._retry_after() <= 0:
+                self._state = BREAKER_HALF_OPEN
+                self._trial_running = False
+            if self._state == BREAKER_HALF_OPEN and (
+                not self._trial_running
+                or time.monotonic() - self._trial_started_at >= self.trial_timeout
+            ):
+                self._trial_running = True
+                self._trial_started_at = time.monotonic()
+                return
+            raise CircuitOpenError(self.name, max(self._retry_after(), 1))
+
+    def is_open(self) -> bool:
+        """True if calls are currently being refused (without starting a trial)."""
+        with self._lock:
+            if self._state == BREAKER_OPEN:
+                return self._retry_after() > 0
+            return self._state == BREAKER_HALF_OPEN and self._trial_running
+
+    def retry_after(self) -> float:
+        with self._lock:
+            return max(self._retry_after(), 1) if self._opened_at else 0
+
+    def record_success(self):
+        with self._lock:
+            if self._state != BREAKER_CLOSED:
+                LOGGER.warning("Circuit breaker for %s closed", self.name)
+            self._state = BREAKER_CLOSED
+            self._failure_count = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failure_count = self._failure_count + 1
+            if self._state == BREAKER_HALF_OPEN or (
+                self._state == BREAKER_CLOSED
+                and self._failure_count >= self.failure_threshold
+            ):
+                LOGGER.error(
+                    "Circuit breaker for %s opened after %d failures",
+                    self.name,
+                    self._failure_count,
+                )
+                self._state = BREAKER_OPEN
+                self._opened_at = time.monotonic()
+                self._trial_running = False
+                self._open_count = self._open_count + 1
+
+    def record(self, exc):
+        """Record the outcome of a call that raised `exc` (fatal errors don't count)."""
+        if is_agent_failure(exc):
+            self.record_failure()
+        else:
+            self.record_success()
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            ret = {
+                "state": self._state,
+                "failure_count": self._failure_count,
+                "failure_threshold": self.failure_threshold,
+                "open_count": self._open_count,
+            }
+            if self._state != BREAKER_CLOSED:
+                ret["retry_after"] = self._retry_after()
+            return ret
+
+
+def call_with_retry(
+    fn,
+    policy: RetryPolicy,
+    breaker: CircuitBreaker = None,
+    idempotent: bool = True,
+    description: str = "",
+):
+    """
+    Call `fn()`, retrying retryable errors as `policy` allows.  Each attempt
+    is recorded on `breaker` (if any), and none are made while it is open.
+    """
+    start_time = time.monotonic()
+    attempt = 0
+    while True:
+        attempt = attempt + 1
+        if breaker is not None:
+            breaker.allow()
+        try:
+            result = fn()
+        except Exception as exc:
+            if breaker is not None:
+                breaker.record(exc)
+            delay = policy.next_delay(attempt, start_time, exc, idempotent)
+            if delay is None:
+                raise
+            LOGGER.warning(
+                "Error calling %s (attempt %d), retrying in %.2fs: %s",
+                description,
+                attempt,
+                delay,
+                str(exc),
+            )
+            time.sleep(delay)
+            continue
+        if breaker is not None:
+            breaker.record_success()
+        return result
+
+
+async def call_with_retry_async(
+    coro_fn,
+    policy: RetryPolicy,
+    breaker: CircuitBreaker = None,
+    idempotent: bool = True,
+    description: str = "",
+):
+    """Coroutine equivalent of call_with_retry(), for a `coro_fn()` coroutine."""
+    start_time = time.monotonic()
+    attempt = 0
+    while True:
+        attempt = attempt + 1
+        if breaker is not None:
+            breaker.allow()
+        try:
+            result = await coro_fn()
+        except Exception as exc:
+            if breaker is not None:
+                breaker.record(exc)
+            delay = policy.next_delay(attempt, start_time, exc, idempotent)
+            if delay is None:
+                raise
+            LOGGER.warning(
+                "Error calling %s (attempt %d), retrying in %.2fs: %s",
+                description,
+                attempt,
+                delay,
+                str(exc),
+            )
+            await asyncio.sleep(delay)
+            continue
+        if breaker is not None:
+            breaker.record_success()
+        return result
@@ -0,0 +1,140 @@
+"""
+A dependency graph of startup phases, run concurrently where possible
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor
+from concurrent.futures import wait as futures_wait
+
+LOGGER = logging.getLogger(__name__)
+
+PHASE_PENDING = "pending"
+PHASE_RUNNING = "running"
+PHASE_COMPLETE = "complete"
+PHASE_FAILED = "failed"
+# a phase is skipped when one of the phases it depends on has failed
+PHASE_SKIPPED = "skipped"
+
+
+class StartupPhase:
+    """One step of the startup process, and its current state."""
+
+    def __init__(self, name: str, fn, depends_on: tuple):
+        self.name = name
+        self.fn = fn
+        self.depends_on = tuple(depends_on)
+        self.state = PHASE_PENDING
+        self.start_time = None
+        self.end_time = None
+        self.error = None
+
+    def to_dict(self) -> dict:
+        if self.start_time is None:
+            elapsed_time = None
+        else:
+            end_time = self.end_time if self.end_time else time.perf_counter()
+            elapsed_time = end_time - self.start_time
+        ret = {
+            "state": self.state,
+            "depends_on": list(self.depends_on),
+            "elapsed_time": elapsed_time,
+        }
+        if self.error:
+            ret["error"] = self.error
+        return ret
+
+
+class StartupPhases:
+    """
+    Run a set of phases, each as soon as all of the phases it depends on have
+    completed.  Phases are added in dependency order; a phase whose
+    dependency fails is skipped rather than run.
+    """
+
+    def __init__(self):
+        self._phases = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, name: str, fn, depends_on: tuple = ()):
+        for dependency in depends_on:
+            if dependency not in self._phases:
+                raise Exception(
+                    "Startup phase {} depends on unknown phase {}".format(
+                        name, dependency
+                    )
+                )
+        self._phases[name] = StartupPhase(name, fn, depends_on)
+
+    def _run_phase(self, phase: StartupPhase):
+        with self._lock:
+            phase.start_time = time.perf_counter()
+        try:
+            phase.fn()
+        except Exception as exc:
+            LOGGER.exception("Startup phase %s failed", phase.name)
+            with self._lock:
+                phase.state = PHASE_FAILED
+                phase.error = str(exc)
+                phase.end_time = time.perf_counter()
+            return
+        with self._lock:
+            phase.state = PHASE_COMPLETE
+            phase.end_time = time.perf_counter()
+
+    def _ready_phases(self) -> list:
+        """Return the pending phases that can start; skip any that never will."""
+        ready = []
+        with self._lock:
+            for phase in self._phases.values():
+                if phase.state != PHASE_PENDING:
+                    continue
+                states = [self._phases[name].state for name in phase.depends_on]
+                if any(state in (PHASE_FAILED, PHASE_SKIPPED) for state in states):
+                    phase.state = PHASE_SKIPPED
+                elif all(state == PHASE_COMPLETE for state in states):
+                    # so that it isn't picked up again before it starts
+                    phase.state = PHASE_RUNNING
+                    ready.append(phase)
+        return ready
+
+    def run(self) -> bool:
+        """Run all of the phases; returns True if they all completed."""
+        with ThreadPoolExecutor(
+            max_workers=max(len(self._phases), 1), thread_name_prefix="startup-phase"
+        ) as executor:
+            running = set()
+            while True:
+                for phase in self._ready_phases():
+                    running.add(executor.submit(self._run_phase, phase))
+                if not running:
+                    break
+                done, running = futures_wait(running, return_when=FIRST_COMPLETED)
+        return self.state == PHASE_COMPLETE
+
+    def phase_state(self, name: str) -> str:
+        with self._lock:
+            return self._phases[name].state
+
+    @property
+    def state(self) -> str:
+        """The overall state: failed, running, pending or complete."""
+        with self._lock:
+            states = set(phase.state for phase in self._phases.values())
+        if PHASE_FAILED in states or PHASE_SKIPPED in states:
+            return PHASE_FAILED
+        if PHASE_RUNNING in states:
+            return PHASE_RUNNING
+        if PHASE_PENDING in states:
+            return PHASE_PENDING
+        return PHASE_COMPLETE
+
+    def to_dict(self) -> dict:
+        state = self.state
+        with self._lock:
+            phases = OrderedDict(
+                (name, phase.to_dict()) for name, phase in self._phases.items()
+            )
+        return {"state": state, "phases": phases}
@@ -0,0 +1,61 @@
+"""
+A JSON snapshot of the ledger artifacts resolved at startup, for warm restarts
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+LOGGER = logging.getLogger(__name__)
+
+
+def config_hash(*configs) -> str:
+    """Return a stable hash of (already loaded) configuration trees."""
+    digest = hashlib.sha256()
+    for tree in configs:
+        digest.update(json.dumps(tree, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+class StartupCache:
+    """
+    Hold the resolved schema and cred def ids, the public DID and the TOB
+    connection id in a file, keyed by the agent's DID and a hash of the
+    configuration they were resolved from.
+
+    A snapshot that doesn't match the current DID and configuration is
+    ignored, as is one that can't be read.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self, did: str, config_key: str) -> dict:
+        try:
+            with open(self.path) as cache_file:
+                snapshot = json.load(cache_file)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            LOGGER.exception("Error reading startup cache %s", self.path)
+            return None
+        if snapshot.get("did") != did or snapshot.get("config_hash") != config_key:
+            LOGGER.info("Startup cache %s is stale, ignoring", self.path)
+            return None
+        return snapshot
+
+    def save(self, did: str, config_key: str, schemas: dict, tob_connection: str):
+        snapshot = {
+            "did": did,
+            "config_hash": config_key,
+            "schemas": schemas,
+            "tob_connection": tob_connection,
+        }
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as cache_file:
+                json.dump(snapshot, cache_file)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            LOGGER.exception("Error writing startup cache %s", self.path)
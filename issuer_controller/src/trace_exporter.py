@@ -0,0 +1,144 @@
+"""
+A background exporter that sends trace events to the trace target in batches
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+
+LOGGER = logging.getLogger(__name__)
+
+
+class TraceExporter:
+    """
+    Buffer trace events in memory and send them from a background thread.
+
+    `send(events)` is called with a list of up to `batch_size` events, as soon
+    as a full batch is buffered or `flush_interval` seconds after the oldest
+    buffered event was added.  The buffer holds at most `buffer_size` events;
+    when it's full the oldest event is dropped (and counted), so `export()`
+    never blocks on the trace target.  The thread is started on first use.
+
+    If `dropped_counter` (a `CounterMetric`) is given, it also counts the
+    dropped events.
+    """
+
+    def __init__(
+        self,
+        send,
+        batch_size: int = 100,
+        flush_interval: float = 1.0,
+        buffer_size: int = 10000,
+        name: str = "trace-exporter",
+        dropped_counter=None,
+    ):
+        self._send = send
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval
+        self.buffer_size = max(buffer_size, 1)
+        self.name = name
+        self.dropped_counter = dropped_counter
+        self._buffer = deque()
+        self._ready = threading.Condition()
+        self._thread = None
+        self._sending = False
+        self._flushing = False
+        self._exported_count = 0
+        self._dropped_count = 0
+        self._failed_count = 0
+        self._batch_count = 0
+
+    def _start(self):
+        with self._ready:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name=self.name, daemon=True
+            )
+            self._thread.start()
+
+    def export(self, event):
+        """Queue an event to be sent; never blocks on the trace target."""
+        if self._thread is None:
+            self._start()
+        with self._ready:
+            if len(self._buffer) >= self.buffer_size:
+                self._buffer.popleft()
+                self._dropped_count = self._dropped_count + 1
+                if self.dropped_counter is not None:
+                    self.dropped_counter.inc()
+            self._buffer.append(event)
+            # wake the thread to start the flush interval, or to send a batch
+            if len(self._buffer) == 1 or len(self._buffer) >= self.batch_size:
+                self._ready.notify_all()
+
+    def _next_batch(self) -> list:
+        """Wait for a full batch, or for the flush interval, and take it."""
+        with self._ready:
+            while not self._buffer:
+                self._ready.wait()
+            deadline = time.monotonic() + self.flush_interval
+            while len(self._buffer) < self.batch_size and not self._flushing:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._ready.wait(remaining)
+            count = min(len(self._buffer), self.batch_size)
+            batch = [self._buffer.popleft() for _ in range(count)]
+            self._sending = bool(batch)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._send(batch)
+                failed = False
+            except Exception:
+                LOGGER.exception("Error sending %d trace events", len(batch))
+                failed = True
+            with self._ready:
+                self._sending = False
+                self._batch_count = self._batch_count + 1
+                if failed:
+                    self._failed_count = self._failed_count + len(batch)
+                else:
+                    self._exported_count = self._exported_count + len(batch)
+                self._ready.notify_all()
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Wait (up to `timeout` seconds) for the buffered events to be sent;
+        returns False if some are still waiting.
+        """
+        if self._thread is None:
+            return not self._buffer
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._ready:
+            # send partial batches now rather than at the flush interval
+            self._flushing = True
+            self._ready.notify_all()
+            try:
+                while self._buffer or self._sending:
+                    if deadline is None:
+                        self._ready.wait()
+                        continue
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._ready.wait(remaining)
+            finally:
+                self._flushing = False
+        return True
+
+    def stats(self) -> dict:
+        with self._ready:
+            return {
+                "buffer_size": self.buffer_size,
+                "buffered_count": len(self._buffer),
+                "exported_count": self._exported_count,
+                "dropped_count": self._dropped_count,
+                "failed_count": self._failed_count,
+                "batch_count": self._batch_count,
+            }
@@ -0,0 +1,73 @@
+"""
+Validation of credential attributes against the schemas in schemas.yml
+"""
+
+from datetime import datetime
+
+DATA_TYPE_DATE = "ui_date"
+
+
+def invalid_credential_response(errors: list) -> dict:
+    """
+    The response for a credential in a batch that wasn't sent because it's
+    invalid; `errors` lists its problems.
+    """
+    return {
+        "success": False,
+        "result": "Invalid credential: " + ", ".join(errors),
+        "errors": errors,
+    }
+
+
+def _is_date(value) -> bool:
+    if not isinstance(value, str):
+        return False
+    try:
+        # dates, or date-times with an optional (Z or offset) time zone
+        datetime.fromisoformat(value[:-1] + "+00:00" if value.endswith("Z") else value)
+    except ValueError:
+        return False
+    return True
+
+
+class SchemaValidator:
+    """
+    Check a credential's attributes against a schema's attribute config (the
+    `attributes` of a schema in schemas.yml): every schema attribute must be
+    present, no others are allowed, required attributes must have a value
+    and ui_date attributes must hold an ISO 8601 date (or date-time).
+    """
+
+    def __init__(self, attributes):
+        if isinstance(attributes, dict):
+            self.attribute_names = frozenset(attributes)
+            self.required = frozenset(
+                name
+                for name, spec in attributes.items()
+                if isinstance(spec, dict) and spec.get("required")
+            )
+            self.dates = frozenset(
+                name
+                for name, spec in attributes.items()
+                if isinstance(spec, dict) and spec.get("data_type") == DATA_TYPE_DATE
+            )
+        else:
+            self.attribute_names = frozenset(attributes)
+            self.required = frozenset()
+            self.dates = frozenset()
+
+    def validate(self, values: dict) -> list:
+        """Return a list of problems with the attribute values (empty if valid)."""
+        errors = []
+        for name in sorted(self.attribute_names.difference(values)):
+            errors.append("missing attribute " + name)
+        for name in sorted(set(values).difference(self.attribute_names)):
+            errors.append("unknown attribute " + name)
+        for name in sorted(self.required):
+            if name in values and values[name] in (None, ""):
+                errors.append(name + " is required")
+        for name in sorted(self.dates):
+            value = values.get(name)
+            if value not in (None, "") and not _is_date(value):
+                errors.append(name + " is not a valid date: " + str(value))
+        return errors
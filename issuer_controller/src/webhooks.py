@@ -0,0 +1,197 @@
+"""
+Table-driven dispatch of the agent's webhook callbacks
+"""
+
+import logging
+import threading
+import time
+
+from flask import Response
+
+from src.executor import IssuanceExecutor, QueueFullError
+from src.metrics import Histogram
+
+LOGGER = logging.getLogger(__name__)
+
+WEBHOOK_MODE_INLINE = "inline"
+WEBHOOK_MODE_QUEUED = "queued"
+
+# what to do with a webhook when the queue is full
+WEBHOOK_OVERFLOW_REJECT = "reject"
+WEBHOOK_OVERFLOW_DROP = "drop"
+WEBHOOK_OVERFLOW_INLINE = "inline"
+WEBHOOK_OVERFLOW_POLICIES = (
+    WEBHOOK_OVERFLOW_REJECT,
+    WEBHOOK_OVERFLOW_DROP,
+    WEBHOOK_OVERFLOW_INLINE,
+)
+
+# bucket upper bounds (in seconds) for the time webhooks spend queued
+WEBHOOK_LAG_BOUNDS = [0.001, 0.01, 0.1, 1.0, 10.0]
+
+# the body returned for webhooks we don't act on, serialized once
+EMPTY_RESPONSE_BODY = b"{}"
+
+
+def empty_response() -> Response:
+    return Response(EMPTY_RESPONSE_BODY, mimetype="application/json")
+
+
+class WebhookHandler:
+    """
+    How to handle the webhooks for one topic.
+
+    If `by_state` is set the handler is called as `handler(state, message)` and
+    messages without a state are ignored; if `states` is also given, only
+    messages in one of those states are dispatched.  Otherwise the handler is
+    called as `handler(message)`.  A handler of None ignores every message.
+
+    `required` lists the message fields the handler can't do without; they
+    are checked up front when webhooks are queued, since by the time the
+    handler runs the agent has already had its response.
+    """
+
+    __slots__ = ("handler", "by_state", "states", "required")
+
+    def __init__(
+        self,
+        handler=None,
+        by_state: bool = False,
+        states: set = None,
+        required: tuple = (),
+    ):
+        self.handler = handler
+        self.by_state = by_state
+        self.states = frozenset(states) if states is not None else None
+        self.required = tuple(required)
+
+    def missing_fields(self, message: dict) -> list:
+        return [field for field in self.required if field not in message]
+
+    def is_noop(self, message: dict) -> bool:
+        if self.handler is None:
+            return True
+        if self.by_state:
+            state = message.get("state")
+            if state is None:
+                return True
+            if self.states is not None and state not in self.states:
+                return True
+        return False
+
+    def method_name(self, topic: str, message: dict) -> str:
+        method = "agent_callback." + topic
+        if self.by_state:
+            method = method + "." + message["state"]
+        return method
+
+    def __call__(self, message: dict):
+        if self.by_state:
+            return self.handler(message["state"], message)
+        return self.handler(message)
+
+
+class WebhookDispatcher:
+    """A registry of webhook handlers by topic."""
+
+    def __init__(self):
+        self._handlers = {}
+
+    def register(self, topics, handler: WebhookHandler):
+        if isinstance(topics, str):
+            topics = [topics]
+        for topic in topics:
+            self._handlers[topic] = handler
+
+    def ignore(self, topics):
+        self.register(topics, WebhookHandler())
+
+    def get(self, topic: str) -> WebhookHandler:
+        return self._handlers.get(topic)
+
+    def topics(self) -> list:
+        return list(self._handlers)
+
+
+class WebhookQueue:
+    """
+    Apply webhooks on a pool of consumer threads, so that the agent gets its
+    response as soon as the webhook is queued.
+
+    When the queue is full the `overflow` policy applies: "reject" raises
+    QueueFullError (so the agent gets an error and can retry), "drop" discards
+    the webhook, and "inline" leaves it to the caller to apply it directly.
+    """
+
+    def __init__(
+        self,
+        consumer_count: int,
+        queue_size: int,
+        overflow: str = WEBHOOK_OVERFLOW_REJECT,
+    ):
+        if overflow not in WEBHOOK_OVERFLOW_POLICIES:
+            raise Exception("Invalid webhook overflow policy: " + str(overflow))
+        self.overflow = overflow
+        self._executor = IssuanceExecutor(consumer_count, queue_size, name="webhook")
+        self._lock = threading.Lock()
+        self._lag = Histogram(WEBHOOK_LAG_BOUNDS)
+        self._last_lag = 0.0
+        self._error_count = 0
+        self._dropped_count = 0
+        self._inline_count = 0
+
+    def _consume(self, queued_time: float, fn, args, kwargs):
+        lag = time.perf_counter() - queued_time
+        with self._lock:
+            self._lag.record(lag)
+            self._last_lag = lag
+        try:
+            fn(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self._error_count = self._error_count + 1
+            LOGGER.exception("Error applying queued webhook")
+
+    def submit(self, fn, *args, **kwargs) -> bool:
+        """
+        Queue `fn(*args, **kwargs)`.
+
+        Returns True if the webhook has been dealt with (queued, or dropped
+        under the "drop" policy) and False if the caller should apply it
+        inline; raises QueueFullError under the "reject" policy.
+        """
+        try:
+            self._executor.submit(
+                self._consume, time.perf_counter(), fn, args, kwargs, timeout=0
+            )
+            return True
+        except QueueFullError:
+            if self.overflow == WEBHOOK_OVERFLOW_REJECT:
+                raise
+            with self._lock:
+                if self.overflow == WEBHOOK_OVERFLOW_DROP:
+                    self._dropped_count = self._dropped_count + 1
+                else:
+                    self._inline_count = self._inline_count + 1
+            if self.overflow == WEBHOOK_OVERFLOW_DROP:
+                LOGGER.error("Webhook queue is full, dropping webhook")
+                return True
+            return False
+
+    def stats(self) -> dict:
+        ret = self._executor.stats()
+        with self._lock:
+            ret.update(
+                {
+                    "overflow": self.overflow,
+                    "error_count": self._error_count,
+                    "dropped_count": self._dropped_count,
+                    "inline_count": self._inline_count,
+                    "last_lag": self._last_lag,
+                    "lag": self._lag.to_dict(),
+                }
+            )
+        return ret
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait)
@@ -86,5 +86,81 @@ def test_agent_callback_TOPIC_PROBLEM_REPORT_empty(test_client):
     assert get_resp.status_code == 500
     # empty is not valid
 
+
+
+def test_agent_callback_noop_topic_skips_timing(test_client):
+    data = {"state": "request_received"}
+    with patch('src.issuer.log_timing_method') as log_timing_method:
+        get_resp = test_client.post(f'/api/agentcb/topic/'+issuer.TOPIC_PRESENTATIONS+'/', json=data)
+    assert get_resp.status_code == 200
+    assert json.loads(get_resp.data.decode()) == {}
+    log_timing_method.assert_not_called()
+
+
+def test_agent_callback_connections_ignores_inactive_states(test_client):
+    data = {"state": "request", "connection_id": "conn-1"}
+    connections_handler = issuer.webhook_dispatcher.get(issuer.TOPIC_CONNECTIONS)
+    with patch.object(connections_handler, 'handler') as handle_connections:
+        get_resp = test_client.post(f'/api/agentcb/topic/'+issuer.TOPIC_CONNECTIONS+'/', json=data)
+    assert get_resp.status_code == 200
+    assert json.loads(get_resp.data.decode()) == {}
+    handle_connections.assert_not_called()
+
+
+def test_agent_callback_credentials_dispatched_by_state(test_client):
+    data = {
+        "state": "credential_acked",
+        "credential_exchange_id": "cred-dispatch-1",
+        "thread_id": "thread-dispatch-1",
+    }
+    with patch('src.issuer.ACK_ERROR_PCT', 0), patch('src.issuer.log_timing_method') as log_timing_method:
+        get_resp = test_client.post(f'/api/agentcb/topic/'+issuer.TOPIC_CREDENTIALS+'/', json=data)
+    assert get_resp.status_code == 200
+    assert json.loads(get_resp.data.decode()) == {"message": "credential_acked"}
+    assert log_timing_method.call_args[0][0] == "agent_callback." + issuer.TOPIC_CREDENTIALS + ".credential_acked"
+    response, thread_id = issuer.correlation_table.pop_response("cred-dispatch-1")
+    assert response["success"]
+    assert thread_id == "thread-dispatch-1"
+
+
+
+def test_agent_callback_trace_events_carry_trace_id(test_client):
+    data = {
+        "state": "credential_acked",
+        "credential_exchange_id": "cred-trace-1",
+        "thread_id": "thread-trace-1",
+    }
+    with patch('src.issuer.ACK_ERROR_PCT', 0), \
+            patch('src.issuer.TRACE_EVENTS', True), \
+            patch('src.issuer.TRACE_TARGET', issuer.TRACE_LOG_TARGET), \
+            patch('src.issuer.log_timing_event') as log_timing_event:
+        issuer.add_credential_request("cred-trace-1", trace_id="trace-1")
+        get_resp = test_client.post(f'/api/agentcb/topic/'+issuer.TOPIC_CREDENTIALS+'/', json=data)
+    assert get_resp.status_code == 200
+    issuer.correlation_table.pop_response("cred-trace-1")
+    # the webhook's events, and the credential handler's, all carry the trace id
+    assert log_timing_event.call_count == 4
+    assert all(call.kwargs["trace_id"] == "trace-1" for call in log_timing_event.call_args_list)
+
+
+def test_agent_callback_queued_mode(test_client):
+    data = {
+        "state": "credential_acked",
+        "credential_exchange_id": "cred-queued-1",
+        "thread_id": "thread-queued-1",
+    }
+    with patch('src.issuer.WEBHOOK_MODE', 'queued'), patch('src.issuer.ACK_ERROR_PCT', 0):
+        waiter = issuer.add_credential_request("cred-queued-1")
+        get_resp = test_client.post(f'/api/agentcb/topic/'+issuer.TOPIC_CREDENTIALS+'/', json=data)
+        assert get_resp.status_code == 200
+        assert json.loads(get_resp.data.decode()) == {}
+        assert waiter.wait(5)
+        bad_resp = test_client.post(f'/api/agentcb/topic/'+issuer.TOPIC_PROBLEM_REPORT+'/', json={"test": "value"})
+        assert bad_resp.status_code == 400
+    response, thread_id = issuer.correlation_table.pop_response("cred-queued-1")
+    assert response["success"]
+    assert thread_id == "thread-queued-1"
+    assert issuer.get_stats()["webhook_queue"]["lag"]["count"] >= 1
+
    
 #TODO: happy path tests for each topic
\ No newline at end of file
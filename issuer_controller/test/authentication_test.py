@@ -0,0 +1,116 @@
+import pytest,threading,time
+
+from unittest.mock import MagicMock, patch
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwk, jwt
+from src import authentication
+
+JWKS_URI = "http://idp/jwks"
+
+
+def make_key(kid):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode()
+    public_jwk = jwk.construct(pem, "RS256").public_key().to_dict()
+    public_jwk["kid"] = kid
+    return pem, public_jwk
+
+
+def make_token(pem, kid, expires_in=300):
+    return jwt.encode(
+        {"sub": "pipeline", "exp": int(time.time()) + expires_in},
+        pem,
+        algorithm="RS256",
+        headers={"kid": kid},
+    )
+
+
+def jwks_response(*keys):
+    response = MagicMock()
+    response.json.return_value = {"keys": list(keys)}
+    return response
+
+
+@pytest.fixture
+def caches():
+    authentication.jwks_cache.clear()
+    authentication.verified_tokens.clear()
+    yield
+    authentication.jwks_cache.clear()
+    authentication.verified_tokens.clear()
+
+
+def validate(app, token):
+    with patch.dict('os.environ', {"OIDC_JWKS_URI": JWKS_URI}), \
+            app.test_request_context(headers={"Authorization": "Bearer " + token}):
+        return authentication.validate_token()
+
+
+def test_validate_token_caches_keys_and_tokens(app, caches):
+    pem, public_jwk = make_key("key-1")
+    token = make_token(pem, "key-1")
+    with patch('src.authentication.requests.get', return_value=jwks_response(public_jwk)) as get, \
+            patch('src.authentication.jwt.decode', wraps=jwt.decode) as decode:
+        assert validate(app, token)
+        assert validate(app, token)
+        assert validate(app, make_token(pem, "key-1", expires_in=600))
+    # one fetch of the keys, and the repeated token isn't verified again
+    assert get.call_count == 1
+    assert decode.call_count == 2
+
+
+def test_validate_token_refreshes_on_unknown_kid(app, caches):
+    pem_1, jwk_1 = make_key("key-1")
+    pem_2, jwk_2 = make_key("key-2")
+    responses = [jwks_response(jwk_1), jwks_response(jwk_1, jwk_2)]
+    with patch('src.authentication.requests.get', side_effect=responses) as get, \
+            patch.object(authentication.jwks_cache, 'min_refresh_interval', 0):
+        assert validate(app, make_token(pem_1, "key-1"))
+        assert validate(app, make_token(pem_2, "key-2"))
+    assert get.call_count == 2
+
+
+def test_validate_token_limits_unknown_kid_refreshes(app, caches):
+    pem, public_jwk = make_key("key-1")
+    with patch('src.authentication.requests.get', return_value=jwks_response(public_jwk)) as get:
+        assert validate(app, make_token(pem, "key-1"))
+        assert not validate(app, make_token(pem, "unknown-1"))
+        assert not validate(app, make_token(pem, "unknown-2"))
+    assert get.call_count == 1
+
+
+def test_validate_token_uses_stale_keys_while_refreshing(app, caches):
+    pem, public_jwk = make_key("key-1")
+    refreshed = threading.Event()
+
+    def idp_down(*args, **kwargs):
+        refreshed.set()
+        raise Exception("identity provider is down")
+
+    with patch('src.authentication.requests.get', return_value=jwks_response(public_jwk)):
+        assert validate(app, make_token(pem, "key-1"))
+    with patch('src.authentication.requests.get', side_effect=idp_down), \
+            patch.object(authentication.jwks_cache, 'ttl', 0), \
+            patch.object(authentication.jwks_cache, 'min_refresh_interval', 0):
+        assert validate(app, make_token(pem, "key-1", expires_in=600))
+        assert refreshed.wait(5)
+
+
+def test_verified_token_cache_expiry_and_lru():
+    tokens = authentication.VerifiedTokenCache(2)
+    now = time.time()
+    tokens.add("a", {"exp": now + 60})
+    tokens.add("b", {"exp": now + 60})
+    tokens.add("expired", {"exp": now - 1})
+    tokens.add("no-exp", {})
+    assert not tokens.contains("expired")
+    assert not tokens.contains("no-exp")
+    assert not tokens.contains("a")
+    tokens.add("c", {"exp": now + 60})
+    assert tokens.contains("b")
+    assert tokens.contains("c")
@@ -0,0 +1,261 @@
+import sqlite3,threading,time
+
+from time import sleep
+
+from src.correlation import CorrelationTable
+from src.correlation_sqlite import SqliteCorrelationTable
+
+
+def test_response_resolves_waiter():
+    table = CorrelationTable(ttl=60, orphan_ttl=60, max_entries=10)
+    waiter = table.add_request("cred-1", threading.Event())
+    table.set_thread_id("cred-1", "thread-1")
+    table.add_response("cred-1", {"success": True, "result": "cred-1"})
+    assert waiter.is_set()
+    assert table.pop_response("cred-1") == ({"success": True, "result": "cred-1"}, "thread-1")
+    assert table.stats()["entry_count"] == 0
+    assert table.get_cred_exch_id("thread-1") is None
+
+
+def test_request_keeps_trace_id():
+    table = CorrelationTable(ttl=60, orphan_ttl=60, max_entries=10)
+    table.add_request("cred-1", threading.Event(), thread_id="thread-1", trace_id="trace-1")
+    assert table.get_trace_id("cred-1") == "trace-1"
+    assert table.get_trace_id("cred-2") is None
+    table.pop_response("cred-1")
+    assert table.get_trace_id("cred-1") is None
+
+
+def test_early_response_short_circuits_request():
+    table = CorrelationTable(ttl=60, orphan_ttl=60, max_entries=10)
+    table.add_response("cred-1", {"success": True, "result": "cred-1"})
+    assert table.add_request("cred-1", threading.Event()) is None
+    assert table.pop_response("cred-1")[0]["success"]
+
+
+def test_orphans_expire():
+    table = CorrelationTable(ttl=60, orphan_ttl=0, max_entries=10)
+    table.set_thread_id("cred-1", "thread-1")
+    table.add_response("cred-2", {"success": True, "result": "cred-2"})
+    table.add_request("cred-3", threading.Event())
+    sleep(0.01)
+    table.expire()
+    stats = table.stats()
+    assert stats["entry_count"] == 1
+    assert stats["orphaned_count"] == 2
+    assert stats["outstanding_count"] == 1
+    assert table.get_cred_exch_id("thread-1") is None
+
+
+def test_outstanding_requests_expire():
+    table = CorrelationTable(ttl=0, orphan_ttl=60, max_entries=10)
+    table.add_request("cred-1", threading.Event())
+    sleep(0.01)
+    table.expire()
+    assert table.stats()["expired_count"] == 1
+    assert table.outstanding_count() == 0
+
+
+def test_size_cap_evicts_oldest_orphan():
+    table = CorrelationTable(ttl=60, orphan_ttl=60, max_entries=2, shard_count=1)
+    table.add_request("cred-1", threading.Event())
+    table.set_thread_id("cred-2", "thread-2")
+    table.set_thread_id("cred-3", "thread-3")
+    stats = table.stats()
+    assert stats["entry_count"] == 2
+    assert stats["evicted_count"] == 1
+    assert table.is_waiting("cred-1")
+    assert table.get_cred_exch_id("thread-2") is None
+
+
+def test_sharded_table_reports_lock_wait():
+    table = CorrelationTable(ttl=60, orphan_ttl=60, max_entries=1000, shard_count=4)
+
+    def exchange(i):
+        cred_exch_id = "cred-" + str(i)
+        waiter = table.add_request(cred_exch_id, threading.Event())
+        table.set_thread_id(cred_exch_id, "thread-" + str(i))
+        table.add_response(cred_exch_id, {"success": True, "result": cred_exch_id})
+        assert waiter.is_set()
+        assert table.pop_response(cred_exch_id)[1] == "thread-" + str(i)
+
+    threads = [threading.Thread(target=exchange, args=(i,)) for i in range(50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = table.stats()
+    assert stats["entry_count"] == 0
+    assert stats["shard_count"] == 4
+    assert stats["lock_wait"]["count"] > 0
+    assert all(table.get_cred_exch_id("thread-" + str(i)) is None for i in range(50))
+
+
+def test_problem_report_routed_by_registered_thread_id():
+    table = CorrelationTable(ttl=60, orphan_ttl=60, max_entries=100)
+    waiter = table.add_request("cred-1", threading.Event(), thread_id="thread-1")
+    table.add_request("cred-2", threading.Event(), thread_id="thread-2")
+    response = {"success": False, "result": "thread-1::problem"}
+    assert table.add_thread_response("thread-1", response) == "cred-1"
+    assert waiter.is_set()
+    assert table.pop_response("cred-1") == (response, "thread-1")
+    assert table.is_waiting("cred-2")
+
+
+def test_early_responses_capped_per_shard():
+    table = CorrelationTable(ttl=60, orphan_ttl=60, max_entries=4, shard_count=1)
+    for i in range(6):
+        table.add_thread_response("thread-%d" % i, {"success": True, "result": str(i)})
+    stats = table.stats()
+    assert stats["early_response_count"] == 4
+    assert stats["evicted_count"] == 2
+    # the oldest were dropped
+    assert not table.add_request("cred-0", threading.Event(), thread_id="thread-0").is_set()
+    assert table.add_request("cred-5", threading.Event(), thread_id="thread-5").is_set()
+
+
+def test_early_problem_report_applied_on_registration():
+    table = CorrelationTable(ttl=60, orphan_ttl=60, max_entries=100)
+    response = {"success": False, "result": "thread-1::problem"}
+    assert table.add_thread_response("thread-1", response) is None
+    assert table.stats()["early_response_count"] == 1
+    waiter = table.add_request("cred-1", threading.Event(), thread_id="thread-1")
+    assert waiter.is_set()
+    assert table.pop_response("cred-1") == (response, "thread-1")
+    assert table.stats()["early_response_count"] == 0
+
+
+def test_unmatched_problem_report_expires():
+    table = CorrelationTable(ttl=60, orphan_ttl=60, max_entries=100, early_ttl=0)
+    table.add_thread_response("thread-1", {"success": False, "result": "x"})
+    sleep(0.01)
+    table.expire()
+    stats = table.stats()
+    assert stats["early_response_count"] == 0
+    assert stats["orphaned_count"] == 1
+
+
+
+def sqlite_table(tmp_path, **kwargs):
+    args = dict(ttl=60, orphan_ttl=60, max_entries=100, poll_interval=0.01)
+    args.update(kwargs)
+    return SqliteCorrelationTable(str(tmp_path / "correlation.db"), **args)
+
+
+def test_sqlite_response_from_another_worker(tmp_path):
+    waiting_worker = sqlite_table(tmp_path)
+    webhook_worker = sqlite_table(tmp_path)
+    waiter = waiting_worker.add_request("cred-1", threading.Event(), thread_id="thread-1")
+    assert waiting_worker.outstanding_count() == 1
+    assert webhook_worker.outstanding_count() == 0
+    assert webhook_worker.is_waiting("cred-1")
+
+    webhook_worker.add_response("cred-1", {"success": True, "result": "cred-1"})
+    assert waiter.wait(5)
+    assert waiting_worker.pop_response("cred-1") == ({"success": True, "result": "cred-1"}, "thread-1")
+    assert webhook_worker.get_cred_exch_id("thread-1") is None
+
+
+def test_sqlite_trace_id_seen_by_another_worker(tmp_path):
+    waiting_worker = sqlite_table(tmp_path)
+    webhook_worker = sqlite_table(tmp_path)
+    waiting_worker.add_request("cred-1", threading.Event(), trace_id="trace-1")
+    assert webhook_worker.get_trace_id("cred-1") == "trace-1"
+    assert webhook_worker.get_trace_id("cred-2") is None
+
+
+def test_sqlite_early_problem_report_from_another_worker(tmp_path):
+    waiting_worker = sqlite_table(tmp_path)
+    webhook_worker = sqlite_table(tmp_path)
+    response = {"success": False, "result": "thread-1::problem"}
+    assert webhook_worker.add_thread_response("thread-1", response) is None
+    waiter = waiting_worker.add_request("cred-1", threading.Event(), thread_id="thread-1")
+    assert waiter.is_set()
+    assert waiting_worker.pop_response("cred-1") == (response, "thread-1")
+
+    waiter = waiting_worker.add_request("cred-2", threading.Event(), thread_id="thread-2")
+    assert webhook_worker.add_thread_response("thread-2", response) == "cred-2"
+    assert waiter.wait(5)
+
+
+def test_sqlite_response_before_request(tmp_path):
+    table = sqlite_table(tmp_path)
+    table.set_thread_id("cred-1", "thread-1")
+    table.add_response("cred-1", {"success": True, "result": "cred-1"})
+    assert table.add_request("cred-1", threading.Event()) is None
+    assert table.pop_response("cred-1")[0]["success"]
+
+
+def test_sqlite_expiry(tmp_path):
+    table = sqlite_table(tmp_path, ttl=0, orphan_ttl=0, early_ttl=0)
+    table.add_request("cred-1", threading.Event())
+    table.set_thread_id("cred-2", "thread-2")
+    table.add_thread_response("thread-3", {"success": False, "result": "x"})
+    sleep(0.01)
+    table.expire()
+    stats = table.stats()
+    assert stats["backend"] == "sqlite"
+    assert stats["entry_count"] == 0
+    assert stats["early_response_count"] == 0
+    assert stats["expired_count"] == 1
+    assert stats["orphaned_count"] == 2
+    assert stats["lock_wait"]["count"] > 0
+    assert table.outstanding_count() == 0
+    assert table.get_cred_exch_id("thread-2") is None
+
+
+def test_sqlite_retries_while_another_process_holds_the_lock(tmp_path):
+    table = sqlite_table(tmp_path, busy_timeout=0.01, lock_timeout=5)
+    other = sqlite3.connect(
+        str(tmp_path / "correlation.db"), isolation_level=None, check_same_thread=False
+    )
+    other.execute("BEGIN IMMEDIATE")
+    timer = threading.Timer(0.2, lambda: other.execute("COMMIT"))
+    timer.start()
+    # longer than the busy timeout, so the write only succeeds by retrying
+    table.add_response("cred-1", {"success": True, "result": "cred-1"})
+    timer.join()
+    other.close()
+    assert table.pop_response("cred-1")[0]["success"]
+    assert table.stats()["lock_wait"]["max_time"] >= 0.1
+
+
+def test_sqlite_reads_not_blocked_by_a_retrying_write(tmp_path):
+    table = sqlite_table(tmp_path, busy_timeout=0.01, lock_timeout=5)
+    table.add_request("cred-1", threading.Event(), trace_id="trace-1")
+    other = sqlite3.connect(
+        str(tmp_path / "correlation.db"), isolation_level=None, check_same_thread=False
+    )
+    other.execute("BEGIN IMMEDIATE")
+    writer = threading.Thread(
+        target=table.add_response, args=("cred-1", {"success": True, "result": "cred-1"})
+    )
+    writer.start()
+    sleep(0.1)
+    start_time = time.perf_counter()
+    # the writer is backing off while the other connection holds the write lock
+    assert table.get_trace_id("cred-1") == "trace-1"
+    assert table.is_waiting("cred-1")
+    assert time.perf_counter() - start_time < 0.5
+    assert writer.is_alive()
+    other.execute("COMMIT")
+    other.close()
+    writer.join()
+    assert table.pop_response("cred-1")[0]["success"]
+
+
+def test_sqlite_threads_share_one_connection(tmp_path):
+    table = sqlite_table(tmp_path)
+
+    def add(i):
+        table.add_request("cred-%d" % i, threading.Event(), thread_id="thread-%d" % i)
+        table.add_response("cred-%d" % i, {"success": True, "result": str(i)})
+
+    threads = [threading.Thread(target=add, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert table.stats()["entry_count"] == 8
+    assert table.get_cred_exch_id("thread-3") == "cred-3"
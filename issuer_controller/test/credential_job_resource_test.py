@@ -0,0 +1,107 @@
+import json,threading,time
+
+from time import sleep
+
+from unittest.mock import patch
+from src import issuer
+from src.executor import QueueFullError
+from src.jobs import JobStore, JOB_COMPLETE, JOB_PENDING
+from test.issue_credential_resource_test import test_send_credential
+
+
+def mock_send_credential(credential_definition_id, cred_offer, *args):
+    sleep(0.05)
+    return {"success": True, "result": cred_offer["schema_name"]}
+
+
+def wait_for_job(test_client, job_id):
+    for _ in range(100):
+        get_resp = test_client.get('/jobs/' + job_id)
+        assert get_resp.status_code == 200
+        job = json.loads(get_resp.data.decode())
+        if job["status"] == JOB_COMPLETE:
+            return job
+        sleep(0.05)
+    raise AssertionError("job did not complete")
+
+
+def test_issue_credential_async_returns_job(test_client):
+    with patch('src.issuer.send_credential', new=mock_send_credential):
+        post_resp = test_client.post('/issue-credential?async=true', json=test_send_credential)
+        assert post_resp.status_code == 202
+        job = json.loads(post_resp.data.decode())
+        assert post_resp.headers["Location"] == '/jobs/' + job["job_id"]
+        assert job["total_count"] == 2
+
+        job = wait_for_job(test_client, job["job_id"])
+    assert [r["result"] for r in job["results"]] == [c["schema"] for c in test_send_credential]
+
+
+def test_issue_credential_prefer_respond_async(test_client):
+    with patch('src.issuer.send_credential', new=mock_send_credential):
+        post_resp = test_client.post(
+            '/issue-credential', json=test_send_credential, headers={"Prefer": "respond-async"}
+        )
+        assert post_resp.status_code == 202
+        wait_for_job(test_client, json.loads(post_resp.data.decode())["job_id"])
+
+
+def test_issue_credential_async_records_invalid_items(test_client):
+    batch = [dict(test_send_credential[0], version="9.9.9"), test_send_credential[1]]
+    with patch('src.issuer.send_credential', new=mock_send_credential):
+        post_resp = test_client.post('/issue-credential?async=true', json=batch)
+        assert post_resp.status_code == 202
+        job = wait_for_job(test_client, json.loads(post_resp.data.decode())["job_id"])
+    assert [r["success"] for r in job["results"]] == [False, True]
+    assert job["results"][0]["errors"] == ["Unknown schema my-registration.org version 9.9.9"]
+
+
+def test_issue_credential_async_returns_before_sending(test_client):
+    release = threading.Event()
+
+    def send(credential_definition_id, cred_offer, *args):
+        release.wait(5)
+        return {"success": True, "result": cred_offer["schema_name"]}
+
+    with patch('src.issuer.send_credential', new=send):
+        start = time.perf_counter()
+        post_resp = test_client.post('/issue-credential?async=true', json=test_send_credential)
+        assert time.perf_counter() - start < 1
+        assert post_resp.status_code == 202
+        job = json.loads(post_resp.data.decode())
+        assert job["status"] == JOB_PENDING
+        release.set()
+        job = wait_for_job(test_client, job["job_id"])
+    assert all(r["success"] for r in job["results"])
+
+
+def test_issue_credential_async_fails_job_when_runners_busy(test_client):
+    with patch.object(issuer.job_executor, 'submit', side_effect=QueueFullError("jobs queue is full")), \
+            patch('src.issuer.send_credential') as send:
+        post_resp = test_client.post('/issue-credential?async=true', json=test_send_credential)
+        assert post_resp.status_code == 202
+        job = wait_for_job(test_client, json.loads(post_resp.data.decode())["job_id"])
+    send.assert_not_called()
+    assert job["results"] == [{"success": False, "result": "jobs queue is full"}] * 2
+    assert issuer.concurrency_limiter.in_flight == 0
+
+
+def test_get_unknown_job(test_client):
+    get_resp = test_client.get('/jobs/not-a-job')
+    assert get_resp.status_code == 404
+
+
+def test_job_store_evicts_oldest_when_full():
+    store = JobStore(2, 60)
+    jobs = [store.create(1) for _ in range(3)]
+    assert store.get(jobs[0].job_id) is None
+    assert store.get(jobs[2].job_id).status == JOB_PENDING
+    assert store.stats()["evicted_count"] == 1
+
+
+def test_job_store_expires_completed_jobs():
+    store = JobStore(10, 0)
+    job = store.create(1)
+    job.set_result(0, {"success": True, "result": "done"})
+    sleep(0.01)
+    assert store.get(job.job_id) is None
@@ -1,9 +1,12 @@
-import pytest,threading,json, random
+import asyncio, pytest,threading,json, random
 
 from time import sleep
 
 from unittest.mock import MagicMock, patch, PropertyMock
 from src import issuer,config
+from src.admin_client import AdminClient
+from src.async_engine import AsyncIssuanceEngine
+from src.executor import IssuanceExecutor, QueueFullError
 
 test_send_credential = [
     {
@@ -63,18 +66,12 @@ def test_health_route(test_client):
 
 
 ##-------------Issue-Credential--------------
-class MockSendCredentialThread(threading.Thread):
-    def __init__(self,*args):
-        threading.Thread.__init__(self)
-        return
-
-    def run(self):
-        sleep(random.randint(1,1000)/1000)
-        self.cred_response = {"success": True, "result":"MOCK_RESPONSE"}
-        return    
-
-def test_issue_credential_spawns_thread(app):
-    with patch('src.issuer.SendCredentialThread',new=MockSendCredentialThread) as mock:
+def mock_send_credential(*args):
+    sleep(random.randint(1,1000)/1000)
+    return {"success": True, "result":"MOCK_RESPONSE"}
+
+def test_issue_credential_submits_to_executor(app):
+    with patch('src.issuer.send_credential',new=mock_send_credential) as mock:
         res = issuer.handle_send_credential(test_send_credential)
         assert res.status_code == 200
         responses = json.loads(res.response[0])
@@ -83,19 +80,234 @@ def test_issue_credential_spawns_thread(app):
         assert len(responses) == 2
 
 
-def test_SendCredentialThread_posts_to_agent(app):
+def test_send_credential_posts_to_agent(app):
     cred_def = "CRED_DEF_my-registration.org_1.0.0"
     cred_offer =  {"test":"tests","test2":"test2"}
     agent_url = config.TestConfig.get("AGENT_ADMIN_URL") + "/issue-credential/send"
     headers = {"Content-Type": "application/json"}
 
-    with patch('src.issuer.requests.post') as mock:
-        thread = issuer.SendCredentialThread(
+    with patch('src.issuer.admin_client.post') as mock:
+        issuer.send_credential(
             cred_def,
             cred_offer,
             agent_url,
             headers,
         )
-        thread.start()
-        thread.join()
         mock.assert_called_with(agent_url, json.dumps(cred_offer), headers=headers)
+
+
+def mock_ordered_send_credential(credential_definition_id, cred_offer, *args):
+    sleep(random.randint(1, 100) / 1000)
+    return {"success": True, "result": cred_offer["comment"]}
+
+
+def test_send_credential_batch_preserves_order(app):
+    cred_offers = [("CRED_DEF", {"comment": str(i)}) for i in range(10)]
+    with patch('src.issuer.send_credential', new=mock_ordered_send_credential), \
+            patch('src.issuer.CRED_BATCH_CONCURRENCY', 4):
+        responses = issuer.send_credential_batch(cred_offers, "http://agent/send")
+    assert [r["result"] for r in responses] == [str(i) for i in range(10)]
+
+
+def test_issuance_executor_returns_futures():
+    executor = IssuanceExecutor(2, 4, name="test")
+    futures = [executor.submit(lambda x: x * 2, i) for i in range(4)]
+    assert [f.result(timeout=5) for f in futures] == [0, 2, 4, 6]
+    stats = executor.stats()
+    assert stats["worker_count"] == 2
+    assert stats["completed_count"] == 4
+    executor.shutdown()
+
+
+def test_issuance_executor_rejects_when_queue_full():
+    executor = IssuanceExecutor(1, 1, name="test")
+    release = threading.Event()
+    executor.submit(release.wait)
+    sleep(0.1)
+    executor.submit(release.wait)
+    with pytest.raises(QueueFullError):
+        executor.submit(release.wait, timeout=0.01)
+    assert executor.stats()["queue_depth"] == 1
+    release.set()
+    executor.shutdown()
+
+
+def test_status_reports_executor_gauges(test_client):
+    get_resp = test_client.get('/status')
+    assert get_resp.status_code == 200
+    assert "queue_depth" in json.loads(get_resp.data.decode())["issuance_executor"]
+
+
+def test_async_engine_resolves_exchange_from_webhook(app):
+    web = pytest.importorskip("aiohttp.web")
+    engine = AsyncIssuanceEngine(10)
+    engine.start()
+
+    async def offer_handler(request):
+        return web.json_response(
+            {"cred_ex_id": "async-cred-ex", "thread_id": "async-thread", "connection_id": "conn"}
+        )
+
+    async def start_agent():
+        agent_app = web.Application()
+        agent_app.router.add_post("/issue-credential-2.0/send", offer_handler)
+        runner = web.AppRunner(agent_app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        return runner, runner.addresses[0][1]
+
+    runner, port = asyncio.run_coroutine_threadsafe(start_agent(), engine._loop).result()
+    try:
+        with patch('src.issuer.async_engine', new=engine), \
+                patch('src.issuer.ISSUANCE_ENGINE', issuer.ISSUANCE_ENGINE_ASYNCIO):
+            future = issuer.submit_credential(
+                "CRED_DEF", {"comment": ""}, f"http://127.0.0.1:{port}/issue-credential-2.0/send"
+            )
+            # simulate the agent's webhook arriving on a Flask thread
+            while not issuer.correlation_table.is_waiting("async-cred-ex"):
+                sleep(0.01)
+            issuer.add_credential_response(
+                "async-cred-ex", {"success": True, "result": "async-cred-ex"}
+            )
+            response = future.result(timeout=5)
+        assert response["success"]
+    finally:
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), engine._loop).result()
+        engine.shutdown()
+
+
+def test_admin_client_applies_default_timeout():
+    client = AdminClient(pool_size=2, connect_timeout=1, read_timeout=2)
+    with patch.object(client._session, 'request') as mock:
+        client.get("http://agent/status", headers={"x": "y"})
+        mock.assert_called_with("GET", "http://agent/status", headers={"x": "y"}, timeout=(1, 2))
+        client.post("http://agent/send", "{}", timeout=10)
+        mock.assert_called_with("POST", "http://agent/send", data="{}", headers=None, timeout=10)
+
+
+def test_issue_credential_streams_ndjson(test_client):
+    with patch('src.issuer.send_credential', new=mock_send_credential), \
+            patch('src.issuer.CRED_BATCH_CONCURRENCY', 2):
+        post_resp = test_client.post(
+            '/issue-credential', json=test_send_credential,
+            headers={"Accept": "application/x-ndjson"}
+        )
+        assert post_resp.status_code == 200
+        assert post_resp.mimetype == "application/x-ndjson"
+        lines = [json.loads(line) for line in post_resp.data.decode().splitlines()]
+    assert sorted(line["index"] for line in lines) == [0, 1]
+    assert all(line["success"] for line in lines)
+
+
+def test_build_cred_offers_from_templates(app):
+    cred_offers, failures = issuer.build_cred_offers(test_send_credential)
+    assert failures == {}
+    cred_def_id, cred_offer = cred_offers[0]
+    assert cred_def_id == issuer.app_config["schemas"]["CRED_DEF_my-registration.org_1.0.0"]
+    assert cred_offer["schema_id"] == issuer.app_config["schemas"]["SCHEMA_my-registration.org_1.0.0"]
+    assert cred_offer["connection_id"] == issuer.app_config["TOB_CONNECTION"]
+    attributes = cred_offer["credential_proposal"]["attributes"]
+    assert attributes[0] == {"name": "corp_num", "mime-type": "text/plain", "value": "ABC12345"}
+
+    cred_def_id_v20, cred_offer_v20 = issuer.build_cred_offers_v20(test_send_credential)[0][0]
+    assert cred_def_id_v20 == cred_def_id
+    assert cred_offer_v20["filter"]["indy"]["cred_def_id"] == cred_def_id
+    assert cred_offer_v20["credential_preview"]["attributes"][0] == {"name": "corp_num", "value": "ABC12345"}
+
+
+def test_issue_credential_unknown_schema_is_rejected(test_client):
+    unknown = [dict(test_send_credential[0], version="9.9.9")]
+    with patch('src.issuer.send_credential') as send:
+        post_resp = test_client.post('/issue-credential-v20', json=unknown)
+    send.assert_not_called()
+    assert post_resp.status_code == 200
+    responses = json.loads(post_resp.data.decode())
+    assert responses == [{
+        "success": False,
+        "result": "Invalid credential: Unknown schema my-registration.org version 9.9.9",
+        "errors": ["Unknown schema my-registration.org version 9.9.9"],
+    }]
+
+
+def test_issue_credential_rejects_invalid_items(test_client):
+    missing = dict(test_send_credential[1]["attributes"])
+    del missing["permit_type"]
+    bad_date = dict(test_send_credential[1]["attributes"], effective_date="not-a-date", colour="red")
+    batch = [
+        test_send_credential[0],
+        dict(test_send_credential[1], attributes=missing),
+        dict(test_send_credential[1], attributes=bad_date),
+        dict(test_send_credential[1], attributes=dict(test_send_credential[1]["attributes"], entity_name="")),
+    ]
+    with patch('src.issuer.send_credential', new=mock_send_credential):
+        post_resp = test_client.post('/issue-credential-v20', json=batch)
+    # the valid credential is sent, and each invalid one fails in place
+    assert post_resp.status_code == 200
+    responses = json.loads(post_resp.data.decode())
+    assert len(responses) == 4
+    assert responses[0] == {"success": True, "result": "MOCK_RESPONSE"}
+    assert not any(response["success"] for response in responses[1:])
+    assert responses[1]["errors"] == ["missing attribute permit_type"]
+    assert responses[2]["errors"] == [
+        "unknown attribute colour",
+        "effective_date is not a valid date: not-a-date",
+    ]
+    assert responses[3]["errors"] == ["entity_name is required"]
+
+
+def test_issue_credential_streams_invalid_items(test_client):
+    batch = [dict(test_send_credential[0], version="9.9.9"), test_send_credential[1]]
+    with patch('src.issuer.send_credential', new=mock_send_credential):
+        post_resp = test_client.post(
+            '/issue-credential', json=batch, headers={"Accept": "application/x-ndjson"}
+        )
+        lines = [json.loads(line) for line in post_resp.data.decode().splitlines()]
+    assert [(line["index"], line["success"]) for line in lines] == [(0, False), (1, True)]
+
+
+def test_send_credential_carries_trace_id(app):
+    response = MagicMock()
+    response.json.return_value = {"credential_exchange_id": "ex-1", "thread_id": "thread-1"}
+    with patch('src.issuer.admin_client.post', return_value=response), \
+            patch('src.issuer.add_credential_request', return_value=None), \
+            patch('src.issuer.get_credential_response', return_value={"success": True, "result": "thread-1"}), \
+            patch('src.issuer.log_timing_event') as log_event:
+        cred_response = issuer.send_credential(
+            "CRED_DEF", {"comment": ""}, "http://agent/send", {}, "trace-1"
+        )
+    assert cred_response == {"success": True, "result": "thread-1", "trace_id": "trace-1"}
+    assert all(call.kwargs["trace_id"] == "trace-1" for call in log_event.call_args_list)
+
+
+def test_issue_credential_propagates_trace_ids(test_client):
+    calls = []
+
+    def send(credential_definition_id, cred_offer, url, headers, trace_id=None):
+        calls.append((cred_offer["comment"], trace_id))
+        return {"success": True, "result": "MOCK_RESPONSE", "trace_id": trace_id}
+
+    with patch('src.issuer.send_credential', new=send):
+        post_resp = test_client.post(
+            '/issue-credential', json=test_send_credential,
+            headers={issuer.TRACE_IDS_HEADER: "trace-a, trace-b"}
+        )
+    assert post_resp.status_code == 200
+    assert sorted(calls) == [("trace_id:trace-a", "trace-a"), ("trace_id:trace-b", "trace-b")]
+    responses = json.loads(post_resp.data.decode())
+    assert [r["trace_id"] for r in responses] == ["trace-a", "trace-b"]
+
+
+def test_issue_credential_rejects_bad_trace_ids(test_client):
+    with patch('src.issuer.send_credential') as send:
+        too_few = test_client.post(
+            '/issue-credential', json=test_send_credential,
+            headers={issuer.TRACE_IDS_HEADER: "trace-a"}
+        )
+        invalid = test_client.post(
+            '/issue-credential-v20', json=test_send_credential,
+            headers={issuer.TRACE_IDS_HEADER: "trace-a,bad id!"}
+        )
+    send.assert_not_called()
+    assert too_few.status_code == 400
+    assert invalid.status_code == 400
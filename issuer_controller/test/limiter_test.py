@@ -0,0 +1,202 @@
+import pytest,threading,time
+
+from unittest.mock import patch
+from src import issuer
+from src.limiter import AdaptiveLimiter
+from test.issue_credential_resource_test import test_send_credential
+
+
+
+def test_limit_grows_while_exchanges_are_fast():
+    limiter = AdaptiveLimiter(initial_limit=4, min_limit=1, max_limit=100, latency_target=1)
+    for _ in range(4):
+        limiter.acquire()
+    for _ in range(40):
+        limiter.record(time.perf_counter(), 0.1)
+    assert limiter.limit > 4
+    assert limiter.stats()["latency"] == pytest.approx(0.1)
+
+
+def test_limit_does_not_grow_when_unused():
+    limiter = AdaptiveLimiter(initial_limit=8, min_limit=1, latency_target=1)
+    limiter.acquire()
+    for _ in range(40):
+        limiter.record(time.perf_counter(), 0.1)
+    assert limiter.limit == 8
+
+
+def test_limit_is_cut_once_per_round():
+    limiter = AdaptiveLimiter(initial_limit=32, min_limit=4, latency_target=1, backoff_ratio=0.5)
+    start_time = time.perf_counter()
+    # slow exchanges that were all in flight together only cut the limit once
+    for _ in range(5):
+        limiter.record(start_time, 2)
+    assert limiter.limit == 16
+    limiter.record(time.perf_counter(), 0.5, timed_out=True)
+    assert limiter.limit == 8
+    limiter.record(time.perf_counter(), 5)
+    limiter.record(time.perf_counter(), 5)
+    # but never below the minimum
+    assert limiter.limit == 4
+
+
+def test_try_acquire_rejects_at_limit():
+    limiter = AdaptiveLimiter(initial_limit=2, min_limit=1)
+    permit = limiter.try_acquire()
+    assert permit is not None
+    limiter.acquire()
+    assert limiter.try_acquire() is None
+    permit.release()
+    # releasing a permit's slots again does nothing
+    permit.release()
+    assert limiter.in_flight == 1
+    assert limiter.try_acquire() is not None
+    assert limiter.stats()["rejected_count"] == 1
+
+
+def test_try_acquire_reserves_whole_batch():
+    limiter = AdaptiveLimiter(initial_limit=8, min_limit=1)
+    first = limiter.try_acquire(5)
+    assert limiter.in_flight == 5
+    # a batch larger than the remaining headroom is rejected outright
+    assert limiter.try_acquire(4) is None
+    assert limiter.in_flight == 5
+    second = limiter.try_acquire(3)
+    assert limiter.in_flight == 8
+    first.release(2)
+    second.release_all()
+    assert limiter.in_flight == 3
+    # a batch larger than the limit is only admitted when nothing is in flight
+    first.release_all()
+    assert limiter.try_acquire(20) is not None
+
+
+def test_submit_credential_tracks_in_flight(app):
+    release = threading.Event()
+
+    def send(*args):
+        release.wait(5)
+        return {"success": True, "result": "MOCK_RESPONSE"}
+
+    limiter = AdaptiveLimiter(initial_limit=4, min_limit=1)
+    with patch.object(issuer, 'concurrency_limiter', limiter), \
+            patch('src.issuer.send_credential', new=send):
+        future = issuer.submit_credential("CRED_DEF", {}, "http://agent/send")
+        assert limiter.in_flight == 1
+        release.set()
+        future.result(timeout=5)
+    assert limiter.in_flight == 0
+
+
+def test_issue_credential_throttled_at_limit(test_client):
+    limiter = AdaptiveLimiter(initial_limit=1, min_limit=1, latency_target=1)
+    limiter.acquire()
+    limiter.record(time.perf_counter(), 2.5)
+    with patch.object(issuer, 'concurrency_limiter', limiter), \
+            patch('src.issuer.ADAPTIVE_CONCURRENCY', True), \
+            patch('src.issuer.send_credential') as send:
+        post_resp = test_client.post('/issue-credential-v20', json=[{"schema": "x"}])
+    send.assert_not_called()
+    assert post_resp.status_code == 429
+    assert post_resp.headers["Retry-After"] == "3"
+
+
+def test_issue_credential_batch_larger_than_headroom_rejected(test_client):
+    limiter = AdaptiveLimiter(initial_limit=4, min_limit=1)
+    limiter.acquire(2)
+    with patch.object(issuer, 'concurrency_limiter', limiter), \
+            patch('src.issuer.ADAPTIVE_CONCURRENCY', True), \
+            patch('src.issuer.CRED_BATCH_CONCURRENCY', 3), \
+            patch('src.issuer.send_credential') as send:
+        post_resp = test_client.post(
+            '/issue-credential-v20', json=[{"schema": "x"}] * 3
+        )
+    send.assert_not_called()
+    assert post_resp.status_code == 429
+    assert limiter.in_flight == 2
+
+
+def test_issue_credential_releases_reserved_slots(test_client):
+    def send(*args):
+        return {"success": True, "result": "MOCK_RESPONSE"}
+
+    limiter = AdaptiveLimiter(initial_limit=4, min_limit=1)
+    with patch.object(issuer, 'concurrency_limiter', limiter), \
+            patch('src.issuer.ADAPTIVE_CONCURRENCY', True), \
+            patch('src.issuer.send_credential', new=send):
+        post_resp = test_client.post('/issue-credential-v20', json=[{"schema": "x"}] * 3)
+        assert limiter.in_flight == 0
+    # the invalid credentials fail in place, and their slots are given back
+    assert post_resp.status_code == 200
+    assert limiter.stats()["admitted_count"] == 1
+
+
+def test_unread_stream_releases_reserved_slots_on_close(app):
+    limiter = AdaptiveLimiter(initial_limit=4, min_limit=1)
+    with patch('src.issuer.send_credential') as send:
+        response = issuer._stream_credentials(
+            [{"cred_def_id": "1"}, {"cred_def_id": "2"}],
+            "http://agent/issue-credential/send",
+            permit=limiter.acquire(2),
+        )
+        assert limiter.in_flight == 2
+        response.close()
+    assert limiter.in_flight == 0
+    assert not send.called
+
+
+def test_batch_reserves_only_the_slots_it_sends_at_once(app):
+    limiter = AdaptiveLimiter(initial_limit=4, min_limit=1)
+    with patch.object(issuer, 'concurrency_limiter', limiter), \
+            patch('src.issuer.CRED_BATCH_CONCURRENCY', 2):
+        permit = issuer.reserve_exchanges(5)
+        assert limiter.in_flight == 2
+        permit.release_all()
+        issuer.reserve_exchanges(1)
+    assert limiter.in_flight == 1
+
+
+def test_default_config_admits_pipeline_load(test_client):
+    # the pipeline's defaults: MAX_CREDS_REQUESTS concurrent batches of
+    # CREDS_REQUEST_SIZE credentials
+    batch_count = 16
+    batch = (test_send_credential * 3)[:5]
+    all_started = threading.Event()
+    lock = threading.Lock()
+    started = []
+    peak_in_flight = []
+
+    def send(*args):
+        with lock:
+            started.append(1)
+            peak_in_flight.append(limiter.in_flight)
+            if len(started) == batch_count:
+                all_started.set()
+        all_started.wait(5)
+        return {"success": True, "result": "MOCK_RESPONSE"}
+
+    limiter = AdaptiveLimiter(
+        initial_limit=issuer.CONCURRENCY_INITIAL_LIMIT,
+        min_limit=issuer.CONCURRENCY_MIN_LIMIT,
+        max_limit=issuer.CONCURRENCY_MAX_LIMIT,
+        latency_target=issuer.CONCURRENCY_LATENCY_TARGET,
+    )
+    statuses = []
+
+    def post():
+        resp = test_client.post('/issue-credential', json=batch)
+        with lock:
+            statuses.append(resp.status_code)
+
+    with patch.object(issuer, 'concurrency_limiter', limiter), \
+            patch('src.issuer.ADAPTIVE_CONCURRENCY', True), \
+            patch('src.issuer.send_credential', new=send):
+        threads = [threading.Thread(target=post) for _ in range(batch_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+    assert statuses == [200] * batch_count
+    assert max(peak_in_flight) <= batch_count * issuer.CRED_BATCH_CONCURRENCY
+    assert limiter.stats()["rejected_count"] == 0
+    assert limiter.in_flight == 0
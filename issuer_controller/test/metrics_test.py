@@ -0,0 +1,124 @@
+import pytest,threading
+
+from unittest.mock import patch
+from src import issuer
+from src.metrics import LatencyHistogram, MethodTimings, MetricsRegistry
+
+
+
+def test_latency_histogram_percentiles():
+    histogram = LatencyHistogram()
+    for i in range(1, 1001):
+        histogram.record(i / 1000)
+    assert histogram.count == 1000
+    assert histogram.min == 0.001
+    assert histogram.max == 1.0
+    # within the histogram's relative error
+    assert histogram.percentile(0.5) == pytest.approx(0.5, rel=1 / 16)
+    assert histogram.percentile(0.99) == pytest.approx(0.99, rel=1 / 16)
+    assert histogram.percentile(0.999) <= 1.0
+
+
+def test_method_timings_merge_shards():
+    timings = MethodTimings(shard_count=4, failure_samples=3)
+
+    def record():
+        for i in range(100):
+            timings.record("send_credential", 0.01, i % 10 != 0, data={"i": i})
+
+    threads = [threading.Thread(target=record) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = timings.to_dict()["send_credential"]
+    assert stats["total_count"] == 400
+    assert stats["fail_count"] == 40
+    assert stats["error_rate"] == pytest.approx(0.1)
+    assert stats["p50"] == pytest.approx(0.01, rel=1 / 16)
+    # only the most recent failures are kept
+    assert len(stats["failures"]) == 3
+
+
+def test_method_timings_spreads_threads_over_shards():
+    timings = MethodTimings(shard_count=4)
+    # keep every thread alive until all have recorded, so none share an ident
+    barrier = threading.Barrier(4)
+
+    def record():
+        timings.record("send_credential", 0.01, True)
+        barrier.wait(5)
+
+    threads = [threading.Thread(target=record) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    used_shards = [methods for _, methods in timings._shards if methods]
+    assert len(used_shards) > 1
+    assert timings.to_dict()["send_credential"]["total_count"] == 4
+
+
+def test_method_timings_caps_methods():
+    timings = MethodTimings(max_methods=2)
+    for method in ["a", "b", "c", "d"]:
+        timings.record(method, 0.001, True)
+    stats = timings.to_dict()
+    assert set(stats) == {"a", "b", "_other"}
+    assert stats["_other"]["total_count"] == 2
+    timings.clear()
+    assert timings.to_dict() == {}
+
+
+def test_status_reports_method_percentiles(test_client):
+    with patch('src.issuer.RECORD_TIMINGS', True):
+        issuer.log_timing_method("test_method", 0, 0.25, True)
+        issuer.log_timing_method("test_method", 0, 0.5, False, data="oops")
+        get_resp = test_client.get('/status')
+    stats = get_resp.get_json()["test_method"]
+    assert stats["total_count"] == 2
+    assert stats["error_rate"] == 0.5
+    assert stats["failures"][0]["data"] == "oops"
+    assert "p999" in stats
+    test_client.get('/status/reset')
+    assert "test_method" not in test_client.get('/status').get_json()
+
+
+def test_metrics_registry_render():
+    registry = MetricsRegistry()
+    counter = registry.counter("test_errors", "Test errors", ("method", "status"))
+    histogram = registry.histogram("test_seconds", "Test latency", ("topic",), [0.1, 1])
+    registry.gauge("test_outstanding", "Test gauge", lambda: 3)
+    counter.inc("POST", "500")
+    counter.inc("POST", "500")
+    histogram.observe(0.05, 'a"b')
+    histogram.observe(0.5, 'a"b')
+    lines = registry.render().splitlines()
+    assert "# TYPE test_errors counter" in lines
+    assert 'test_errors_total{method="POST",status="500"} 2' in lines
+    assert "# TYPE test_seconds histogram" in lines
+    assert 'test_seconds_bucket{topic="a\\"b",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{topic="a\\"b",le="1"} 2' in lines
+    assert 'test_seconds_bucket{topic="a\\"b",le="+Inf"} 2' in lines
+    assert 'test_seconds_count{topic="a\\"b"} 2' in lines
+    assert "test_outstanding 3" in lines
+
+
+def test_metrics_endpoint(test_client):
+    reports = issuer.problem_reports.value()
+    webhooks = issuer.webhook_duration.count(issuer.TOPIC_PROBLEM_REPORT, "")
+    data = {"~thread": {"thid": "metrics-thread"}, "explain-ltxt": "bad credential"}
+    with patch('src.issuer.RECORD_TIMINGS', False):
+        resp = test_client.post('/api/agentcb/topic/' + issuer.TOPIC_PROBLEM_REPORT + '/', json=data)
+        assert resp.status_code == 200
+        get_resp = test_client.get('/metrics')
+    assert get_resp.status_code == 200
+    assert get_resp.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    assert issuer.problem_reports.value() == reports + 1
+    assert issuer.webhook_duration.count(issuer.TOPIC_PROBLEM_REPORT, "") == webhooks + 1
+    body = get_resp.data.decode()
+    assert "issuer_problem_reports_total " + str(reports + 1) in body
+    assert "# TYPE issuer_outstanding_exchanges gauge" in body
+    assert "# TYPE issuer_admin_api_errors counter" in body
@@ -0,0 +1,119 @@
+import pytest,time,json
+
+import requests
+from unittest.mock import MagicMock, patch
+from src import issuer
+from src.resilience import (
+    BREAKER_CLOSED,
+    BREAKER_HALF_OPEN,
+    BREAKER_OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+    RetryPolicy,
+    call_with_retry,
+    is_retryable,
+)
+
+
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(str(status), response=response)
+
+
+def test_error_classification():
+    assert is_retryable(http_error(503))
+    assert is_retryable(http_error(429), idempotent=False)
+    assert not is_retryable(http_error(400))
+    assert not is_retryable(http_error(404))
+    assert not is_retryable(http_error(500), idempotent=False)
+    assert is_retryable(requests.ConnectTimeout("connect"), idempotent=False)
+    assert is_retryable(requests.ReadTimeout("read"))
+    assert not is_retryable(requests.ReadTimeout("read"), idempotent=False)
+    assert not is_retryable(ValueError("bad json"))
+
+
+def test_call_with_retry_backs_off_until_success():
+    fn = MagicMock(side_effect=[http_error(503), requests.ConnectionError("down"), "ok"])
+    policy = RetryPolicy(max_attempts=4, base_delay=0.01, max_delay=0.02, deadline=5)
+    with patch('src.resilience.time.sleep') as sleep:
+        assert call_with_retry(fn, policy) == "ok"
+    assert fn.call_count == 3
+    assert all(0 <= call.args[0] <= 0.02 for call in sleep.call_args_list)
+
+
+def test_call_with_retry_does_not_retry_fatal_errors():
+    fn = MagicMock(side_effect=http_error(400))
+    with pytest.raises(requests.HTTPError):
+        call_with_retry(fn, RetryPolicy(max_attempts=4, base_delay=0.01))
+    assert fn.call_count == 1
+
+
+def test_call_with_retry_respects_deadline():
+    fn = MagicMock(side_effect=http_error(503))
+    policy = RetryPolicy(max_attempts=10, base_delay=1, max_delay=1, deadline=0.5)
+    with patch('src.resilience.random.uniform', return_value=1), \
+            pytest.raises(requests.HTTPError):
+        call_with_retry(fn, policy)
+    assert fn.call_count == 1
+
+
+def test_circuit_breaker_opens_and_recovers():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    fn = MagicMock(side_effect=http_error(502))
+    policy = RetryPolicy(max_attempts=1)
+    for _ in range(2):
+        with pytest.raises(requests.HTTPError):
+            call_with_retry(fn, policy, breaker)
+    assert breaker.to_dict()["state"] == BREAKER_OPEN
+    assert breaker.is_open()
+    with pytest.raises(CircuitOpenError):
+        call_with_retry(fn, policy, breaker)
+    assert fn.call_count == 2
+
+    time.sleep(0.06)
+    # a single trial call is let through, and closes the breaker
+    breaker.allow()
+    assert breaker.to_dict()["state"] == BREAKER_HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+    breaker.record_success()
+    assert breaker.to_dict()["state"] == BREAKER_CLOSED
+
+
+def test_circuit_breaker_ignores_fatal_errors():
+    breaker = CircuitBreaker(failure_threshold=1)
+    with pytest.raises(requests.HTTPError):
+        call_with_retry(MagicMock(side_effect=http_error(422)), RetryPolicy(), breaker)
+    assert breaker.to_dict()["state"] == BREAKER_CLOSED
+
+
+def test_issue_credential_fails_fast_when_breaker_open(test_client):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    with patch.object(issuer, 'agent_breaker', breaker), \
+            patch('src.issuer.send_credential') as send:
+        post_resp = test_client.post('/issue-credential', json=[{"schema": "x"}])
+        readiness = test_client.get('/readiness')
+    send.assert_not_called()
+    assert post_resp.status_code == 503
+    assert 0 < int(post_resp.headers["Retry-After"]) <= 30
+    assert json.loads(readiness.data.decode())["agent_circuit"]["state"] == BREAKER_OPEN
+
+
+def test_exchange_timeouts_open_breaker(app):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    response = MagicMock()
+    response.json.return_value = {"credential_exchange_id": "ex-1", "thread_id": "t-1", "connection_id": "c-1"}
+    waiter = MagicMock()
+    waiter.wait.return_value = False
+    with patch.object(issuer, 'agent_breaker', breaker), \
+            patch('src.issuer.admin_client.post', return_value=response), \
+            patch('src.issuer.add_credential_request', return_value=waiter), \
+            patch('src.issuer.get_credential_response', return_value={"success": False, "result": "t-1::Error thread timeout"}):
+        for _ in range(3):
+            issuer.send_credential("CRED_DEF", {}, "http://agent/send", {})
+    # the third offer isn't sent
+    assert response.json.call_count == 2
+    assert breaker.to_dict()["state"] == BREAKER_OPEN
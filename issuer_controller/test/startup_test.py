@@ -0,0 +1,154 @@
+import threading,json
+
+from unittest.mock import MagicMock, patch
+from src import issuer
+from src.startup import PHASE_COMPLETE, PHASE_FAILED, PHASE_PENDING, PHASE_SKIPPED, StartupPhases
+from src.startup_cache import StartupCache, config_hash
+
+
+AGENT_ADMIN_URL = "http://agent:8024"
+
+agent_ledger_data = {
+    "/schemas/created": {"schema_ids": ["did:2:schema-a:1.0", "did:2:schema-b:1.0"]},
+    "/schemas/did:2:schema-a:1.0": {"schema": {"name": "schema-a", "version": "1.0", "seqNo": 11}},
+    "/schemas/did:2:schema-b:1.0": {"schema": {"name": "schema-b", "version": "1.0", "seqNo": 12}},
+    "/credential-definitions/created": {"credential_definition_ids": ["did:3:CL:12:tag", "did:3:CL:99:tag"]},
+    "/credential-definitions/did:3:CL:12:tag": {"credential_definition": {"id": "did:3:CL:12:tag", "schemaId": "12"}},
+    "/credential-definitions/did:3:CL:99:tag": {"credential_definition": {"id": "did:3:CL:99:tag", "schemaId": "99"}},
+}
+
+
+def mock_agent_get(url, headers=None, **kwargs):
+    response = MagicMock()
+    response.json.return_value = agent_ledger_data[url[len(AGENT_ADMIN_URL):]]
+    return response
+
+
+def test_agent_schemas_cred_defs_matches_by_seq_no():
+    with patch('src.issuer.admin_client.get', side_effect=mock_agent_get) as agent_get:
+        schemas = issuer.agent_schemas_cred_defs(AGENT_ADMIN_URL)
+    assert agent_get.call_count == 6
+    assert set(schemas) == {"schema-a::1.0", "schema-b::1.0"}
+    assert schemas["schema-a::1.0"]["schema_id"] == "11"
+    assert "cred_def" not in schemas["schema-a::1.0"]
+    assert schemas["schema-b::1.0"]["cred_def"]["id"] == "did:3:CL:12:tag"
+
+
+def test_startup_cache_round_trip(tmp_path):
+    cache = StartupCache(str(tmp_path / "startup-cache.json"))
+    schemas_config = [{"name": "schema-a", "version": "1.0"}]
+    cache_key = config_hash(schemas_config, {"verifiers": {}})
+    assert cache.load("did-1", cache_key) is None
+
+    schemas = {"SCHEMA_schema-a_1.0": "did:2:schema-a:1.0", "CRED_DEF_schema-a_1.0": "did:3:CL:11:tag"}
+    cache.save("did-1", cache_key, schemas, "conn-1")
+    snapshot = cache.load("did-1", cache_key)
+    assert snapshot["schemas"] == schemas
+    assert snapshot["tob_connection"] == "conn-1"
+
+    # a different DID or configuration doesn't match
+    assert cache.load("did-2", cache_key) is None
+    changed = [{"name": "schema-a", "version": "1.1"}]
+    assert cache.load("did-1", config_hash(changed, {"verifiers": {}})) is None
+
+
+def test_startup_cache_ignores_corrupt_file(tmp_path):
+    path = tmp_path / "startup-cache.json"
+    path.write_text("{not json")
+    assert StartupCache(str(path)).load("did-1", "key") is None
+
+
+def mock_agent_post(url, payload, headers=None):
+    request = json.loads(payload)
+    response = MagicMock()
+    if url.endswith("/schemas"):
+        response.json.return_value = {"schema_id": "did:2:" + request["schema_name"] + ":" + request["schema_version"]}
+    else:
+        response.json.return_value = {"credential_definition_id": "cred-def-for-" + request["schema_id"]}
+    return response
+
+
+def test_register_schema_cred_def_chains_cred_def_to_schema():
+    schema = {"name": "schema-c", "version": "1.0", "attributes": ["corp_num"]}
+    with patch('src.issuer.agent_post_with_retry', side_effect=mock_agent_post) as agent_post:
+        schema_id, cred_def_id = issuer.register_schema_cred_def(AGENT_ADMIN_URL, schema, {})
+    assert agent_post.call_count == 2
+    assert schema_id == "did:2:schema-c:1.0"
+    assert cred_def_id == "cred-def-for-did:2:schema-c:1.0"
+    steps = issuer.get_stats()["startup"]["steps"]
+    assert steps["schema.schema-c::1.0"]["success"]
+    assert "cred_def.schema-c::1.0" in steps
+
+
+def test_register_schema_cred_def_skips_existing():
+    schema = {"name": "schema-b", "version": "1.0", "attributes": ["corp_num"]}
+    existing = {
+        "schema-b::1.0": {
+            "schema": {"id": "did:2:schema-b:1.0"},
+            "schema_id": "12",
+            "cred_def": {"id": "did:3:CL:12:tag"},
+        }
+    }
+    with patch('src.issuer.agent_post_with_retry') as agent_post:
+        ids = issuer.register_schema_cred_def(AGENT_ADMIN_URL, schema, existing)
+    agent_post.assert_not_called()
+    assert ids == ("did:2:schema-b:1.0", "did:3:CL:12:tag")
+
+
+def test_startup_phases_run_after_dependencies():
+    phases = StartupPhases()
+    order = []
+    lock = threading.Lock()
+
+    def phase(name):
+        def run():
+            with lock:
+                order.append(name)
+        return run
+
+    phases.add("config", phase("config"))
+    phases.add("did", phase("did"))
+    phases.add("registration", phase("registration"), ("config", "did"))
+    phases.add("register_issuer", phase("register_issuer"), ("registration",))
+    assert phases.state == PHASE_PENDING
+    assert phases.run()
+    assert set(order[:2]) == {"config", "did"}
+    assert order[2:] == ["registration", "register_issuer"]
+    status = phases.to_dict()
+    assert status["state"] == PHASE_COMPLETE
+    assert status["phases"]["registration"]["depends_on"] == ["config", "did"]
+    assert status["phases"]["registration"]["elapsed_time"] is not None
+
+
+def test_startup_phases_skip_dependents_of_failed_phase():
+    phases = StartupPhases()
+    ran = []
+
+    def fail():
+        raise Exception("agent is down")
+
+    phases.add("did", fail)
+    phases.add("config", lambda: ran.append("config"))
+    phases.add("registration", lambda: ran.append("registration"), ("did",))
+    phases.add("register_issuer", lambda: ran.append("register_issuer"), ("registration",))
+    assert not phases.run()
+    assert ran == ["config"]
+    status = phases.to_dict()
+    assert status["state"] == PHASE_FAILED
+    assert status["phases"]["did"]["error"] == "agent is down"
+    assert status["phases"]["register_issuer"]["state"] == PHASE_SKIPPED
+
+
+def test_wait_for_connection_active():
+    assert not issuer.wait_for_connection_active("conn-wait-1", 0.01)
+    timer = threading.Timer(0.05, issuer.set_connection_active, ("conn-wait-1", "test-alias"))
+    timer.start()
+    assert issuer.wait_for_connection_active("conn-wait-1", 5)
+    assert issuer.active_connection_for_alias("test-alias") == "conn-wait-1"
+
+
+def test_readiness_reports_startup_phases(test_client):
+    get_resp = test_client.get('/readiness')
+    body = json.loads(get_resp.data.decode())
+    assert "phases" in body["startup"]
+    assert get_resp.status_code == (200 if body["success"] else 503)
@@ -0,0 +1,84 @@
+import threading,time
+
+from unittest.mock import patch
+from src import issuer
+from src.metrics import CounterMetric
+from src.trace_exporter import TraceExporter
+
+
+
+def test_trace_exporter_sends_full_batches():
+    batches = []
+    exporter = TraceExporter(batches.append, batch_size=3, flush_interval=60)
+    for i in range(6):
+        exporter.export({"i": i})
+    assert exporter.flush(timeout=5)
+    assert [len(batch) for batch in batches] == [3, 3]
+    assert [event["i"] for batch in batches for event in batch] == list(range(6))
+    assert exporter.stats()["exported_count"] == 6
+
+
+def test_trace_exporter_sends_partial_batch_after_interval():
+    sent = threading.Event()
+    batches = []
+
+    def send(batch):
+        batches.append(batch)
+        sent.set()
+
+    exporter = TraceExporter(send, batch_size=100, flush_interval=0.05)
+    exporter.export({"i": 0})
+    assert sent.wait(5)
+    assert batches == [[{"i": 0}]]
+
+
+def test_trace_exporter_drops_oldest_when_full():
+    release = threading.Event()
+    sending = threading.Event()
+    batches = []
+
+    def send(batch):
+        sending.set()
+        release.wait(5)
+        batches.append(batch)
+
+    dropped = CounterMetric("dropped", "Dropped events")
+    exporter = TraceExporter(
+        send, batch_size=1, flush_interval=60, buffer_size=2, dropped_counter=dropped
+    )
+    exporter.export({"i": 0})
+    # the exporter is stuck sending the first event, so the rest are buffered
+    assert sending.wait(5)
+    start = time.perf_counter()
+    for i in range(1, 5):
+        exporter.export({"i": i})
+    assert time.perf_counter() - start < 1
+    release.set()
+    assert exporter.flush(timeout=5)
+    assert [batch[0]["i"] for batch in batches] == [0, 3, 4]
+    assert exporter.stats()["dropped_count"] == 2
+    assert dropped.value() == 2
+
+
+def test_trace_exporter_counts_failed_batches():
+    def send(batch):
+        raise Exception("trace target is down")
+
+    exporter = TraceExporter(send, batch_size=2, flush_interval=60)
+    exporter.export({"i": 0})
+    exporter.export({"i": 1})
+    assert exporter.flush(timeout=5)
+    stats = exporter.stats()
+    assert stats["failed_count"] == 2
+    assert stats["exported_count"] == 0
+
+
+def test_log_timing_event_uses_exporter():
+    with patch('src.issuer.TRACE_TARGET', "http://localhost:9999/"), \
+         patch.object(issuer.trace_exporter, 'export') as mock_export, \
+         patch('src.issuer.requests.post') as mock_post:
+        issuer.log_timing_event("issue_credential", {"thread_id": "t1"}, 0, 1, True)
+    mock_post.assert_not_called()
+    event = mock_export.call_args[0][0]
+    assert event["thread_id"] == "t1"
+    assert event["ellapsed_milli"] == 1000
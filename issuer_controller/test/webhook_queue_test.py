@@ -0,0 +1,59 @@
+import pytest,threading
+
+from time import sleep
+
+from src.executor import QueueFullError
+from src.webhooks import WebhookQueue
+
+
+
+def fill_queue(webhook_queue, release):
+    # one webhook held by the (single) consumer, one waiting on the queue
+    webhook_queue.submit(release.wait)
+    while webhook_queue.stats()["active_workers"] == 0:
+        sleep(0.001)
+    webhook_queue.submit(release.wait)
+
+
+def test_webhook_queue_applies_webhooks():
+    webhook_queue = WebhookQueue(2, 10)
+    applied = threading.Event()
+    assert webhook_queue.submit(applied.set)
+    assert applied.wait(1)
+    webhook_queue.submit(lambda: 1 / 0)
+    webhook_queue.shutdown()
+    stats = webhook_queue.stats()
+    assert stats["completed_count"] == 2
+    assert stats["error_count"] == 1
+    assert stats["lag"]["count"] == 2
+
+
+def test_webhook_queue_overflow_reject():
+    webhook_queue = WebhookQueue(1, 1, "reject")
+    release = threading.Event()
+    fill_queue(webhook_queue, release)
+    with pytest.raises(QueueFullError):
+        webhook_queue.submit(release.wait)
+    release.set()
+    webhook_queue.shutdown()
+
+
+def test_webhook_queue_overflow_drop_and_inline():
+    release = threading.Event()
+    dropping = WebhookQueue(1, 1, "drop")
+    fill_queue(dropping, release)
+    assert dropping.submit(release.wait)
+    assert dropping.stats()["dropped_count"] == 1
+
+    inline = WebhookQueue(1, 1, "inline")
+    fill_queue(inline, release)
+    assert not inline.submit(release.wait)
+    assert inline.stats()["inline_count"] == 1
+    release.set()
+    dropping.shutdown()
+    inline.shutdown()
+
+
+def test_webhook_queue_invalid_overflow():
+    with pytest.raises(Exception):
+        WebhookQueue(1, 1, "spill")
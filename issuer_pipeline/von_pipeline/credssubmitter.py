@@ -26,6 +26,7 @@ import sys
 import aiohttp
 import time
 import traceback
+import uuid
 from von_pipeline.config import config
 
 AGENT_URL = os.environ.get('VONX_API_URL', 'http://localhost:5000')
@@ -34,18 +35,48 @@ ISSUE_CRED_VERSION = os.getenv('ISSUE_CRED_VERSION', 'V10')
 if not ISSUE_CRED_VERSION in ['V10', 'V20']:
     raise Exception(f"Unsupported Issue Credential version: {ISSUE_CRED_VERSION}")
 
+# ask the controller to stream back each credential's result as soon as it completes
+STREAM_CRED_RESULTS = os.getenv('STREAM_CRED_RESULTS', 'false').lower() == 'true'
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# each credential gets a trace id, sent to the controller (one per credential,
+# comma-separated) and echoed back in its result
+TRACE_IDS_HEADER = 'X-Credential-Trace-Ids'
+
 CREDS_BATCH_SIZE = 3000
 CREDS_REQUEST_SIZE = 5     # use 1 because it's more likely to trigger deadlocks
 MAX_CREDS_REQUESTS = 16
 MAX_PROCESSING_MINS = 10
 PROCESS_LOOP_REPORT_CT = 100
 
+# the controller answers 429 (with a Retry-After) when the agent is at its
+# concurrency limit; wait and re-post, up to this many times
+MAX_THROTTLED_RETRIES = int(os.getenv('MAX_THROTTLED_RETRIES', '30'))
+
+
+async def post_when_admitted(http_client, url, creds, headers=None):
+    """Post a batch to the controller, waiting while it is throttling requests."""
+    retries = 0
+    while True:
+        response = await http_client.post(url, json=creds, headers=headers)
+        if response.status != 429 or retries >= MAX_THROTTLED_RETRIES:
+            return response
+        retries = retries + 1
+        try:
+            retry_after = float(response.headers.get('Retry-After', '1'))
+        except ValueError:
+            retry_after = 1
+        response.release()
+        await asyncio.sleep(retry_after)
+
 
-async def submit_cred_batch(http_client, creds):
+async def submit_cred_batch(http_client, creds, headers=None):
     try:
-        response = await http_client.post(
+        response = await post_when_admitted(
+            http_client,
             '{}/issue-credential'.format(AGENT_URL),
-            json=creds
+            creds,
+            headers
         )
         if response.status != 200:
             raise RuntimeError(
@@ -57,11 +88,13 @@ async def submit_cred_batch(http_client, creds):
         print(exc)
         raise 
 
-async def submit_cred_batch_v20(http_client, creds):
+async def submit_cred_batch_v20(http_client, creds, headers=None):
     try:
-        response = await http_client.post(
+        response = await post_when_admitted(
+            http_client,
             '{}/issue-credential-v20'.format(AGENT_URL),
-            json=creds
+            creds,
+            headers
         )
         if response.status != 200:
             raise RuntimeError(
@@ -73,6 +106,23 @@ async def submit_cred_batch_v20(http_client, creds):
         print(exc)
         raise
 
+async def submit_cred_batch_stream(http_client, creds, headers=None):
+    """Post a batch and yield each credential's result (with its "index") as it arrives."""
+    path = '/issue-credential-v20' if ISSUE_CRED_VERSION == "V20" else '/issue-credential'
+    response = await post_when_admitted(
+        http_client,
+        '{}{}'.format(AGENT_URL, path),
+        creds,
+        dict(headers or {}, Accept=NDJSON_MIMETYPE)
+    )
+    if response.status != 200:
+        raise RuntimeError(
+            'Credentials could not be processed: {}'.format(await response.text())
+        )
+    async for line in response.content:
+        if line.strip():
+            yield json.loads(line)
+
 async def post_credentials(http_client, conn, credentials):
     sql2 = """UPDATE CREDENTIAL_LOG
               SET PROCESS_DATE = %s, PROCESS_SUCCESS = 'Y', PROCESS_MSG = %s
@@ -85,50 +135,68 @@ async def post_credentials(http_client, conn, credentials):
     success = 0
     failed = 0
     post_creds = []
+    trace_ids = []
     for credential in credentials:
       # need to inject reason into this process
       post_creds.append({"schema":credential['SCHEMA_NAME'], "version":credential['SCHEMA_VERSION'], "attributes":credential['CREDENTIAL_JSON']})
+      trace_ids.append(uuid.uuid4().hex)
+    headers = {TRACE_IDS_HEADER: ','.join(trace_ids)}
 
     # post credential
     #print('Post credential ...')
     cur2 = None
     results = None
-    try:
-        if ISSUE_CRED_VERSION == "V20":
-            results = await submit_cred_batch_v20(http_client,post_creds)
+    logged = set()
+
+    def log_result(i, result):
+        nonlocal cur2, success, failed
+        credential = credentials[i]
+        if result['success']:
+            #print("log success to database")
+            cur2 = conn.cursor()
+            cur2.execute(sql2, (datetime.datetime.now(), result['result'], credential['RECORD_ID'],))
+            conn.commit()
+            cur2.close()
+            cur2 = None
+            success = success + 1
         else:
-            results = await submit_cred_batch(http_client, post_creds)
+            # the trace id ties the record to the controller's trace events
+            print("log error to database, credential", credential['RECORD_ID'], "trace id", trace_ids[i])
+            #print(result['result'])
+            #print(credential)
+            cur2 = conn.cursor()
+            if 255 < len(result['result']):
+                res = result['result'][:250] + '...'
+            else:
+                res = result['result']
+            cur2.execute(sql3, (datetime.datetime.now(), res, credential['RECORD_ID'],))
+            conn.commit()
+            cur2.close()
+            cur2 = None
+            failed = failed + 1
+        logged.add(i)
 
-        for i in range(len(credentials)):
-            credential = credentials[i]
-            result = results[i]
-
-            if result['success']:
-                #print("log success to database")
-                cur2 = conn.cursor()
-                cur2.execute(sql2, (datetime.datetime.now(), result['result'], credential['RECORD_ID'],))
-                conn.commit()
-                cur2.close()
-                cur2 = None
-                success = success + 1
+    try:
+        if STREAM_CRED_RESULTS:
+            # record each result as soon as the controller reports it
+            async for result in submit_cred_batch_stream(http_client, post_creds, headers):
+                log_result(result['index'], result)
+        else:
+            if ISSUE_CRED_VERSION == "V20":
+                results = await submit_cred_batch_v20(http_client, post_creds, headers)
             else:
-                print("log error to database")
-                #print(result['result'])
-                #print(credential)
-                cur2 = conn.cursor()
-                if 255 < len(result['result']):
-                    res = result['result'][:250] + '...'
-                else:
-                    res = result['result']
-                cur2.execute(sql3, (datetime.datetime.now(), res, credential['RECORD_ID'],))
-                conn.commit()
-                cur2.close()
-                cur2 = None
-                failed = failed + 1
+                results = await submit_cred_batch(http_client, post_creds, headers)
+
+            for i in range(len(credentials)):
+                log_result(i, results[i])
+
+        if len(logged) < len(credentials):
+            raise RuntimeError('No result returned for credential')
 
     except (Exception) as error:
-        # everything failed :-(
-        print("log exception to database")
+        # everything (that isn't already logged) failed :-(
+        print("log exception to database, trace ids",
+              ','.join(trace_ids[i] for i in range(len(credentials)) if i not in logged))
         if cur2 is not None:
             cur2.close()
             cur2 = None
@@ -137,6 +205,8 @@ async def post_credentials(http_client, conn, credentials):
         if 255 < len(res):
             res = res[:250] + '...'
         for i in range(len(credentials)):
+            if i in logged:
+                continue
             credential = credentials[i]
             cur2.execute(sql3, (datetime.datetime.now(), res, credential['RECORD_ID'],))
             failed = failed + 1